@@ -13,16 +13,22 @@
 # limitations under the License.
 """Set of utility functions to work with Firestore."""
 
+import threading
+import time
 from datetime import datetime
-from typing import Any
+from typing import Any, Callable
 
-from common import firestore_tools, solution
-from common.log import Logger, log_params
+from common import constants, firestore_tools, solution
+from common.cache import cache
+from common.log import Logger, log, log_params
 
 logger = Logger(__name__).get_logger()
 
 CURRENT_CONFIG = 'current_config'
 
+WATCH_RETRY_DELAY: int = int(solution.getenv('CONFIG_WATCH_RETRY_DELAY', f'{constants.MINUTE}'))
+"""How long to poll the config document before trying to subscribe to its changes again after the listener failed."""
+
 
 class AdminDAO:
     """Handles database persistence or configuration data."""
@@ -46,10 +52,11 @@ class AdminDAO:
     @log_params
     def get_resumes_timestamp(self) -> datetime | None:
         """Get most recent timestamp when resumes were updated."""
-        doc_ref = self._collection.document(CURRENT_CONFIG)
-        if not doc_ref.get().exists:
-            return None
-        return doc_ref.get().to_dict()['last_resume_update']
+        return _get_last_resume_update(self._collection.document(CURRENT_CONFIG).get())
+
+    def watch_config(self, callback: Callable[[Any, Any, Any], None]) -> Any:
+        """Subscribe to the changes of the config document. Returns Firestore `Watch` that can be unsubscribed."""
+        return self._collection.document(CURRENT_CONFIG).on_snapshot(callback)
 
     @log_params
     def erase_resumes_timestamp(self) -> None:
@@ -60,3 +67,114 @@ class AdminDAO:
 
         data: dict[str, Any] = {'last_resume_update': None, 'info': 'Erased resume refresh timestamp.'}
         doc_ref.set(data, merge=True)
+
+
+def _get_last_resume_update(doc_snapshot: Any) -> datetime | None:
+    """Extract the timestamp of the last resume update from the snapshot of the config document."""
+    if doc_snapshot is None or not doc_snapshot.exists:
+        return None
+    return doc_snapshot.to_dict().get('last_resume_update')
+
+
+@cache
+@log
+def _poll_resumes_version() -> datetime | None:
+    """Read the version of the resume index from the database at most once per cache timeout."""
+    return AdminDAO().get_resumes_timestamp()
+
+
+class ResumesVersionWatcher:
+    """Keep the version of the resume index up to date by listening to the changes of the config document.
+
+    Typical usage:
+        watcher = ResumesVersionWatcher()
+        watcher.add_listener(lambda version: logger.info('Resumes updated: %s', version))
+        version = watcher.get_version()
+
+    Until the first snapshot is received, or if the listener stops because of an error, the version is polled from
+    the database as before and the subscription is retried every `WATCH_RETRY_DELAY` seconds.
+    """
+
+    def __init__(self, admin_dao: AdminDAO | None = None) -> None:
+        self._admin_dao = admin_dao
+        self._lock = threading.Lock()
+        self._listeners: list[Callable[[datetime | None], None]] = []
+        self._watch: Any = None
+        self._started_at: float | None = None
+        self._has_version: bool = False
+        self._version: datetime | None = None
+
+    def start(self) -> None:
+        """Subscribe to the changes of the config document unless the subscription is already active."""
+        with self._lock:
+            if self._is_active():
+                return
+            self._started_at = time.monotonic()
+            self._has_version = False
+            try:
+                if self._admin_dao is None:
+                    self._admin_dao = AdminDAO()
+                self._watch = self._admin_dao.watch_config(self._on_snapshot)
+                logger.info('Watching changes of the resume index version.')
+            except Exception as err:    # noqa: B902
+                logger.error('Failed to watch changes of the resume index version, will poll instead: %s', err)
+
+    def stop(self) -> None:
+        """Unsubscribe from the changes of the config document."""
+        with self._lock:
+            watch, self._watch = self._watch, None
+            self._has_version = False
+        if watch is not None:
+            watch.unsubscribe()
+
+    def add_listener(self, listener: Callable[[datetime | None], None]) -> None:
+        """Call the listener from the Firestore thread with the new version every time resumes are updated."""
+        with self._lock:
+            self._listeners.append(listener)
+
+    def is_watching(self) -> bool:
+        """Return True if the version is kept up to date by the listener without reading the database."""
+        return self._has_version and self._is_active()
+
+    def get_version(self) -> datetime | None:
+        """Return the version pushed by the listener, or poll the database if the listener is not available."""
+        if self.is_watching():
+            return self._version
+        if self._started_at is None or time.monotonic() - self._started_at >= WATCH_RETRY_DELAY:
+            self.start()
+        return _poll_resumes_version()
+
+    def _is_active(self) -> bool:
+        return self._watch is not None and self._watch.is_active
+
+    def _on_snapshot(self, doc_snapshots: list[Any], changes: Any, read_time: Any) -> None:
+        """Remember the new version and notify the listeners if it has changed."""
+        version = _get_last_resume_update(doc_snapshots[0] if doc_snapshots else None)
+        with self._lock:
+            changed = not self._has_version or version != self._version
+            self._version = version
+            self._has_version = True
+            listeners = list(self._listeners)
+        if not changed:
+            return
+        logger.info('Resume index version changed to: %s', version)
+        for listener in listeners:
+            try:
+                listener(version)
+            except Exception as err:    # noqa: B902
+                logger.error('Failed to notify about resume index version %s: %s', version, err)
+
+
+VERSION_WATCHER = ResumesVersionWatcher()
+"""Process wide watcher of the resume index version. Subscribes on the first call to `get_resumes_version()`."""
+
+
+@log
+def get_resumes_version() -> datetime | None:
+    """Return version of the resume index (timestamp of the last resume update) without reading the database.
+
+    In local development mode the index is never updated by the resume manager, so the version is always None.
+    """
+    if solution.LOCAL_DEVELOPMENT_MODE:
+        return None
+    return VERSION_WATCHER.get_version()
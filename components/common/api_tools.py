@@ -13,10 +13,11 @@
 # limitations under the License.
 """Custom FastAPI routers to manipulate request/response flow."""
 
+import time
 from typing import Any, Callable
 
 import fastapi
-from common import solution
+from common import metrics, solution, tracing
 from common.log import Logger
 from fastapi import HTTPException, Request, Response
 from fastapi.routing import APIRoute
@@ -94,6 +95,110 @@ class ErrorHandler(APIRoute):
         return custom_route_handler
 
 
+_CONTEXT_HEADERS: frozenset[bytes] = frozenset(
+    (b'x-cloud-trace-context', b'traceparent', b'x-request-id', b'x-goog-authenticated-user-email'))
+"""Request headers read by `RequestContextMiddleware`."""
+
+
+class RequestContextMiddleware:
+    """Run every HTTP request in a `tracing.request_context()`, so that its logs and spans carry the trace id.
+
+    The trace id is taken from the request headers (see `tracing.trace_id_from_headers()`) or generated, and returned
+    in the `X-Trace-Id` response header so that clients can refer to the request when reporting problems.
+    """
+
+    def __init__(self, app: Any) -> None:
+        self.app = app
+
+    async def __call__(self, scope: dict, receive: Callable, send: Callable) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        headers = {name.decode('latin-1'): value.decode('latin-1') for name, value in scope['headers']
+                   if name in _CONTEXT_HEADERS}
+        user_email = headers.get('x-goog-authenticated-user-email')
+        with tracing.request_context(trace_id=tracing.trace_id_from_headers(headers),
+                                     user_id=user_email.split(':')[-1] if user_email else None) as trace_id:
+            trace_header = (b'x-trace-id', trace_id.encode('latin-1'))
+
+            async def send_with_trace_id(message: dict) -> None:
+                if message['type'] == 'http.response.start':
+                    message['headers'] = [*message.get('headers', []), trace_header]
+                await send(message)
+
+            await self.app(scope, receive, send_with_trace_id)
+
+
+class TracingMiddleware:
+    """Trace a sample of HTTP requests (see `tracing.TRACE_SAMPLE_RATE`) and log the span tree of slow ones.
+
+    Implemented as plain ASGI middleware, so that requests that are not sampled pass through without extra work, and
+    streaming responses are timed until their last chunk is sent.
+    """
+
+    def __init__(self, app: Any) -> None:
+        self.app = app
+
+    async def __call__(self, scope: dict, receive: Callable, send: Callable) -> None:
+        if scope['type'] != 'http' or not tracing.should_trace():
+            await self.app(scope, receive, send)
+            return
+        root: tracing.Span | None = None
+        try:
+            with tracing.trace(f'{scope["method"]} {scope["path"]}') as root:
+                await self.app(scope, receive, send)
+        finally:
+            if root is not None and root.wall is not None and root.wall >= tracing.TRACE_LOG_THRESHOLD:
+                logger.info('Slow request trace:\n%s', root.format())
+
+
+class MetricsMiddleware:
+    """Count HTTP requests and observe their latency by route (see `metrics.HTTP_REQUESTS`).
+
+    Requests are labelled with the route path, e.g. `/jobs/{job_id}`, rather than the actual path, to keep the number
+    of time series bounded.
+    """
+
+    def __init__(self, app: Any) -> None:
+        self.app = app
+        self._handlers: dict[Any, str] = {}
+        """Route paths keyed by endpoint function."""
+
+    async def __call__(self, scope: dict, receive: Callable, send: Callable) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_with_status(message: dict) -> None:
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        start = time.perf_counter()
+        metrics.HTTP_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            metrics.HTTP_IN_FLIGHT.dec()
+            handler = self._get_handler(scope)
+            metrics.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, scope['method'], handler)
+            metrics.HTTP_REQUESTS.inc(scope['method'], handler, str(status))
+
+    def _get_handler(self, scope: dict) -> str:
+        """Return path of the route that handled the request, which the router records in the scope."""
+        endpoint = scope.get('endpoint')
+        if endpoint is None:
+            return 'unmatched'
+        handler = self._handlers.get(endpoint)
+        if handler is None:
+            handler = next((route.path for route in scope['app'].routes
+                            if getattr(route, 'endpoint', None) is endpoint), 'unmatched')
+            self._handlers[endpoint] = handler
+        return handler
+
+
 class ServiceAPI(fastapi.FastAPI):
     """Custom API class that adds some new behavior to the standard FastAPI."""
 
@@ -112,3 +217,7 @@ class ServiceAPI(fastapi.FastAPI):
             license_info=solution.license_info)
 
         self.router.route_class = ErrorHandler
+        self.add_middleware(TracingMiddleware)
+        self.add_middleware(MetricsMiddleware)
+        # Added last so that it runs first and the other middlewares already see the trace id
+        self.add_middleware(RequestContextMiddleware)
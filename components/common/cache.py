@@ -21,7 +21,7 @@ import functools
 import os
 import time
 
-from common import constants
+from common import constants, metrics
 from common.log import Logger
 
 logger = Logger(__name__).get_logger()
@@ -69,14 +69,18 @@ def _ttl_cache(func, ttl_sec: int = CACHE_TIMEOUT, max_size: int = 2**14, typed:
         typed: Cache on distinct input types (see `functools.lru_cache`).
     """
 
+    cache_name = f'{func.__module__}.{func.__qualname__}'
+
     @functools.lru_cache(maxsize=max_size, typed=typed)
     def _cached(*args, _salt, **kwargs):
         """Cache the execution of the 'func' based on the value of '_salt' relative to current time."""
+        metrics.CACHE_MISSES.inc(cache_name)
         return func(*args, **kwargs)
 
     @functools.wraps(func)
     def _wrapper(*args, **kwargs):
         """Invoke '_cached' function with the proper time salt."""
+        metrics.CACHE_LOOKUPS.inc(cache_name)
         return _cached(*args, **kwargs, _salt=int(time.time() / ttl_sec))
 
     return _wrapper
@@ -0,0 +1,150 @@
+# Copyright 2023 Qarik Group, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Registry of versioned query engine snapshots that are rebuilt in the background and swapped atomically.
+
+Typical usage:
+    Create one registry per backend with a function that builds a new engine from the current index:
+
+        ENGINE_REGISTRY = EngineRegistry(name='chroma', builder=_create_engine)
+
+        def query(question):
+            engine = ENGINE_REGISTRY.get(version=admin_dao.get_resumes_version()).engine
+            return engine(question)
+
+    Readers never take a lock once the first snapshot is published: they get a reference to the current snapshot and
+    keep using it until the request completes, even if a newer snapshot is published in the meantime. The old
+    snapshot is garbage collected when the last in-flight request that uses it drops the reference.
+"""
+
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable
+
+from common import constants, metrics, solution, tracing
+from common.log import Logger, log
+
+logger = Logger(__name__).get_logger()
+
+REBUILD_RETRY_DELAY: int = constants.MINUTE
+"""How long to wait before retrying a failed background rebuild of the same version."""
+
+
+class EngineSnapshot:
+    """Immutable version of a query engine."""
+    __slots__ = ('version', 'engine', 'created')
+
+    def __init__(self, version: Any, engine: Any) -> None:
+        self.version = version
+        """Version of the index that the engine was built from, such as timestamp of the last resume update."""
+        self.engine = engine
+        """Query engine built by the registry builder."""
+        self.created: datetime = solution.now()
+        """When the snapshot was built."""
+
+
+class EngineRegistry:
+    """Keep track of the current engine snapshot for one backend and rebuild it when the index version changes."""
+
+    def __init__(self, name: str, builder: Callable[[], Any]) -> None:
+        """Initialize the registry.
+
+        Args:
+            name: Name of the backend, used for logging and thread names.
+            builder: Function that builds a new engine from the current state of the index.
+        """
+        self.name = name
+        self._builder = builder
+        self._snapshot: EngineSnapshot | None = None
+        self._build_lock = threading.Lock()
+        """Serialize builds. Readers only wait for it on cold start when there is no snapshot yet."""
+        self._rebuild_lock = threading.Lock()
+        """Protect the version of the background rebuild. Only taken when a new version is detected."""
+        self._rebuild_version: Any = None
+        self._rebuild_thread: threading.Thread | None = None
+        self._rebuild_failed_at: float = 0
+
+    def current(self) -> EngineSnapshot | None:
+        """Return the current snapshot or None if no engine has been built yet."""
+        return self._snapshot
+
+    def get(self, version: Any = None) -> EngineSnapshot:
+        """Return the current snapshot, building it on the caller thread only if there is none yet.
+
+        If the current snapshot is older than the requested version, the rebuild is started in the background and the
+        current snapshot is returned without waiting for it.
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            return self._build(version=version)
+        if snapshot.version != version:
+            self.refresh(version=version)
+        return snapshot
+
+    def refresh(self, version: Any = None) -> None:
+        """Start rebuilding the engine for the given version in the background, unless it is already in progress."""
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.version == version:
+            return
+        with self._rebuild_lock:
+            rebuild_in_progress = self._rebuild_thread is not None and self._rebuild_thread.is_alive()
+            if self._rebuild_version == version and (
+                    rebuild_in_progress or time.monotonic() - self._rebuild_failed_at < REBUILD_RETRY_DELAY):
+                return
+            self._rebuild_failed_at = 0
+            self._rebuild_version = version
+            # Log the rebuild with the trace id of the request that detected the new version
+            self._rebuild_thread = threading.Thread(target=tracing.detached(self._rebuild),
+                                                    kwargs={'version': version},
+                                                    name=f'{self.name}-rebuild',
+                                                    daemon=True)
+            self._rebuild_thread.start()
+
+    def warm_up(self, get_version: Callable[[], Any]) -> None:
+        """Look up the current version and build the first snapshot in the background to speed up the first request."""
+        threading.Thread(target=self._warm_up, kwargs={'get_version': get_version}, name=f'{self.name}-warm-up',
+                         daemon=True).start()
+
+    def _warm_up(self, get_version: Callable[[], Any]) -> None:
+        """Build the snapshot for the current version and log (rather than raise) errors."""
+        try:
+            self.get(version=get_version())
+        except Exception as err:    # noqa: B902
+            logger.error('Failed to warm up [%s] engine, will retry on first request: %s', self.name, err)
+
+    def _rebuild(self, version: Any) -> None:
+        """Build the new snapshot and log (rather than raise) errors, since nobody is waiting for the result."""
+        try:
+            self._build(version=version)
+        except Exception as err:    # noqa: B902
+            self._rebuild_failed_at = time.monotonic()
+            logger.error('Failed to rebuild [%s] engine for version %s, keep using the old one: %s', self.name,
+                         version, err)
+
+    @log
+    def _build(self, version: Any) -> EngineSnapshot:
+        """Build and publish the engine snapshot for the given version."""
+        with self._build_lock:
+            # Check again because the snapshot may have been built while we were waiting for the lock
+            snapshot = self._snapshot
+            if snapshot is not None and snapshot.version == version:
+                return snapshot
+            logger.info('Building [%s] engine for version %s...', self.name, version)
+            with metrics.STAGE_SECONDS.time('refresh'):
+                engine = self._builder()
+            snapshot = EngineSnapshot(version=version, engine=engine)
+            # Assignment of the reference is atomic, so readers see either the old or the new snapshot
+            self._snapshot = snapshot
+            logger.info('Published [%s] engine for version %s.', self.name, version)
+            return snapshot
@@ -13,36 +13,273 @@
 # limitations under the License.
 """Set of utility functions to work with GCS."""
 
+import base64
+import hashlib
+import json
 import os
 import shutil
+import tarfile
+import tempfile
+from datetime import datetime, timedelta
+from typing import IO, Any
 
+from common import constants, metrics, solution, tracing
 from common.log import Logger, log_params
+from google.api_core import exceptions
 from google.cloud import storage
 
 logger = Logger(__name__).get_logger()
 
+DOWNLOAD_WORKERS: int = int(solution.getenv('GCS_DOWNLOAD_WORKERS', '16'))
+"""Maximum number of objects downloaded from GCS at the same time."""
+
+UPLOAD_WORKERS: int = int(solution.getenv('GCS_UPLOAD_WORKERS', '16'))
+"""Maximum number of objects uploaded to GCS at the same time."""
+
+LOCAL_MANIFEST_SUFFIX: str = '.gcs-manifest.json'
+"""Suffix of the file next to the synced local directory that records the GCS object behind each local file."""
+
+MANIFEST_NAME: str = 'manifest.json'
+"""Object that lists the objects of the current version of the published directory. Readers only follow it."""
+
+VERSIONS_PREFIX: str = 'versions/'
+"""Prefix of the objects uploaded for each published version and of the manifest of each version."""
+
+BUNDLE_NAME: str = 'bundle.tar.gz'
+"""Compressed archive with all files of a version, published next to them for fast download by new instances."""
+
+BUNDLE_CHUNK_SIZE: int = 8 * 1024 * 1024
+"""Size of the chunks in which the bundle is streamed from GCS."""
+
+VERSION_GRACE_PERIOD: int = int(solution.getenv('GCS_VERSION_GRACE_PERIOD', f'{constants.HOUR}'))
+"""How long to keep objects of a version after it was replaced, so that readers in the middle of a sync can finish."""
+
+PUBLISH_ATTEMPTS: int = 5
+"""How many times to try merging a fragment into the manifest that keeps being changed by concurrent publishers."""
+
+
+def _get_local_manifest_path(local_dir: str) -> str:
+    """Keep the manifest outside of the synced directory so that it is never mistaken for one of the synced files."""
+    return f'{os.path.normpath(local_dir)}{LOCAL_MANIFEST_SUFFIX}'
+
+
+def _read_local_manifest(local_dir: str) -> dict[str, dict[str, Any]]:
+    """Return GCS object name, generation and MD5 hash of each local file keyed by path relative to the directory."""
+    try:
+        with open(_get_local_manifest_path(local_dir), encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_local_manifest(local_dir: str, manifest: dict[str, dict[str, Any]]) -> None:
+    manifest_path = _get_local_manifest_path(local_dir)
+    with open(f'{manifest_path}.tmp', 'w', encoding='utf-8') as file:
+        json.dump(manifest, file)
+    os.replace(f'{manifest_path}.tmp', manifest_path)
+
+
+def _list_local_files(local_dir: str) -> set[str]:
+    """Return paths of all files in the directory relative to the directory."""
+    return {
+        os.path.relpath(os.path.join(root, file), local_dir)
+        for root, _, files in os.walk(local_dir)
+        for file in files
+    }
+
+
+def _read_manifest(bucket: storage.Bucket, manifest_name: str = MANIFEST_NAME) -> dict[str, Any] | None:
+    """Return the published manifest or None if the bucket has never been published to with `upload`."""
+    blob = bucket.get_blob(manifest_name)
+    if blob is None:
+        return None
+    return json.loads(blob.download_as_bytes())
+
+
+def _list_remote_objects(bucket: storage.Bucket) -> tuple[dict[str, dict[str, Any]], dict[str, Any] | None]:
+    """Return GCS object name, generation and MD5 hash of each object keyed by the local path it is synced to.
+
+    Published buckets are read through their manifest, so that all objects come from one consistent version. Other
+    buckets, such as the bucket with resume files, are listed as they are.
+
+    Returns:
+        Objects keyed by local path and the bundle with all of them, if the version was published with one.
+    """
+    manifest = _read_manifest(bucket)
+    if manifest is not None:
+        logger.debug(f'Following manifest of version {manifest["version"]} in GCS bucket {bucket.name}.')
+        return manifest['objects'], manifest.get('bundle')
+    return {
+        blob.name: {'name': blob.name, 'generation': blob.generation, 'md5': blob.md5_hash}
+        for blob in bucket.list_blobs()
+        if not blob.name.endswith('/')
+    }, None
+
+
+def _is_unchanged(local_path: str, remote: dict[str, Any], local: dict[str, Any] | None) -> bool:
+    """Return True if the local file is the same as the GCS object, comparing hashes only if the manifest is stale."""
+    if not os.path.isfile(local_path):
+        return False
+    if local == remote:
+        return True
+    return file_md5(local_path) == remote['md5']
+
+
+def _download_object(bucket: storage.Bucket, remote: dict[str, Any], local_file_path: str) -> None:
+    """Download exactly the generation of the object listed in the manifest."""
+    os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
+    bucket.blob(remote['name'], generation=remote['generation']).download_to_filename(local_file_path)
+    logger.debug(f'Downloaded {remote["name"]} to {local_file_path}')
+
+
+def _link_or_copy(src: str, dst: str) -> None:
+    """Carry over an unchanged file into the new directory without copying the data if possible."""
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class _HashingReader:
+    """File-like wrapper that computes SHA-256 of everything read from the stream."""
+
+    def __init__(self, stream: IO[bytes]) -> None:
+        self._stream = stream
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._stream.read(size)
+        self.sha256.update(data)
+        return data
+
+
+def _extract_bundle(bucket: storage.Bucket, bundle: dict[str, Any], local_dir: str) -> None:
+    """Download the bundle with one streaming request and unpack it into the directory while it downloads."""
+    blob = bucket.blob(bundle['name'], generation=bundle['generation'])
+    with blob.open('rb', chunk_size=BUNDLE_CHUNK_SIZE) as stream:
+        reader = _HashingReader(stream)
+        with tarfile.open(fileobj=reader, mode='r|gz') as tar:  # type: ignore
+            tar.extractall(local_dir, filter='data')
+        # Read the end of the archive that tar does not need, so that the checksum covers the whole object
+        while reader.read(BUNDLE_CHUNK_SIZE):
+            pass
+    if reader.sha256.hexdigest() != bundle['sha256']:
+        raise ValueError(f'Checksum of {bundle["name"]} does not match the manifest')
+    logger.info(f'Extracted {bundle["name"]} ({bundle["size"]} bytes) into {local_dir}.')
+
+
+def _swap_dir(new_dir: str, local_dir: str) -> None:
+    """Replace the local directory with the new one using two renames, so that readers never see a partial directory.
+
+    The swap is not atomic: between the renames `local_dir` does not exist for a moment. Readers that open files while
+    the directory is replaced must retry or, like the engine registries, only read it from the thread that downloads it.
+    """
+    old_dir = None
+    if os.path.exists(local_dir):
+        old_dir = tempfile.mkdtemp(prefix=f'.{os.path.basename(local_dir)}-old-', dir=os.path.dirname(local_dir) or '.')
+        os.rename(local_dir, os.path.join(old_dir, 'dir'))
+    os.rename(new_dir, local_dir)
+    if old_dir is not None:
+        shutil.rmtree(old_dir, ignore_errors=True)
+
 
 @log_params
+@metrics.STAGE_SECONDS.time('gcs_fetch')
 def download(bucket_name: str, local_dir: str) -> None:
-    """Download files from GCS."""
-    logger.debug(f'Current dir: {os.getcwd()}')
-    # Make sure the local temp directory is empty before we do anything
-    if os.path.exists(local_dir):
-        shutil.rmtree(local_dir)
-    os.makedirs(local_dir)
+    """Sync local directory with GCS bucket, downloading only new and changed objects and deleting removed ones.
 
-    # Download all blobs from the bucket
+    The updated directory is assembled next to the current one, with unchanged files hard linked and changed files
+    downloaded in parallel, and then renamed into place, so a failed sync leaves the current directory untouched.
+    The directory is missing for a moment while it is renamed into place, see `_swap_dir`.
+    If there is no local copy yet and the version has a bundle, it is downloaded and unpacked in one request instead.
+    """
+    local_dir = os.path.normpath(local_dir)
     storage_client = storage.Client()
     bucket = storage_client.bucket(bucket_name)
-    blobs = bucket.list_blobs()
-    for blob in blobs:
-        local_file_path: str = f'{local_dir}/{blob.name}'
-        local_dir_path = os.path.dirname(local_file_path)
-        if not os.path.exists(local_dir_path):
-            os.makedirs(local_dir_path)
-        if not os.path.exists(local_file_path):
-            blob.download_to_filename(local_file_path)
-            logger.debug(f'Downloaded {blob.name} to {local_file_path}')
+    remote_objects, bundle = _list_remote_objects(bucket)
+    local_manifest = _read_local_manifest(local_dir)
+    local_files = _list_local_files(local_dir) if os.path.isdir(local_dir) else set()
+
+    changed = [path for path, remote in remote_objects.items()
+               if path not in local_files
+               or not _is_unchanged(os.path.join(local_dir, path), remote, local_manifest.get(path))]
+    removed = local_files - remote_objects.keys()
+    if os.path.isdir(local_dir) and not changed and not removed:
+        logger.info(f'Local dir {local_dir} is up to date with GCS bucket {bucket_name}.')
+        _write_local_manifest(local_dir, remote_objects)
+        return
+
+    parent_dir = os.path.dirname(local_dir) or '.'
+    os.makedirs(parent_dir, exist_ok=True)
+    new_dir = tempfile.mkdtemp(prefix=f'.{os.path.basename(local_dir)}-new-', dir=parent_dir)
+    try:
+        if bundle is not None and not local_files:
+            try:
+                _extract_bundle(bucket, bundle, new_dir)
+                changed = []
+            except Exception as err:    # noqa: B902
+                logger.warning(f'Failed to extract {bundle["name"]}, will download files one by one: {err}')
+                shutil.rmtree(new_dir, ignore_errors=True)
+                os.makedirs(new_dir)
+        changed_paths = set(changed)
+        for path in remote_objects.keys() - changed_paths:
+            if not os.path.exists(os.path.join(new_dir, path)):
+                _link_or_copy(os.path.join(local_dir, path), os.path.join(new_dir, path))
+        with tracing.ContextThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS,
+                                               thread_name_prefix='gcs-download') as executor:
+            # Consume the results to raise the first download error, if any
+            list(executor.map(lambda path: _download_object(bucket, remote_objects[path], os.path.join(new_dir, path)),
+                              changed))
+        _swap_dir(new_dir=new_dir, local_dir=local_dir)
+    except BaseException:
+        shutil.rmtree(new_dir, ignore_errors=True)
+        raise
+    _write_local_manifest(local_dir, remote_objects)
+    logger.info(f'Synced {local_dir} with GCS bucket {bucket_name}: downloaded [{len(changed)}], '
+                f'kept [{len(remote_objects) - len(changed)}], removed [{len(removed)}] files.')
+
+
+@log_params
+def list_blob_names(bucket_name: str) -> list[str]:
+    """List names of all objects in the GCS bucket without downloading them."""
+    storage_client = storage.Client()
+    return [blob.name for blob in storage_client.list_blobs(bucket_name)]
+
+
+@log_params
+def list_blob_hashes(bucket_name: str) -> dict[str, str]:
+    """Return base64 encoded MD5 hashes of all objects in the GCS bucket keyed by object name."""
+    storage_client = storage.Client()
+    return {blob.name: blob.md5_hash for blob in storage_client.list_blobs(bucket_name)}
+
+
+def file_md5(file_path: str) -> str:
+    """Return base64 encoded MD5 hash of the local file in the same format as GCS uses for `Blob.md5_hash`."""
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            md5.update(block)
+    return base64.b64encode(md5.digest()).decode('utf-8')
+
+
+@log_params
+@metrics.STAGE_SECONDS.time('gcs_fetch')
+def download_blob(bucket_name: str, blob_name: str, local_file_path: str) -> None:
+    """Download a single object from GCS into the local file."""
+    local_dir_path = os.path.dirname(local_file_path)
+    if local_dir_path and not os.path.exists(local_dir_path):
+        os.makedirs(local_dir_path)
+    storage_client = storage.Client()
+    storage_client.bucket(bucket_name).blob(blob_name).download_to_filename(local_file_path)
+    logger.debug(f'Downloaded {blob_name} to {local_file_path}')
+
+
+@log_params
+def blob_exists(bucket_name: str, blob_name: str) -> bool:
+    """Return True if the object exists in the GCS bucket."""
+    storage_client = storage.Client()
+    return storage_client.bucket(bucket_name).get_blob(blob_name) is not None
 
 
 @log_params
@@ -56,28 +293,229 @@ def delete_all_objects(bucket_name: str):
         blob.delete()
 
 
+def _get_version_manifest_name(version: str) -> str:
+    return f'{VERSIONS_PREFIX}{version}.json'
+
+
+def _upload_object(bucket: storage.Bucket, local_file_path: str, blob_name: str) -> dict[str, Any]:
+    """Upload the file and return the manifest entry of the new object."""
+    blob = bucket.blob(blob_name)
+    blob.upload_from_filename(local_file_path)
+    logger.debug(f'File {local_file_path} uploaded to {blob_name}.')
+    return {'name': blob.name, 'generation': blob.generation, 'md5': blob.md5_hash}
+
+
+def _new_version() -> str:
+    """Return version name that sorts in the order of creation."""
+    return datetime.now(tz=constants.TIMEZONE).strftime('%Y%m%d-%H%M%S-%f')
+
+
+def _upload_files(bucket: storage.Bucket, local_dir: str, paths: list[str], version: str) -> dict[str, dict[str, Any]]:
+    """Upload files in parallel under the version prefix and return their manifest entries keyed by path."""
+    with tracing.ContextThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix='gcs-upload') as executor:
+        entries = list(executor.map(
+            lambda path: _upload_object(bucket, os.path.join(local_dir, path), f'{VERSIONS_PREFIX}{version}/{path}'),
+            paths))
+    return dict(zip(paths, entries))
+
+
+def _publish_manifest(bucket: storage.Bucket, manifest: dict[str, Any], if_generation_match: int | None = None) -> int:
+    """Save the manifest of the version and then flip the current manifest to it, which is a single object write.
+
+    Returns:
+        Generation of the current manifest object.
+
+    Raises:
+        google.api_core.exceptions.PreconditionFailed if the current manifest is not of the expected generation.
+    """
+    data = json.dumps(manifest)
+    bucket.blob(_get_version_manifest_name(manifest['version'])).upload_from_string(data,
+                                                                                    content_type='application/json')
+    blob = bucket.blob(MANIFEST_NAME)
+    blob.cache_control = 'no-store'
+    blob.upload_from_string(data, content_type='application/json', if_generation_match=if_generation_match)
+    logger.info(f'Published version {manifest["version"]} with [{len(manifest["objects"])}] files '
+                f'to GCS bucket {bucket.name}.')
+    return blob.generation
+
+
+def _create_bundle(local_dir: str, paths: list[str], bundle_path: str) -> str:
+    """Pack the files into a gzip compressed tar archive and return its SHA-256 checksum."""
+    with tarfile.open(bundle_path, 'w:gz') as tar:
+        for path in paths:
+            tar.add(os.path.join(local_dir, path), arcname=path)
+    sha256 = hashlib.sha256()
+    with open(bundle_path, 'rb') as file:
+        for block in iter(lambda: file.read(BUNDLE_CHUNK_SIZE), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def _upload_bundle(bucket: storage.Bucket, local_dir: str, paths: list[str], blob_name: str) -> dict[str, Any]:
+    """Create the bundle in a temporary file, upload it and return its manifest entry."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bundle_path = os.path.join(tmp_dir, BUNDLE_NAME)
+        sha256 = _create_bundle(local_dir=local_dir, paths=paths, bundle_path=bundle_path)
+        entry = _upload_object(bucket, bundle_path, blob_name)
+        entry.update({'sha256': sha256, 'size': os.path.getsize(bundle_path)})
+        return entry
+
+
 @log_params
-def upload(bucket_name: str, local_dir: str) -> None:
-    """Upload local files to GCS."""
-    logger.debug('Removing files from GCS embeddings bucket...')
-    delete_all_objects(bucket_name=bucket_name)
-    logger.debug('Loading fresh index files into GCS embeddings bucket...')
-    # TODO - debug - Print contents of the 'local_dir' directory
-    logger.debug(f'---------------------------- Current dir: {os.getcwd()}')
-    logger.debug(f'Local dir: {local_dir}')
-    for root, _, files in os.walk(local_dir):
-        for file in files:
-            logger.debug(os.path.join(root, file))
-    # End debug
+def upload(bucket_name: str, local_dir: str, bundle: bool = False) -> str:
+    """Publish local files to GCS as a new version and return the version.
+
+    Files are uploaded in parallel under a new version prefix, then the manifest is switched to the new version.
+    Readers that follow the manifest (see `download`) see either the old or the new version, but never a mix of both
+    or an empty bucket. Versions that were replaced more than `VERSION_GRACE_PERIOD` ago are deleted afterwards.
 
+    Args:
+        bucket_name: GCS bucket to publish to.
+        local_dir: Directory with the files to publish.
+        bundle: Also publish all files in a single compressed archive, so that new instances with no local copy
+            download them with one request (see `download`).
+    """
+    local_dir = os.path.normpath(local_dir)
+    version = _new_version()
     storage_client = storage.Client()
     bucket = storage_client.bucket(bucket_name)
-    count: int = 0
-    for root, _, files in os.walk(local_dir):
-        for file in files:
-            local_file_path = os.path.join(root, file)
-            blob = bucket.blob(local_file_path.replace(f'{local_dir}/', ''))
-            blob.upload_from_filename(local_file_path)
-            logger.debug(f'File {local_file_path} uploaded to {local_file_path.replace(local_dir,"")}.')
-            count += 1
-    logger.info(f'Uploaded [{count}] files to GCS bucket {bucket_name}.')
+    paths = sorted(_list_local_files(local_dir))
+    with tracing.ContextThreadPoolExecutor(max_workers=1, thread_name_prefix='gcs-bundle') as executor:
+        # Compress and upload the bundle while the individual files are uploaded
+        bundle_entry = executor.submit(_upload_bundle, bucket, local_dir, paths,
+                                       f'{VERSIONS_PREFIX}{version}/{BUNDLE_NAME}') if bundle else None
+        objects = _upload_files(bucket=bucket, local_dir=local_dir, paths=paths, version=version)
+    manifest: dict[str, Any] = {
+        'version': version,
+        'created': datetime.now(tz=constants.TIMEZONE).isoformat(),
+        'objects': objects,
+    }
+    if bundle_entry is not None:
+        manifest['bundle'] = bundle_entry.result()
+    _publish_manifest(bucket, manifest)
+    delete_old_versions(bucket_name=bucket_name)
+    return version
+
+
+@log_params
+def is_published(bucket_name: str) -> bool:
+    """Return True if the bucket has a manifest, i.e. it has been published to with `upload`."""
+    storage_client = storage.Client()
+    return storage_client.bucket(bucket_name).get_blob(MANIFEST_NAME) is not None
+
+
+def _add_bundle(bucket: storage.Bucket, local_dir: str, manifest: dict[str, Any], generation: int) -> None:
+    """Bundle the local copy of the published version and add the bundle to its manifest, if the copy matches it.
+
+    The copy may not match if another publisher has added its fragments to the version. The manifest is only updated
+    if it is still of the given generation, so a newer version published in the meantime is never replaced.
+    """
+    paths = sorted(manifest['objects'].keys())
+    if _list_local_files(local_dir) != set(paths) or any(
+            file_md5(os.path.join(local_dir, path)) != manifest['objects'][path]['md5'] for path in paths):
+        logger.warning(f'Local dir {local_dir} does not match version {manifest["version"]}, skipping its bundle.')
+        return
+    manifest['bundle'] = _upload_bundle(bucket, local_dir, paths,
+                                        f'{VERSIONS_PREFIX}{manifest["version"]}/{BUNDLE_NAME}')
+    try:
+        _publish_manifest(bucket, manifest, if_generation_match=generation)
+    except exceptions.PreconditionFailed:
+        logger.info(f'Version {manifest["version"]} was replaced while it was bundled, skipping its bundle.')
+
+
+@log_params
+def publish_fragment(bucket_name: str, local_dir: str, sub_dirs: list[str], bundle: bool = False) -> str:
+    """Publish a new version that only replaces the files under `sub_dirs` of the current version, and return it.
+
+    Only the files of the fragments are uploaded, the rest of the new version refers to the objects of the current
+    version. If a fragment directory does not exist locally, its files are removed from the new version. The bundle
+    of the current version, if any, no longer matches and is not carried over.
+    The manifest is updated with a generation precondition, so concurrent fragment publishes never overwrite each
+    other.
+
+    Args:
+        bucket_name: GCS bucket to publish to.
+        local_dir: Directory with the fragments to publish.
+        sub_dirs: Fragment directories relative to `local_dir`.
+        bundle: Publish the version first, then bundle the local directory and add the bundle to the version. Only use
+            if `local_dir` is a full copy of the published files, so that new instances keep downloading one archive.
+
+    Raises:
+        ValueError if the bucket has not been published with `upload` yet, so there is no version to start from.
+    """
+    local_dir = os.path.normpath(local_dir)
+    prefixes = tuple(f'{sub_dir.strip("/")}/' for sub_dir in sub_dirs)
+    version = _new_version()
+    storage_client = storage.Client()
+    bucket = storage_client.bucket(bucket_name)
+    paths = sorted(f'{prefix}{path}' for prefix in prefixes if os.path.isdir(os.path.join(local_dir, prefix))
+                   for path in _list_local_files(os.path.join(local_dir, prefix)))
+    fragment = _upload_files(bucket=bucket, local_dir=local_dir, paths=paths, version=version)
+
+    for attempt in range(1, PUBLISH_ATTEMPTS + 1):
+        blob = bucket.get_blob(MANIFEST_NAME)
+        if blob is None:
+            raise ValueError(f'GCS bucket {bucket_name} has no published version to add fragments {sub_dirs} to')
+        current = json.loads(blob.download_as_bytes())
+        objects = {path: entry for path, entry in current['objects'].items() if not path.startswith(prefixes)}
+        objects.update(fragment)
+        manifest: dict[str, Any] = {
+            'version': version,
+            'created': datetime.now(tz=constants.TIMEZONE).isoformat(),
+            'base_version': current['version'],
+            'objects': objects,
+        }
+        try:
+            generation = _publish_manifest(bucket, manifest, if_generation_match=blob.generation)
+            break
+        except exceptions.PreconditionFailed:
+            if attempt == PUBLISH_ATTEMPTS:
+                raise
+            logger.warning(f'Manifest of GCS bucket {bucket_name} changed while publishing {sub_dirs}, retrying...')
+    if bundle:
+        _add_bundle(bucket=bucket, local_dir=local_dir, manifest=manifest, generation=generation)
+    delete_old_versions(bucket_name=bucket_name)
+    return version
+
+
+@log_params
+def delete_old_versions(bucket_name: str, grace_period: int = VERSION_GRACE_PERIOD) -> int:
+    """Delete objects that are not used by the current version nor by versions replaced within the grace period.
+
+    Objects created within the grace period are never deleted, because they may belong to an upload in progress.
+    Objects from before the bucket was first published with `upload` are deleted too.
+
+    Returns:
+        Number of deleted objects.
+    """
+    storage_client = storage.Client()
+    bucket = storage_client.bucket(bucket_name)
+    blobs = list(bucket.list_blobs())
+    current = _read_manifest(bucket)
+    if current is None:
+        return 0
+
+    now = datetime.now(tz=constants.TIMEZONE)
+    manifests = sorted((json.loads(blob.download_as_bytes()) for blob in blobs
+                        if blob.name.startswith(VERSIONS_PREFIX) and blob.name.endswith('.json')
+                        and '/' not in blob.name[len(VERSIONS_PREFIX):]),
+                       key=lambda manifest: manifest['version'])
+    live = [current]
+    for manifest, replaced_by in zip(manifests, manifests[1:]):
+        if now - datetime.fromisoformat(replaced_by['created']) < timedelta(seconds=grace_period):
+            live.append(manifest)
+    keep = {MANIFEST_NAME}
+    for manifest in live:
+        keep.add(_get_version_manifest_name(manifest['version']))
+        keep.update(entry['name'] for entry in manifest['objects'].values())
+        if 'bundle' in manifest:
+            keep.add(manifest['bundle']['name'])
+
+    deleted: int = 0
+    for blob in blobs:
+        if blob.name in keep or now - blob.time_created < timedelta(seconds=grace_period):
+            continue
+        blob.delete()
+        deleted += 1
+    logger.info(f'Deleted [{deleted}] objects of old versions from GCS bucket {bucket_name}.')
+    return deleted
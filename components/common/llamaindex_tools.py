@@ -13,18 +13,22 @@
 # limitations under the License.
 
 import glob
+import json
 import os
+import shutil
 import threading
-from datetime import datetime
+import time
 from pathlib import Path
-from typing import Any, List
+from typing import Any, Dict, List, NamedTuple, Optional
 
-from common import admin_dao, constants, gcs_tools, solution
-from common.cache import cache
+from common import admin_dao, constants, gcs_tools, metrics, solution
+from common.engine_registry import EngineRegistry, EngineSnapshot
 from common.log import Logger, log, log_params
 from langchain.llms.openai import OpenAIChat
 from llama_index import (Document, GPTSimpleKeywordTableIndex, GPTVectorStoreIndex, LLMPredictor, ServiceContext,
                          SimpleDirectoryReader, StorageContext, load_index_from_storage)
+from llama_index.callbacks import CallbackManager, CBEventType
+from llama_index.callbacks.base_handler import BaseCallbackHandler
 from llama_index.indices.composability import ComposableGraph
 from llama_index.indices.query.base import BaseQueryEngine
 from llama_index.indices.query.query_transform.base import DecomposeQueryTransform
@@ -41,15 +45,9 @@ logger.info('Initializing...')
 DATA_LOAD_LOCK = threading.Lock()
 """Block many concurrent data loads at once."""
 
-LLAMA_FILE_LOCK = threading.Lock()
-"""Lock to prevent concurrent updates of the same index - needed in case we have more than one request processing."""
-
 INDEX_BUCKET: str = solution.getenv('EMBEDDINGS_BUCKET_NAME')
 """Location to download llama-index embeddings from."""
 
-LAST_LOCAL_INDEX_UPDATE: datetime | None = None
-"""Keep track of the most recent local index update to avoid unnecessary refreshes."""
-
 if solution.LOCAL_DEVELOPMENT_MODE:
     LLAMA_INDEX_DIR: str = 'dev/tmp/llamaindex-embeddings'
 else:
@@ -58,6 +56,9 @@ else:
 LOCAL_DEV_DATA_DIR: str = 'dev/tmp'
 """Location of the local data directory for development on local machine."""
 
+SOURCE_FILE_NAME: str = 'source.json'
+"""File in the embeddings directory of each person with the name and MD5 hash of the resume they were generated from."""
+
 
 @log
 def _get_llm(provider: constants.LlmProvider) -> LLMPredictor:
@@ -69,6 +70,12 @@ def _get_llm(provider: constants.LlmProvider) -> LLMPredictor:
     return llm
 
 
+def get_person_name(resume_file: str) -> str:
+    """Derive the person name from the resume file name: '<person_name>.pdf' optionally with 'resume' suffix."""
+    return os.path.basename(resume_file).replace('.pdf', '').replace(
+        'Resume', '').replace('resume', '').replace('_', ' ').strip()
+
+
 @log_params
 def load_resumes(resume_dir: str | None) -> dict[str, List[Document]]:
     """Initialize list of resumes from index storage or from the directory with PDF source files."""
@@ -103,8 +110,7 @@ def load_resumes(resume_dir: str | None) -> dict[str, List[Document]]:
         if len(pdf_files):
             # Each resume shall be named as '<person_name>.pdf' optionally with 'resume' suffix
             for resume in pdf_files:
-                person_name = os.path.basename(resume).replace('.pdf', '').replace(
-                    'Resume', '').replace('resume', '').replace('_', ' ').strip()
+                person_name = get_person_name(resume)
                 logger.debug(f'Loading: {person_name}')
                 resume_content = SimpleDirectoryReader(input_files=[resume]).load_data()
                 resumes[person_name] = resume_content
@@ -175,11 +181,93 @@ def generate_embeddings(resume_dir: str, provider: constants.LlmProvider) -> Non
     _load_resume_indices(resumes=resumes, service_context=context, embeddings_dir=LLAMA_INDEX_DIR)
 
 
+@log
+def update_person_embeddings(resume_name: str, resume_hash: str, pages: List[Document],
+                             provider: constants.LlmProvider) -> str:
+    """Regenerate embeddings of a single resume from its parsed pages in the local index directory.
+
+    Args:
+        resume_name: Name of the resume PDF file.
+        resume_hash: MD5 hash of the resume file, recorded next to the embeddings (see `get_indexed_resumes`).
+        pages: Text of the resume pages.
+        provider: LLM provider to generate embeddings with.
+
+    Returns:
+        Name of the person whose embeddings were regenerated.
+    """
+    person_name = get_person_name(resume_name)
+    delete_person_embeddings(person_name=person_name)
+    predictor = _get_llm(provider=provider)
+    context = ServiceContext.from_defaults(llm_predictor=predictor, chunk_size_limit=constants.CHUNK_SIZE)
+    _load_resume_indices(resumes={person_name: pages}, service_context=context, embeddings_dir=LLAMA_INDEX_DIR)
+    source_file = Path(LLAMA_INDEX_DIR) / person_name / SOURCE_FILE_NAME
+    source_file.write_text(json.dumps({'resume': resume_name, 'resume_hash': resume_hash}))
+    return person_name
+
+
+@log
+def get_indexed_resumes() -> dict[str, str]:
+    """Return MD5 hashes of the resumes in the local index directory keyed by resume file name.
+
+    Embeddings generated before the hashes were recorded are keyed by the person name and have an empty hash.
+    """
+    indexed: dict[str, str] = {}
+    for person_dir in Path(LLAMA_INDEX_DIR).glob('*'):
+        if not person_dir.is_dir():
+            continue
+        source_file = person_dir / SOURCE_FILE_NAME
+        if source_file.exists():
+            source = json.loads(source_file.read_text())
+            indexed[source['resume']] = source['resume_hash']
+        else:
+            indexed[person_dir.name] = ''
+    return indexed
+
+
+@log_params
+def delete_person_embeddings(person_name: str) -> None:
+    """Remove embeddings of the person from the local index directory."""
+    person_dir = Path(LLAMA_INDEX_DIR) / person_name
+    if person_dir.exists():
+        shutil.rmtree(person_dir)
+
+
+class _StageTimer(BaseCallbackHandler):
+    """Record retrieval and LLM events of llama-index queries in the stage duration histogram."""
+
+    STAGES = {CBEventType.RETRIEVE: 'retrieval', CBEventType.LLM: 'llm'}
+    """Stage label of each timed event type."""
+
+    def __init__(self) -> None:
+        ignored = [event_type for event_type in CBEventType if event_type not in self.STAGES]
+        super().__init__(event_starts_to_ignore=ignored, event_ends_to_ignore=ignored)
+        self._starts: dict[str, float] = {}
+        """Start time of each event in progress by event id."""
+
+    def on_event_start(self, event_type: CBEventType, payload: Optional[Dict[str, Any]] = None, event_id: str = '',
+                       **kwargs: Any) -> str:
+        self._starts[event_id] = time.perf_counter()
+        return event_id
+
+    def on_event_end(self, event_type: CBEventType, payload: Optional[Dict[str, Any]] = None, event_id: str = '',
+                     **kwargs: Any) -> None:
+        start = self._starts.pop(event_id, None)
+        if start is not None:
+            metrics.STAGE_SECONDS.observe(time.perf_counter() - start, self.STAGES[event_type])
+
+    def start_trace(self, trace_id: Optional[str] = None) -> None:
+        pass
+
+    def end_trace(self, trace_id: Optional[str] = None, trace_map: Optional[Dict[str, List[str]]] = None) -> None:
+        pass
+
+
 @log_params
 def _get_resume_query_engine(provider: constants.LlmProvider, resume_dir: str | None = None) -> BaseQueryEngine | None:
     """Load the index from disk, or build it if it doesn't exist."""
     llm = _get_llm(provider=provider)
-    service_context = ServiceContext.from_defaults(llm_predictor=llm, chunk_size_limit=constants.CHUNK_SIZE)
+    service_context = ServiceContext.from_defaults(llm_predictor=llm, chunk_size_limit=constants.CHUNK_SIZE,
+                                                   callback_manager=CallbackManager([_StageTimer()]))
 
     resumes: dict[str, List[Document]] = load_resumes(resume_dir=resume_dir)
     logger.debug('-------------------------- resumes: %s', resumes.keys())
@@ -253,40 +341,45 @@ def _get_resume_query_engine(provider: constants.LlmProvider, resume_dir: str |
     # return router_query_engine
 
 
-@cache
-@log
-def _refresh_llama_index() -> None:
-    """Refresh the index of resumes from the database using Llama-Index."""
-    global LAST_LOCAL_INDEX_UPDATE
+class LlamaIndexEngine(NamedTuple):
+    """Query engine together with the names of people whose resumes it was built from."""
+    query_engine: BaseQueryEngine | None
+    """Query engine or None if there are no resumes in the index."""
+    people: list[str]
+    """Names of people in the index, listed once per index version so that requests never touch the file system."""
+
 
+@log
+def _create_query_engine() -> LlamaIndexEngine:
+    """Make sure the local index files are up to date and build the query engine from them."""
     if solution.LOCAL_DEVELOPMENT_MODE:
         logger.info('Running in local development mode')
         index_path = Path(LLAMA_INDEX_DIR)
         if not index_path.exists():
             # TODO - need to generate proper embeddings for each provider, not hard coded
             generate_embeddings(resume_dir=LOCAL_DEV_DATA_DIR, provider=constants.LlmProvider.OPEN_AI)
-        return
-
-    global LLAMA_FILE_LOCK
-    last_resume_refresh = admin_dao.AdminDAO().get_resumes_timestamp()
-    if LAST_LOCAL_INDEX_UPDATE is None or LAST_LOCAL_INDEX_UPDATE < last_resume_refresh:
+    else:
         logger.info('Refreshing local index of resumes...')
-        # Prevent concurrent updates of the same index - needed in case we have more than one request processing
-        with LLAMA_FILE_LOCK:
-            # Check for condition again because the index may have been updated while we were waiting for the lock
-            if LAST_LOCAL_INDEX_UPDATE is None or LAST_LOCAL_INDEX_UPDATE < last_resume_refresh:
-                gcs_tools.download(bucket_name=INDEX_BUCKET, local_dir=LLAMA_INDEX_DIR)
-        return last_resume_refresh
+        gcs_tools.download(bucket_name=INDEX_BUCKET, local_dir=LLAMA_INDEX_DIR)
+    query_engine = _get_resume_query_engine(provider=constants.LlmProvider.OPEN_AI)
+    people = sorted(load_resumes(resume_dir='').keys())
+    return LlamaIndexEngine(query_engine=query_engine, people=people)
+
 
-    logger.info('Skipping refresh of resumes index because no changes in source resumes were detected.')
-    LAST_LOCAL_INDEX_UPDATE = last_resume_refresh
+ENGINE_REGISTRY = EngineRegistry(name='llamaindex', builder=_create_query_engine)
+"""Versioned Llama-Index query engine snapshots. Replaced in the background when resumes are updated."""
+
+
+@log
+def _refresh_llama_index() -> EngineSnapshot:
+    """Return current query engine snapshot and start refresh in the background if the resumes have been updated."""
+    return ENGINE_REGISTRY.get(version=admin_dao.get_resumes_version())
 
 
 @log
 def query(question: str) -> str:
     """Run LLM query for CHatGPT."""
-    _refresh_llama_index()
-    query_engine = _get_resume_query_engine(provider=constants.LlmProvider.OPEN_AI)
+    query_engine = _refresh_llama_index().engine.query_engine
     if query_engine is None:
         raise SystemError('No resumes found in the database. Please upload resumes.')
 
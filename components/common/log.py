@@ -23,26 +23,224 @@ Typical usage:
         def function_x():
             logger.debug('Blah blah %s, %s, %s', x, y, z)
 
+Records are queued without blocking and written to stdout by a background thread, as text or, with `LOG_FORMAT=json`,
+as structured records for Cloud Logging. Debug records are rate limited per call site, so `LOG_LEVEL=DEBUG` can be
+turned on in production without flooding the logs or slowing down requests.
 """
+import atexit
 import functools
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import reprlib
 import sys
+from datetime import datetime, timezone
+from typing import Any
+
+from common import metrics, tracing
 
 _LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
 
+_LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+"""Output format: `text` for reading in a terminal, or `json` for one structured record per line for Cloud Logging."""
+
+_MAX_FIELD_LENGTH = int(os.environ.get('LOG_MAX_FIELD_LENGTH', '4000'))
+"""Truncate the message, and the stack trace, of a log record to this many characters."""
+
+_DEBUG_RATE_LIMIT = float(os.environ.get('LOG_DEBUG_RATE_LIMIT', '10'))
+"""Maximum number of debug records per second from one call site, or 0 for no limit."""
+
+_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+"""Maximum number of records waiting to be written. Records logged while the queue is full are dropped."""
+
+_PROJECT_ID = os.environ.get('PROJECT_ID')
+"""GCP project of the Cloud Trace traces that JSON records are linked to."""
+
+LOG_RECORDS_DROPPED = metrics.Counter('log_records_dropped_total',
+                                      'Log records dropped by the debug rate limit or because the log queue was full.',
+                                      labelnames=('reason',))
+
+
+def _truncate(value: str, keep_end: bool = False) -> str:
+    """Shorten the value to `_MAX_FIELD_LENGTH` characters, keeping its beginning or, for stack traces, its end."""
+    if len(value) <= _MAX_FIELD_LENGTH:
+        return value
+    note = f'...[{len(value) - _MAX_FIELD_LENGTH} characters truncated]...'
+    return note + value[-_MAX_FIELD_LENGTH:] if keep_end else value[:_MAX_FIELD_LENGTH] + note
+
+
+class _RateLimitFilter(logging.Filter):
+    """Drop debug records from call sites that log more than `_DEBUG_RATE_LIMIT` records per second.
+
+    Every call site, i.e. line of code or function decorated with `@log`, gets a token bucket that holds up to one
+    second worth of records. The number of dropped records is reported with the next record from the same call site.
+    Buckets are updated without a lock: concurrent callers may let a few extra records through, which is cheaper.
+    """
+
+    def __init__(self, rate: float) -> None:
+        super().__init__()
+        self._rate = rate
+        self._buckets: dict[Any, list[float]] = {}
+        """Available tokens, time of the last update and number of dropped records, keyed by call site."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG or self._rate <= 0:
+            return True
+        call_site = getattr(record, 'call_site', None) or (record.pathname, record.lineno)
+        bucket = self._buckets.get(call_site)
+        if bucket is None:
+            bucket = self._buckets[call_site] = [self._rate, record.created, 0]
+        bucket[0] = min(self._rate, bucket[0] + (record.created - bucket[1]) * self._rate)
+        bucket[1] = record.created
+        if bucket[0] < 1:
+            bucket[2] += 1
+            LOG_RECORDS_DROPPED.inc('rate_limit')
+            return False
+        bucket[0] -= 1
+        record.suppressed = int(bucket[2])
+        bucket[2] = 0
+        return True
+
+
+class _RequestContextFilter(logging.Filter):
+    """Add `trace_id` and `user_id` of the current request to log records, and `context` to prefix the message with.
+
+    The `context` attribute is empty outside of a request, so that log formats can use it unconditionally.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = tracing.get_trace_id()
+        record.user_id = tracing.get_user_id()
+        record.context = f'[{record.trace_id}] ' if record.trace_id else ''
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Hand records over to the writer thread without blocking and without formatting them on the calling thread.
+
+    Arguments of the message are rendered by the writer thread, so objects changed right after the call may be logged
+    with their new values.
+    """
+
+    def handle(self, record: logging.LogRecord) -> bool:
+        # The queue is thread safe, so skip the handler lock that would make all logging threads wait for each other
+        accepted = self.filter(record)
+        if accepted:
+            self.emit(record)
+        return accepted
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc('queue_full')
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    """Writer thread that waits for queued records to be written when stopped, even if the queue is full."""
+
+    def enqueue_sentinel(self) -> None:
+        self.queue.put(self._sentinel)
+
+
+_FORMATTERS: dict[str, logging.Formatter] = {}
+"""Text formatter of every logger set up by `setup_logger()`, keyed by logger name."""
+
+
+class _TextFormatter(logging.Formatter):
+    """Format records in the format given to `setup_logger()` for the logger that created them."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        record.msg = _truncate(record.getMessage())
+        record.args = None
+        text = _FORMATTERS.get(record.name, _DEFAULT_FORMATTER).format(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        return f'{text} [{suppressed} similar records suppressed]' if suppressed else text
+
+
+class _JsonFormatter(logging.Formatter):
+    """Format records as one line of JSON with the fields recognized by Cloud Logging.
+
+    See https://cloud.google.com/logging/docs/structured-logging for the special fields.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = _truncate(record.getMessage())
+        if record.exc_info:
+            # Error Reporting picks up stack traces at the end of the message
+            message = f'{message}\n{_truncate(self.formatException(record.exc_info), keep_end=True)}'
+        entry: dict[str, Any] = {
+            'severity': record.levelname,
+            'message': message,
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'logger': record.name,
+            'logging.googleapis.com/sourceLocation': {
+                'file': record.pathname,
+                'line': str(record.lineno),
+                'function': record.funcName,
+            },
+        }
+        trace_id = getattr(record, 'trace_id', None)
+        if trace_id:
+            entry['trace_id'] = trace_id
+            if _PROJECT_ID:
+                entry['logging.googleapis.com/trace'] = f'projects/{_PROJECT_ID}/traces/{trace_id}'
+        if user_id := getattr(record, 'user_id', None):
+            entry['user_id'] = user_id
+        if suppressed := getattr(record, 'suppressed', 0):
+            entry['suppressed_records'] = suppressed
+        return json.dumps(entry, default=str)
+
+
+_DEFAULT_FORMATTER = logging.Formatter('%(message)s')
+
+_stdout_handler = logging.StreamHandler(sys.stdout)
+_stdout_handler.setFormatter(_JsonFormatter() if _LOG_FORMAT == 'json' else _TextFormatter())
+
+_queue: queue.Queue = queue.Queue(maxsize=_QUEUE_SIZE)
+_QUEUE_HANDLER = _QueueHandler(_queue)
+"""Handler shared by all loggers, which writes records to stdout from a background thread."""
+_QUEUE_HANDLER.setLevel(_LOG_LEVEL)
+# Rate limit first, so that dropped records do not pay for looking up the request context
+_QUEUE_HANDLER.addFilter(_RateLimitFilter(_DEBUG_RATE_LIMIT))
+_QUEUE_HANDLER.addFilter(_RequestContextFilter())
+
+_listener = _QueueListener(_queue, _stdout_handler)
+_listener.start()
+atexit.register(lambda: _listener.stop())
+
+
+def _restart_listener() -> None:
+    """Start a writer thread with a new queue in a forked child process, which inherits neither the thread nor a usable
+    queue: the lock of the parent's queue may have been held by another thread at the time of the fork."""
+    global _queue, _listener
+    _queue = queue.Queue(maxsize=_QUEUE_SIZE)
+    _QUEUE_HANDLER.queue = _queue
+    _listener = _QueueListener(_queue, _stdout_handler)
+    _listener.start()
+
+
+os.register_at_fork(after_in_child=_restart_listener)
+
 
 def setup_logger(log_format: str = '%(message)s', log_name: str = 'undefined_log_name') -> logging.Logger:
-    """Initialize logging settings for the caller and return `logger` that can be used as `logger.info('message')`."""
+    """Initialize logging settings for the caller and return `logger` that can be used as `logger.info('message')`.
+
+    Records are written to stdout in the given format, or as JSON if `LOG_FORMAT=json`, by a background thread. Calling
+    it again for the same name returns the same logger without adding another handler.
+    """
     logger = logging.getLogger(log_name)
     logger.setLevel(_LOG_LEVEL)
     logger.propagate = False
     # See log levels, formatting, etc. in the docs: https://docs.python.org/3/library/logging.html
-    formatter = logging.Formatter(log_format)
-    stdout_handler = logging.StreamHandler(sys.stdout)
-    stdout_handler.setLevel(_LOG_LEVEL)
-    stdout_handler.setFormatter(formatter)
-    logger.addHandler(stdout_handler)
+    _FORMATTERS[log_name] = logging.Formatter(log_format)
+    if _QUEUE_HANDLER not in logger.handlers:
+        logger.addHandler(_QUEUE_HANDLER)
     return logger
 
 
@@ -50,7 +248,7 @@ class Logger:
     """Logger class for using inside of method body, such as `log.debug()`."""
 
     def __init__(self, log_name: str = 'my_log') -> None:
-        log_format = '%(levelname)s:%(filename)s:%(funcName)s(%(lineno)d): %(message)s'
+        log_format = '%(levelname)s:%(context)s%(filename)s:%(funcName)s(%(lineno)d): %(message)s'
         log_name_f = f'{log_name}_f'
         self.function_body_logger = setup_logger(log_format, log_name_f)
 
@@ -59,39 +257,78 @@ class Logger:
         return self.function_body_logger
 
 
-_DECORATOR_LOGGER = setup_logger('%(levelname)s: %(message)s', __name__)
+_DECORATOR_LOGGER = setup_logger('%(levelname)s: %(context)s%(message)s', __name__)
+
+
+_REPR = reprlib.Repr()
+"""Render parameters and results of decorated functions with size limits, so that large objects do not flood logs."""
+_REPR.maxstring = 200
+_REPR.maxother = 200
+_REPR.maxlist = _REPR.maxtuple = _REPR.maxset = _REPR.maxdict = 10
+_REPR.maxlevel = 3
+
+
+class _LazySignature:
+    """Arguments of a call, rendered only if the log record is emitted."""
+    __slots__ = ('args', 'kwargs')
+
+    def __init__(self, args: tuple, kwargs: dict) -> None:
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self) -> str:
+        args_repr = [_REPR.repr(a) for a in self.args]
+        kwargs_repr = [f'{k}={_REPR.repr(v)}' for k, v in self.kwargs.items()]
+        return ', '.join(args_repr + kwargs_repr)
+
+
+class _LazyRepr:
+    """Value rendered only if the log record is emitted."""
+    __slots__ = ('value',)
+
+    def __init__(self, value: Any) -> None:
+        self.value = value
+
+    def __str__(self) -> str:
+        return _REPR.repr(self.value)
 
 
 def _log(func, log_params: bool):
-    """Log entry and exit from functions.
+    """Log entry and exit from functions and record their timing in the current trace (see `tracing`).
+
+    When neither debug logging nor a trace is active, the only overhead is one context variable lookup.
 
     Args:
         log_params: True if you want to print log input and output to the annotated function.
     """
+    fname = '.'.join([func.__module__, func.__qualname__])
+    # Rate limit debug records of each decorated function separately, rather than by the line in this module
+    call_site = {'call_site': fname}
 
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
-
-        def get_signature():
-            args_repr = [repr(a) for a in args]
-            kwargs_repr = [f'{k}={v!r}' for k, v in kwargs.items()]
-            return ', '.join(args_repr + kwargs_repr)
-
-        fname = '.'.join([func.__module__, func.__qualname__])
-        if log_params:
-            _DECORATOR_LOGGER.debug('in--> %s -> %s', fname, get_signature())
-        else:
-            _DECORATOR_LOGGER.debug('in--> %s ->', fname)
-        try:
-            result = func(*args, **kwargs)
+        span = tracing.start_span(fname)
+        debug = _DECORATOR_LOGGER.isEnabledFor(logging.DEBUG)
+        if debug:
             if log_params:
-                _DECORATOR_LOGGER.debug('<-out %s <- %s', fname, result)
+                _DECORATOR_LOGGER.debug('in--> %s -> %s', fname, _LazySignature(args, kwargs), extra=call_site)
             else:
-                _DECORATOR_LOGGER.debug('<-out %s <-', fname)
-            return result
+                _DECORATOR_LOGGER.debug('in--> %s ->', fname, extra=call_site)
+        try:
+            result = func(*args, **kwargs)
         except Exception as err:    # noqa: B902
-            _DECORATOR_LOGGER.exception('Function %s(%s) threw exception: %s', fname, get_signature(), err)
+            if span is not None:
+                tracing.end_span(span, error=err)
+            _DECORATOR_LOGGER.exception('Function %s(%s) threw exception: %s', fname, _LazySignature(args, kwargs), err)
             raise err
+        if span is not None:
+            tracing.end_span(span)
+        if debug:
+            if log_params:
+                _DECORATOR_LOGGER.debug('<-out %s <- %s', fname, _LazyRepr(result), extra=call_site)
+            else:
+                _DECORATOR_LOGGER.debug('<-out %s <-', fname, extra=call_site)
+        return result
 
     return wrapper
 
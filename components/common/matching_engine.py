@@ -17,6 +17,7 @@
 
 from __future__ import annotations
 
+import hashlib
 import json
 import time
 import uuid
@@ -26,6 +27,7 @@ import google.auth
 import google.auth.transport.requests
 import requests
 from common.log import Logger, log
+from google.api_core import exceptions
 from google.cloud import aiplatform, aiplatform_v1, storage  # noqa: F401
 from google.cloud.aiplatform import MatchingEngineIndex, MatchingEngineIndexEndpoint
 from google.oauth2 import service_account  # noqa: F401
@@ -43,6 +45,16 @@ ME_DIMENSIONS: int = 768
 """Vertex PaLM Embedding has maximum 768 dimensions."""""
 EMBEDDING_NUM_BATCH: int = 5
 """Number of documents to embed in a batch."""
+ME_INGESTED_RESUMES: str = 'ingestion/resumes.json'
+"""Object in the Matching Engine bucket with the hash and number of chunks of each ingested resume."""
+
+
+def make_datapoint_id(document_name: str, chunk: int) -> str:
+    """Return the datapoint id of the chunk, which is the same every time the document is ingested.
+
+    Re-ingesting a document then replaces its datapoints instead of adding duplicates.
+    """
+    return f'{hashlib.sha1(document_name.encode()).hexdigest()[:16]}-{chunk}'
 
 
 @log
@@ -137,6 +149,7 @@ class MatchingEngine(VectorStore):
         self,
         texts: Iterable[str],
         metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
         **kwargs: Any,
     ) -> List[str]:
         """Run more texts through the embeddings and add to the vectorstore.
@@ -144,22 +157,24 @@ class MatchingEngine(VectorStore):
         Args:
             texts: Iterable of strings to add to the vectorstore.
             metadatas: Optional list of metadatas associated with the texts.
+            ids: Optional list of datapoint ids (see `make_datapoint_id`). Datapoints with existing ids are replaced.
+            If not provided, random ids are generated.
             kwargs: vectorstore specific parameters.
 
         Returns:
             List of ids from adding the texts into the vectorstore.
         """
+        texts = list(texts)
+        if ids is None:
+            ids = [str(uuid.uuid4()) for _ in texts]
         logger.debug('Embedding documents.')
-        embeddings = self.embedding.embed_documents(list(texts))
+        embeddings = self.embedding.embed_documents(texts)
         insert_datapoints_payload = []
-        ids = []
 
         # Streaming index update
-        for idx, (embedding, text, metadata) in enumerate(
-            zip(embeddings, texts, metadatas)  # type: ignore
+        for idx, (embedding, text, metadata, id) in enumerate(
+            zip(embeddings, texts, metadatas, ids)  # type: ignore
         ):
-            id = uuid.uuid4()
-            ids.append(id)
             self._upload_to_gcs(text, f'documents/{id}')
             metadatas[idx]  # type: ignore
             insert_datapoints_payload.append(
@@ -183,7 +198,31 @@ class MatchingEngine(VectorStore):
             _ = self.index_client.upsert_datapoints(request=upsert_request)
 
         logger.info(f'Indexed {len(ids)} documents to Matching Engine.')
-        return ids  # type: ignore
+        return ids
+
+    @log
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        """Remove datapoints from the index and their documents from GCS.
+
+        Args:
+            ids: List of datapoint ids to remove. Ids that are not in the index are ignored.
+            kwargs: vectorstore specific parameters.
+
+        Returns:
+            True if any datapoints were removed.
+        """
+        if not ids:
+            return False
+        remove_request = aiplatform_v1.RemoveDatapointsRequest(index=self.index.name, datapoint_ids=ids)
+        self.index_client.remove_datapoints(request=remove_request)
+        bucket = self.gcs_client.get_bucket(self.gcs_bucket_name)
+        for id in ids:
+            try:
+                bucket.blob(f'documents/{id}').delete()
+            except exceptions.NotFound:
+                pass
+        logger.info(f'Removed {len(ids)} documents from Matching Engine.')
+        return True
 
     @log
     def _upload_to_gcs(self, data: str, gcs_location: str) -> None:
@@ -203,17 +242,31 @@ class MatchingEngine(VectorStore):
         embeddings: List[str],
         n_matches: int,
         index_endpoint: MatchingEngineIndexEndpoint,
+        filters: Optional[List[dict]] = None,
+        query_filters: Optional[List[Optional[List[dict]]]] = None,
     ) -> str:
-        """Get matches from matching engine given a vector query using public endpoint."""
+        """Get matches from matching engine given a vector query using public endpoint.
+
+        Args:
+            filters: Optional namespace restricts in the same format as the `metadatas` passed to `add_texts`, e.g.
+            [{'namespace': 'document_name', 'allow_list': ['John Doe.pdf']}]. Only datapoints that match all of the
+            restricts are considered by the index.
+            query_filters: Optional restricts for each of the embeddings, overriding `filters` for that query.
+        """
+        datapoints = [{'datapoint_id': f'{i}', 'feature_vector': emb} for i, emb in enumerate(embeddings)]
+        for i, datapoint in enumerate(datapoints):
+            restricts = query_filters[i] if query_filters is not None and query_filters[i] is not None else filters
+            if restricts:
+                datapoint['restricts'] = restricts
         request_data = {
             'deployed_index_id': index_endpoint.deployed_indexes[0].id,
             'return_full_datapoint': True,
             'queries': [
                 {
-                    'datapoint': {'datapoint_id': f'{i}', 'feature_vector': emb},
+                    'datapoint': datapoint,
                     'neighbor_count': n_matches,
                 }
-                for i, emb in enumerate(embeddings)
+                for datapoint in datapoints
             ],
         }
 
@@ -230,7 +283,12 @@ class MatchingEngine(VectorStore):
 
     @log
     def similarity_search(
-        self, query: str, k: int = 4, search_distance: float = 0.65, **kwargs: Any
+        self,
+        query: str,
+        k: int = 4,
+        search_distance: float = 0.65,
+        filters: Optional[List[dict]] = None,
+        **kwargs: Any,
     ) -> List[Document]:
         """Return docs most similar to query.
 
@@ -238,40 +296,65 @@ class MatchingEngine(VectorStore):
             query: The string that will be used to search for similar documents.
             k: The amount of neighbors that will be retrieved.
             search_distance: filter search results by  search distance by adding a threshold value
+            filters: Optional namespace restricts to limit the search to a subset of the index (see `get_matches`).
 
         Returns:
             A list of k matching documents.
         """
 
-        logger.debug(f'Embedding query {query}.')
-        embedding_query = self.embedding.embed_documents([query])
-        # deployed_index_id = self._get_index_id()
-        # logger.debug(f'Deployed Index ID = {deployed_index_id}')
+        return self.similarity_search_batch([query], k=k, search_distance=search_distance, filters=[filters])[0]
+
+    @log
+    def similarity_search_batch(
+        self,
+        queries: List[str],
+        k: int = 4,
+        search_distance: float = 0.65,
+        filters: Optional[List[Optional[List[dict]]]] = None,
+    ) -> List[List[Document]]:
+        """Return docs most similar to each of the queries, embedding all of them together and with one index call.
+
+        Args:
+            queries: The strings that will be used to search for similar documents.
+            k: The amount of neighbors that will be retrieved for each query.
+            search_distance: filter search results by  search distance by adding a threshold value
+            filters: Optional namespace restricts for each of the queries (see `get_matches`).
+
+        Returns:
+            A list of k matching documents for each of the queries, in the same order as the queries.
+        """
+        if not queries:
+            return []
+
+        logger.debug(f'Embedding {len(queries)} queries.')
+        embedding_queries = self.embedding.embed_documents(queries)
 
         # TO-DO: Pending query sdk integration
         # response = self.endpoint.match(
         #     deployed_index_id=self._get_index_id(),
-        #     queries=embedding_query,
+        #     queries=embedding_queries,
         #     num_neighbors=k,
         # )
 
-        response = self.get_matches(embedding_query, k, self.endpoint)
+        response = self.get_matches(embedding_queries, k, self.endpoint, query_filters=filters)
 
         if response.status_code == 200:
-            response = response.json()['nearestNeighbors']
+            response = response.json().get('nearestNeighbors', [])
         else:
             raise Exception(f'Failed to query index {str(response)}')
 
-        if len(response) == 0:
-            return []
-
-        logger.debug(f'Found {len(response)} matches for the query {query}.')
+        # Each result carries the `datapoint_id` of its query, which is the position of the query in the request
+        neighbors_by_query = {
+            int(result.get('id', i)): result.get('neighbors', []) for i, result in enumerate(response)
+        }
+        logger.debug(f'Found matches for {len(neighbors_by_query)} of {len(queries)} queries.')
+        return [self._get_documents(neighbors_by_query.get(i, []), search_distance) for i in range(len(queries))]
 
+    @log
+    def _get_documents(self, neighbors: List[dict], search_distance: float) -> List[Document]:
+        """Download documents of the neighbors found by the index that are within the search distance."""
         results = []
-
-        # Only getting the first one because queries receives an array and the similarity_search method only receives
-        # one query. This means that the match method will always return an array with only one element.
-        for doc in response[0]['neighbors']:
+        for doc in neighbors:
             page_content = self._download_from_gcs(
                 f'documents/{doc["datapoint"]["datapointId"]}'
             )
@@ -0,0 +1,280 @@
+# Copyright 2023 Qarik Group, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Counters, gauges and histograms exposed in the Prometheus text format for scraping.
+
+Typical usage:
+    Define metrics once at module level and update them on the request path:
+
+        ANSWERS = metrics.Counter('answers_total', 'Answers by backend.', labelnames=('backend',))
+
+        ANSWERS.inc('gpt')
+        with metrics.STAGE_SECONDS.time('llm'):
+            answer = llm(question)
+
+    Serve `metrics.REGISTRY.expose()` with `metrics.CONTENT_TYPE` from the `/metrics` endpoint.
+
+Every thread updates its own shard of each metric, so the request path never takes a lock. Shards are summed when
+the metrics are scraped, and shards of threads that have ended are folded into a base total. Values computed on
+demand, such as queue depths, are exposed with `CallbackGauge`.
+"""
+
+import bisect
+import contextlib
+import math
+import threading
+import time
+import weakref
+from typing import Any, Callable, Iterator
+
+CONTENT_TYPE: str = 'text/plain; version=0.0.4; charset=utf-8'
+"""Content type of the Prometheus text exposition format."""
+
+DEFAULT_BUCKETS: tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+"""Upper bounds of histogram buckets in seconds, from cached lookups to slow LLM calls."""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str, quotes: bool = True) -> str:
+    """Escape a label value, or a help text, which keeps quotes as they are."""
+    value = value.replace('\\', r'\\').replace('\n', r'\n')
+    return value.replace('"', r'\"') if quotes else value
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)) + '}'
+
+
+class Registry:
+    """Collection of metrics served together."""
+
+    def __init__(self) -> None:
+        self._metrics: dict[str, '_Metric'] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: '_Metric') -> None:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'Metric {metric.name} is already registered.')
+            self._metrics[metric.name] = metric
+
+    def expose(self) -> str:
+        """Return all metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines: list[str] = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {_escape(metric.help, quotes=False)}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+"""Default registry that all metrics are added to."""
+
+
+class _Metric:
+    """Metric with one value (or histogram) per combination of label values, kept in per-thread shards."""
+    type: str = 'untyped'
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = (), registry: Registry = REGISTRY) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._local = threading.local()
+        self._shards: list[tuple[weakref.ref[threading.Thread], dict[tuple[str, ...], Any]]] = []
+        """Shards of threads that have updated the metric, with a weak reference to the thread."""
+        self._base: dict[tuple[str, ...], Any] = {}
+        """Values of threads that have ended."""
+        self._shards_lock = threading.Lock()
+        registry.register(self)
+
+    def _shard(self) -> dict[tuple[str, ...], Any]:
+        """Return the shard of the calling thread, creating it on the first update from the thread."""
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard: dict[tuple[str, ...], Any] = {}
+            with self._shards_lock:
+                self._fold_ended_threads()
+                self._shards.append((weakref.ref(threading.current_thread()), shard))
+            self._local.shard = shard
+            return shard
+
+    def _fold_ended_threads(self) -> None:
+        """Merge shards of threads that have ended into the base total. Must be called with the lock held."""
+        live = []
+        for thread_ref, shard in self._shards:
+            thread = thread_ref()
+            if thread is not None and thread.is_alive():
+                live.append((thread_ref, shard))
+            else:
+                for labels, value in shard.items():
+                    self._base[labels] = self._add(self._base.get(labels), value)
+        self._shards = live
+
+    def _snapshots(self) -> list[dict[tuple[str, ...], Any]]:
+        """Return copies of the base total and all shards. Copying a dict is atomic, so concurrent updates are never
+        half seen."""
+        with self._shards_lock:
+            self._fold_ended_threads()
+            return [dict(self._base)] + [dict(shard) for _, shard in self._shards]
+
+    @staticmethod
+    def _add(total: Any, value: Any) -> Any:
+        """Return the sum of two values of the metric, where the total may be None."""
+        raise NotImplementedError
+
+    def collect(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Value that only goes up, such as the number of requests."""
+    type = 'counter'
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    @staticmethod
+    def _add(total: float | None, value: float) -> float:
+        return value if total is None else total + value
+
+    def collect(self) -> list[str]:
+        totals: dict[tuple[str, ...], float] = {}
+        for snapshot in self._snapshots():
+            for labels, value in snapshot.items():
+                totals[labels] = totals.get(labels, 0) + value
+        if not totals and not self.labelnames:
+            totals[()] = 0
+        return [f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}'
+                for labels, value in sorted(totals.items())]
+
+
+class Gauge(Counter):
+    """Value that goes up and down, such as the number of requests in flight.
+
+    Increments and decrements from different threads add up correctly, since shards are summed.
+    """
+    type = 'gauge'
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+    @contextlib.contextmanager
+    def track(self, *labels: str) -> Iterator[None]:
+        """Increment the gauge for the duration of the block."""
+        self.inc(*labels)
+        try:
+            yield
+        finally:
+            self.dec(*labels)
+
+
+class CallbackGauge(_Metric):
+    """Gauge whose values are computed by a function when the metrics are scraped."""
+    type = 'gauge'
+
+    def __init__(self, name: str, help: str, callback: Callable[[], dict[tuple[str, ...], float | None]],
+                 labelnames: tuple[str, ...] = (), registry: Registry = REGISTRY) -> None:
+        """Initialize the gauge.
+
+        Args:
+            callback: Function that returns values keyed by tuples of label values. None values are not exposed.
+        """
+        super().__init__(name=name, help=help, labelnames=labelnames, registry=registry)
+        self._callback = callback
+
+    def collect(self) -> list[str]:
+        return [f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}'
+                for labels, value in sorted(self._callback().items()) if value is not None]
+
+
+class CallbackCounter(CallbackGauge):
+    """Counter whose values are kept elsewhere, e.g. in the statistics of a component, and read when scraped."""
+    type = 'counter'
+
+
+class Histogram(_Metric):
+    """Distribution of values, such as request latency, counted in buckets."""
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS, registry: Registry = REGISTRY) -> None:
+        super().__init__(name=name, help=help, labelnames=labelnames, registry=registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels: str) -> None:
+        shard = self._shard()
+        counts = shard.get(labels)
+        if counts is None:
+            # One count per bucket, one for values above the last bucket and the sum of values
+            counts = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    @staticmethod
+    def _add(total: list[float] | None, value: list[float]) -> list[float]:
+        return list(value) if total is None else [a + b for a, b in zip(total, value)]
+
+    @contextlib.contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        """Observe the duration of the block in seconds, including blocks that raise an exception."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def collect(self) -> list[str]:
+        totals: dict[tuple[str, ...], list[float]] = {}
+        for snapshot in self._snapshots():
+            for labels, counts in snapshot.items():
+                counts = list(counts)
+                total = totals.get(labels)
+                totals[labels] = counts if total is None else [a + b for a, b in zip(total, counts)]
+        lines: list[str] = []
+        for labels, counts in sorted(totals.items()):
+            cumulative = 0.0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                bucket_labels = _format_labels(self.labelnames + ('le',), labels + (_format_value(bound),))
+                lines.append(f'{self.name}_bucket{bucket_labels} {_format_value(cumulative)}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(counts[-1])}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, labels)} {_format_value(cumulative)}')
+        return lines
+
+
+HTTP_REQUESTS = Counter('http_requests_total', 'HTTP requests by method, route and status code.',
+                        labelnames=('method', 'handler', 'status'))
+HTTP_REQUEST_SECONDS = Histogram('http_request_duration_seconds', 'Time to send the full HTTP response.',
+                                 labelnames=('method', 'handler'))
+HTTP_IN_FLIGHT = Gauge('http_requests_in_flight', 'HTTP requests currently being processed.')
+STAGE_SECONDS = Histogram('stage_duration_seconds',
+                          'Time spent in processing stages: refresh, retrieval, gcs_fetch, llm, firestore_write, '
+                          'rebuild.',
+                          labelnames=('stage',))
+CACHE_LOOKUPS = Counter('cache_lookups_total', 'Lookups of in-process caches.', labelnames=('cache',))
+CACHE_MISSES = Counter('cache_misses_total', 'Lookups of in-process caches that computed the value.',
+                       labelnames=('cache',))
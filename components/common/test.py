@@ -12,10 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import threading
 import unittest
 
-from common import solution
-from common.admin_dao import AdminDAO
+from common import metrics, solution
+from common.admin_dao import AdminDAO, ResumesVersionWatcher
 from common.log import Logger, log
 
 logger = Logger(__name__).get_logger()
@@ -49,5 +50,70 @@ class TestAdmin(unittest.TestCase):
         assert current_time == admin.get_resumes_timestamp()
 
 
+class TestResumesVersionWatcher(unittest.TestCase):
+
+    @log
+    def test_watch_resumes_version(self) -> None:
+        """Test that resume update is pushed to the watcher without polling."""
+        admin: AdminDAO = AdminDAO()
+        watcher = ResumesVersionWatcher(admin_dao=admin)
+        current_time = solution.now()
+        updated = threading.Event()
+        watcher.add_listener(lambda version: updated.set() if version == current_time else None)
+        watcher.start()
+        try:
+            admin.touch_resumes(timestamp=current_time)
+            assert updated.wait(timeout=10)
+            assert watcher.is_watching()
+            assert current_time == watcher.get_version()
+        finally:
+            watcher.stop()
+        assert not watcher.is_watching()
+
+
+class TestMetrics(unittest.TestCase):
+
+    @log
+    def test_histogram_buckets(self) -> None:
+        """Test that histogram buckets are cumulative, include their upper bound and end with `+Inf`."""
+        registry = metrics.Registry()
+        histogram = metrics.Histogram('test_seconds', 'Test "latency".', labelnames=('stage',), buckets=(1, 0.5),
+                                      registry=registry)
+        for value in (0.25, 0.5, 1, 3):
+            histogram.observe(value, 'llm')
+        assert registry.expose().splitlines() == [
+            '# HELP test_seconds Test "latency".',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{stage="llm",le="0.5"} 2',
+            'test_seconds_bucket{stage="llm",le="1"} 3',
+            'test_seconds_bucket{stage="llm",le="+Inf"} 4',
+            'test_seconds_sum{stage="llm"} 4.75',
+            'test_seconds_count{stage="llm"} 4',
+        ]
+
+    @log
+    def test_shards_of_ended_threads(self) -> None:
+        """Test that updates from threads that have ended are kept in the totals and their shards are released."""
+        registry = metrics.Registry()
+        counter = metrics.Counter('test_total', 'Test counter.', labelnames=('backend',), registry=registry)
+        histogram = metrics.Histogram('test_seconds', 'Test histogram.', buckets=(1,), registry=registry)
+
+        def update() -> None:
+            counter.inc('gpt')
+            histogram.observe(2)
+
+        for _ in range(20):
+            thread = threading.Thread(target=update)
+            thread.start()
+            thread.join()
+        counter.inc('gpt', amount=2)
+        exposed = registry.expose()
+        assert 'test_total{backend="gpt"} 22\n' in exposed
+        assert 'test_seconds_bucket{le="+Inf"} 20\n' in exposed
+        assert 'test_seconds_sum 40\n' in exposed
+        assert len(counter._shards) == 1
+        assert len(histogram._shards) == 0
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,268 @@
+# Copyright 2023 Qarik Group, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Per-request trace trees with wall and CPU time of every function decorated with `@log` or `@log_params`.
+
+Typical usage:
+    Start a trace for a request (done for every sampled HTTP request by `api_tools.ServiceAPI`):
+
+        with tracing.trace('GET /ask_gpt') as root:
+            answer = llamaindex_tools.query(question)
+        print(root.format())
+
+    Decorated functions called while the trace is active, in the same context, record child spans. Outside of a trace
+    `start_span()` returns None right away, so the decorators cost one context variable lookup when tracing is off.
+
+    Every request, traced or not, runs in a `request_context()` with a trace id that is added to all log records. Use
+    `ContextThreadPoolExecutor` for fan-out within a request and `detached()` for background work it starts, so that
+    their logs and spans carry the trace id of the request too.
+"""
+
+import collections
+import contextlib
+import contextvars
+import functools
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Iterator, Mapping
+
+TRACE_SAMPLE_RATE: float = float(os.environ.get('TRACE_SAMPLE_RATE', '0'))
+"""Fraction of requests to trace, from 0 (tracing disabled) to 1 (every request)."""
+
+TRACE_LOG_THRESHOLD: float = float(os.environ.get('TRACE_LOG_THRESHOLD', '1'))
+"""Log and keep the trace of a request that took at least this many seconds."""
+
+MAX_SPANS_PER_TRACE: int = 1000
+"""Stop recording spans of a trace after this many, so that loops over many items do not grow the tree unbounded."""
+
+RECENT_TRACES_KEPT: int = 50
+"""Number of most recent slow traces to keep for `recent_traces()`."""
+
+MAX_TRACE_ID_LENGTH: int = 64
+"""Longest trace id accepted from a request header. Longer ids are replaced by a generated one."""
+
+
+class Trace:
+    """Spans recorded for one request."""
+    __slots__ = ('trace_id', 'user_id', 'root', 'span_count', 'dropped')
+
+    def __init__(self) -> None:
+        self.trace_id: str | None = _trace_id.get()
+        self.user_id: str | None = _user_id.get()
+        self.root: Span | None = None
+        self.span_count: int = 0
+        self.dropped: int = 0
+        """Number of spans that were not recorded because of `MAX_SPANS_PER_TRACE`."""
+
+
+class Span:
+    """Timing of one function call within a trace."""
+    __slots__ = ('name', 'trace', 'children', 'error', 'start', 'wall', 'cpu', '_cpu_start', '_token')
+
+    def __init__(self, name: str, trace: Trace) -> None:
+        self.name = name
+        self.trace = trace
+        self.children: list[Span] = []
+        self.error: str | None = None
+        self.start = time.perf_counter()
+        self.wall: float | None = None
+        """Seconds from start to finish, or None if the span has not finished yet."""
+        self.cpu: float | None = None
+        """CPU seconds of the calling thread from start to finish, excluding time spent waiting for I/O and locks."""
+        self._cpu_start = time.thread_time()
+        self._token: contextvars.Token | None = None
+
+    def finish(self, error: BaseException | None = None) -> None:
+        self.wall = time.perf_counter() - self.start
+        self.cpu = time.thread_time() - self._cpu_start
+        if error is not None:
+            self.error = f'{type(error).__name__}: {error}'
+
+    def to_dict(self, trace_start: float | None = None) -> dict[str, Any]:
+        """Return the span and its children as a JSON serializable dictionary with times in milliseconds."""
+        if trace_start is None:
+            trace_start = self.start
+        return {
+            'name': self.name,
+            'start_ms': round((self.start - trace_start) * 1000, 3),
+            'wall_ms': round(self.wall * 1000, 3) if self.wall is not None else None,
+            'cpu_ms': round(self.cpu * 1000, 3) if self.cpu is not None else None,
+            'error': self.error,
+            'children': [child.to_dict(trace_start) for child in list(self.children)],
+        }
+
+    def format(self, indent: int = 0) -> str:
+        """Return the span and its children as an indented text tree, one span per line."""
+        wall = f'{self.wall * 1000:10.1f}' if self.wall is not None else '   running'
+        cpu = f'{self.cpu * 1000:10.1f}' if self.cpu is not None else '          '
+        line = f'{wall} ms wall {cpu} ms cpu  {"  " * indent}{self.name}'
+        if self.error:
+            line += f'  !! {self.error}'
+        return '\n'.join([line] + [child.format(indent + 1) for child in list(self.children)])
+
+
+_current_span: contextvars.ContextVar[Span | None] = contextvars.ContextVar('current_span', default=None)
+_trace_id: contextvars.ContextVar[str | None] = contextvars.ContextVar('trace_id', default=None)
+_user_id: contextvars.ContextVar[str | None] = contextvars.ContextVar('user_id', default=None)
+
+_VALID_TRACE_ID = re.compile(r'[A-Za-z0-9._-]+')
+
+_recent_traces: collections.deque[Span] = collections.deque(maxlen=RECENT_TRACES_KEPT)
+_recent_lock = threading.Lock()
+
+
+def new_trace_id() -> str:
+    """Return a random trace id in the format used by Cloud Trace (32 hex digits)."""
+    return uuid.uuid4().hex
+
+
+def trace_id_from_headers(headers: Mapping[str, str]) -> str | None:
+    """Return the trace id of the incoming request, or None if the headers (with lowercase names) have none.
+
+    Accepts `X-Cloud-Trace-Context: TRACE_ID/SPAN_ID;o=1` set by Google load balancers, W3C
+    `traceparent: 00-TRACE_ID-SPAN_ID-01` and `X-Request-Id`, in this order.
+    """
+    candidates = []
+    if cloud_trace := headers.get('x-cloud-trace-context'):
+        candidates.append(cloud_trace.split('/', 1)[0])
+    if traceparent := headers.get('traceparent'):
+        parts = traceparent.split('-')
+        if len(parts) >= 4:
+            candidates.append(parts[1])
+    if request_id := headers.get('x-request-id'):
+        candidates.append(request_id)
+    for candidate in candidates:
+        candidate = candidate.strip()
+        if len(candidate) <= MAX_TRACE_ID_LENGTH and _VALID_TRACE_ID.fullmatch(candidate):
+            return candidate
+    return None
+
+
+def get_trace_id() -> str | None:
+    """Return the trace id of the current request or background job, or None outside of `request_context()`."""
+    return _trace_id.get()
+
+
+def get_user_id() -> str | None:
+    """Return the id of the user that made the current request, if known."""
+    return _user_id.get()
+
+
+@contextlib.contextmanager
+def request_context(trace_id: str | None = None, user_id: str | None = None) -> Iterator[str]:
+    """Make the trace id, generated if not given, and the user id current for the block and yield the trace id."""
+    trace_id = trace_id or new_trace_id()
+    trace_token = _trace_id.set(trace_id)
+    user_token = _user_id.set(user_id)
+    try:
+        yield trace_id
+    finally:
+        _user_id.reset(user_token)
+        _trace_id.reset(trace_token)
+
+
+def detached(func: Callable) -> Callable:
+    """Return the function wrapped to run with the current trace and user ids, but outside of the current span.
+
+    Use for background work started by a request, e.g. the target of a thread, which starts with an empty context.
+    The work is logged with the trace id of the request, but does not add spans to a trace that may already be over.
+    """
+    trace_id, user_id = _trace_id.get(), _user_id.get()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with request_context(trace_id=trace_id, user_id=user_id):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    """Thread pool that runs every task in a copy of the context of the caller that submitted it.
+
+    Worker threads of a plain `ThreadPoolExecutor` keep their own context, so tasks would lose the trace id and the
+    current span of the request. `asyncio.to_thread()` copies the context already.
+    """
+
+    def submit(self, fn: Callable, /, *args, **kwargs) -> Future:
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def should_trace() -> bool:
+    """Return True if the next request should be traced, according to `TRACE_SAMPLE_RATE`."""
+    return TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE
+
+
+def current_span() -> Span | None:
+    """Return the innermost span of the current context, or None if no trace is active."""
+    return _current_span.get()
+
+
+@contextlib.contextmanager
+def trace(name: str) -> Iterator[Span]:
+    """Record a trace rooted at a span with the given name, e.g. the HTTP method and path of the request."""
+    span = Span(name=name, trace=Trace())
+    span.trace.root = span
+    token = _current_span.set(span)
+    try:
+        yield span
+        span.finish()
+    except BaseException as err:
+        span.finish(error=err)
+        raise
+    finally:
+        _current_span.reset(token)
+        if span.wall is not None and span.wall >= TRACE_LOG_THRESHOLD:
+            with _recent_lock:
+                _recent_traces.append(span)
+
+
+def start_span(name: str) -> Span | None:
+    """Start a child of the current span and make it current, or return None if no trace is active."""
+    parent = _current_span.get()
+    if parent is None:
+        return None
+    trace_ = parent.trace
+    if trace_.span_count >= MAX_SPANS_PER_TRACE:
+        trace_.dropped += 1
+        return None
+    trace_.span_count += 1
+    span = Span(name=name, trace=trace_)
+    parent.children.append(span)
+    span._token = _current_span.set(span)
+    return span
+
+
+def end_span(span: Span, error: BaseException | None = None) -> None:
+    """Finish the span started by `start_span()` and make its parent current again."""
+    span.finish(error=error)
+    if span._token is not None:
+        _current_span.reset(span._token)
+
+
+def recent_traces() -> list[dict[str, Any]]:
+    """Return the most recent traces that took longer than `TRACE_LOG_THRESHOLD`, newest first."""
+    with _recent_lock:
+        spans = list(reversed(_recent_traces))
+    return [{
+        'trace_id': span.trace.trace_id,
+        'user_id': span.trace.user_id,
+        **span.to_dict(),
+        'spans': span.trace.span_count,
+        'dropped_spans': span.trace.dropped,
+    } for span in spans]
@@ -13,15 +13,27 @@
 # limitations under the License.
 """Data Access Object to abstract access to the database from the rest of the app."""
 
+import queue
+import threading
+import time
 from typing import Any
 
-from common import firestore_tools, solution
+from common import firestore_tools, metrics, solution
 from common.log import Logger, log
 from google.cloud import firestore  # type: ignore
 from pydantic import BaseModel, Field
 
 logger = Logger(__name__).get_logger()
 
+INTERACTIONS_QUEUE_SIZE: int = int(solution.getenv('INTERACTIONS_QUEUE_SIZE', '1000'))
+"""Maximum number of pending interaction writes before the writes fall back to being synchronous."""
+
+INTERACTIONS_BATCH_SIZE: int = int(solution.getenv('INTERACTIONS_BATCH_SIZE', '100'))
+"""Maximum number of pending interaction writes to commit in one batch (Firestore allows 500 writes per batch)."""
+
+INTERACTIONS_FLUSH_INTERVAL: float = float(solution.getenv('INTERACTIONS_FLUSH_INTERVAL', '1.0'))
+"""Maximum number of seconds an interaction waits in the queue before it is written."""
+
 
 class VoteStatistic(BaseModel):
     """Input parameters for the vote endpoint."""
@@ -30,6 +42,16 @@ class VoteStatistic(BaseModel):
     down: int = Field(description='Number of downvotes for this LLM backend', example=-22, le=0)
 
 
+def create_interaction(question: Any, answer: Any, llm_backend: str) -> dict[str, Any]:
+    """Create a record of the user question and the LLM answer to be stored in the user document."""
+    return {
+        'answer': answer,
+        'llm': llm_backend,
+        'question': question,
+        'timestamp': solution.now()
+    }
+
+
 class BaseDao:
     """Generic object that handles database persistence."""
 
@@ -74,6 +96,7 @@ class VoteDao(BaseDao):
         return doc_ref
 
     @log
+    @metrics.STAGE_SECONDS.time('firestore_write')
     def submit_vote(self, llm: str, question: str, answer: str, upvoted: bool) -> Any:
         """Submit new vote."""
         doc_ref = self._get_doc_ref_by_llm(llm)
@@ -124,6 +147,8 @@ class UserDao(BaseDao):
         """Initialize the DAO with proper resources."""
         super().__init__(f'{solution.RESOURCE_PREFIX}_users')
         """Firestore collection that keeps track of users known to the system."""
+        self._known_users: set[str] = set()
+        """IDs of users whose documents are known to exist, so that we do not need to check it again."""
 
     def _get_doc_ref_by_id(self, user_id: str) -> firestore.DocumentReference | None:
         """Find device Firestore Doc Ref by its ID. Return None if does not exist."""
@@ -149,23 +174,46 @@ class UserDao(BaseDao):
 
     def save_question_answer(self, user_id: str, question: Any, answer: Any, llm_backend: str) -> Any:
         """Update user document."""
+        return self.save_interactions(user_id=user_id,
+                                      interactions=[create_interaction(question=question,
+                                                                       answer=answer,
+                                                                       llm_backend=llm_backend)])
+
+    @metrics.STAGE_SECONDS.time('firestore_write')
+    def save_interactions(self, user_id: str, interactions: list[dict[str, Any]]) -> Any:
+        """Append several interactions to the user document with a single write."""
         doc_ref = self._get_doc_ref_by_id(user_id)
         if doc_ref is None:
             doc_ref = self.create(user_id)
-        interaction: dict[str, Any] = {
-            'answer': answer,
-            'llm': llm_backend,
-            'question': question,
-            'timestamp': solution.now()
-        }
-        # Append new interaction to the list of existing interactions in the user document
-        data = {'interactions': firestore.ArrayUnion([interaction])}
+        self._known_users.add(user_id)
+        # Append new interactions to the list of existing interactions in the user document
+        data = {'interactions': firestore.ArrayUnion(interactions)}
         return doc_ref.set(data, merge=True)
 
+    @log
+    @metrics.STAGE_SECONDS.time('firestore_write')
+    def save_interactions_batch(self, interactions_by_user: dict[str, list[dict[str, Any]]]) -> None:
+        """Append interactions to documents of several users with one batch commit and at most one batch read."""
+        new_users = [user_id for user_id in interactions_by_user.keys() if user_id not in self._known_users]
+        if new_users:
+            for snapshot in self._db.get_all([self._collection.document(user_id) for user_id in new_users]):
+                if snapshot.exists:
+                    self._known_users.add(snapshot.id)
+
+        batch = self._db.batch()
+        for user_id, interactions in interactions_by_user.items():
+            data: dict[str, Any] = {'interactions': firestore.ArrayUnion(interactions)}
+            if user_id not in self._known_users:
+                data.update({'user_id': user_id, 'first_login': solution.now()})
+            batch.set(self._collection.document(user_id), data, merge=True)
+        batch.commit()
+        self._known_users.update(interactions_by_user.keys())
+
     @log
     def delete(self, user_id: str) -> Any:
         """Delete user document."""
         doc_ref = self._collection.document(user_id)
+        self._known_users.discard(user_id)
         if not doc_ref.get().exists:
             return None
         return doc_ref.delete()
@@ -178,3 +226,92 @@ class UserDao(BaseDao):
             users.append(doc.to_dict())
         logger.debug('Found %s users in the database', len(users))
         return users
+
+
+class InteractionWriter:
+    """Write-behind queue that saves user interactions in batches in the background, off the request path.
+
+    Interactions are committed when the batch is full or when the oldest one has waited for the flush interval.
+    If the queue is full, the interaction is written synchronously by the caller instead.
+    """
+
+    def __init__(self,
+                 user_dao: UserDao,
+                 max_queue_size: int = INTERACTIONS_QUEUE_SIZE,
+                 batch_size: int = INTERACTIONS_BATCH_SIZE,
+                 flush_interval: float = INTERACTIONS_FLUSH_INTERVAL) -> None:
+        """Initialize the queue and start the background writer thread."""
+        self._user_dao = user_dao
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._queue: queue.Queue[tuple[str, list[dict[str, Any]]] | None] = queue.Queue(maxsize=max_queue_size)
+        self._thread = threading.Thread(target=self._run, name='interaction-writer', daemon=True)
+        self._thread.start()
+
+    def save_interactions(self, user_id: str, interactions: list[dict[str, Any]]) -> None:
+        """Queue interactions to be appended to the user document."""
+        try:
+            self._queue.put_nowait((user_id, interactions))
+        except queue.Full:
+            logger.warning('Interaction queue is full, saving interactions of user %s synchronously.', user_id)
+            self._user_dao.save_interactions(user_id=user_id, interactions=interactions)
+
+    def queue_depth(self) -> int:
+        """Return the approximate number of interactions waiting to be written."""
+        return self._queue.qsize()
+
+    def close(self, timeout: float | None = None) -> None:
+        """Write all queued interactions and stop the background thread."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            logger.error('Interaction queue is still full after %s seconds, %s interactions are not saved.', timeout,
+                         self._queue.qsize())
+            return
+        self._thread.join(timeout=None if deadline is None else max(0, deadline - time.monotonic()))
+
+    def _run(self) -> None:
+        """Write batches of queued interactions until the queue is closed."""
+        closed = False
+        while not closed:
+            batch, closed = self._next_batch()
+            if batch:
+                self._write(batch)
+
+    def _next_batch(self) -> tuple[list[tuple[str, list[dict[str, Any]]]], bool]:
+        """Wait for the first item, then collect more until the batch is full or the flush interval expires.
+
+        Returns:
+            Collected items and True if the queue has been closed.
+        """
+        item = self._queue.get()
+        if item is None:
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + self._flush_interval
+        while len(batch) < self._batch_size:
+            try:
+                item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _write(self, batch: list[tuple[str, list[dict[str, Any]]]]) -> None:
+        """Commit interactions of all users in the batch, falling back to individual writes on error."""
+        interactions_by_user: dict[str, list[dict[str, Any]]] = {}
+        for user_id, interactions in batch:
+            interactions_by_user.setdefault(user_id, []).extend(interactions)
+        try:
+            self._user_dao.save_interactions_batch(interactions_by_user=interactions_by_user)
+            return
+        except Exception as err:    # noqa: B902
+            logger.error('Failed to save batch of %s interactions, retrying one user at a time: %s', len(batch), err)
+        for user_id, interactions in interactions_by_user.items():
+            try:
+                self._user_dao.save_interactions(user_id=user_id, interactions=interactions)
+            except Exception as err:    # noqa: B902
+                logger.error('Lost %s interactions of user %s: %s', len(interactions), user_id, err)
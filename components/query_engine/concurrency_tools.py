@@ -0,0 +1,269 @@
+# Copyright 2023 Qarik Group, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Utilities that control how concurrent requests share the LLM backends."""
+
+import asyncio
+import contextlib
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, AsyncIterator, Awaitable, Callable, Hashable, Iterator
+
+from common import metrics
+from common.log import Logger
+
+logger = Logger(__name__).get_logger()
+
+QUEUE_WAIT_SECONDS = metrics.Histogram('backend_queue_wait_seconds',
+                                       'Time admitted requests waited for a backend concurrency slot.',
+                                       labelnames=('backend',))
+
+
+class RequestCoalescer:
+    """Run only one computation for concurrent identical requests and share its result with all of them.
+
+    Typical usage:
+        coalescer = RequestCoalescer()
+        answer = coalescer.run(('gpt', question), llamaindex_tools.query, question)
+
+    The result is not cached: once the computation completes, the next request with the same key starts a new one.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._in_flight: dict[Hashable, Future] = {}
+        self.leaders: int = 0
+        """Number of requests that ran the computation."""
+        self.followers: int = 0
+        """Number of requests that reused the result of the computation started by another request."""
+
+    def run(self, key: Hashable, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Return result of `func(*args, **kwargs)`, waiting for the in-flight computation with the same key if any."""
+        future, is_leader = self._join(key)
+        if not is_leader:
+            logger.debug('Waiting for in-flight request: %s', key)
+            return future.result()
+
+        try:
+            result = func(*args, **kwargs)
+            future.set_result(result)
+            return result
+        except BaseException as err:
+            future.set_exception(err)
+            raise
+        finally:
+            self._leave(key)
+
+    async def run_async(self, key: Hashable, func: Callable[..., Awaitable[Any]], *args: Any, **kwargs: Any) -> Any:
+        """Same as `run()` for a coroutine function, waiting for the in-flight computation without holding a thread."""
+        future, is_leader = self._join(key)
+        if not is_leader:
+            logger.debug('Waiting for in-flight request: %s', key)
+            # Shield the shared future, so that a cancelled follower does not cancel the computation of the leader
+            return await asyncio.shield(asyncio.wrap_future(future))
+
+        try:
+            result = await func(*args, **kwargs)
+            future.set_result(result)
+            return result
+        except BaseException as err:
+            future.set_exception(err)
+            raise
+        finally:
+            self._leave(key)
+
+    def _join(self, key: Hashable) -> tuple[Future, bool]:
+        """Return the future of the in-flight computation and True if the caller has to run it."""
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.followers += 1
+                return future, False
+            future = self._in_flight[key] = Future()
+            self.leaders += 1
+            return future, True
+
+    def _leave(self, key: Hashable) -> None:
+        with self._lock:
+            del self._in_flight[key]
+
+
+class OverloadedError(RuntimeError):
+    """Request could not be admitted in time. Reported as 503 by `api_tools.ErrorHandler`."""
+
+
+class AdmissionController:
+    """Limit the number of concurrent requests to a backend, with a bounded queue of requests waiting for a slot.
+
+    Typical usage:
+        controller = AdmissionController(name='gpt', max_concurrency=4, max_queue=16, queue_timeout=10)
+        with controller.admit():
+            answer = llamaindex_tools.query(question)
+
+    Use `admit_async()` on the request path of the event loop: requests waiting for a slot then hold no threads, so a
+    burst on one backend can not fill the thread pool that all other endpoints share.
+
+    Requests that find the queue full, or that can not start within the queue timeout, are rejected with
+    `OverloadedError` right away, so that a burst degrades into fast failures instead of slowing everyone down.
+    """
+
+    def __init__(self, name: str, max_concurrency: int, max_queue: int, queue_timeout: float) -> None:
+        """Initialize the controller.
+
+        Args:
+            name: Name of the backend, used in error messages and statistics.
+            max_concurrency: Maximum number of requests running at the same time.
+            max_queue: Maximum number of requests waiting for a slot.
+            queue_timeout: Maximum number of seconds a request may wait for a slot.
+        """
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._async_waiters: list[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+        """Event loop and future of each request waiting in `admit_async`, woken up when a slot is released."""
+        self.waiting: int = 0
+        """Number of requests currently waiting in the queue."""
+        self.running: int = 0
+        """Number of requests currently running."""
+        self.admitted: int = 0
+        """Total number of admitted requests."""
+        self.rejected: int = 0
+        """Total number of rejected requests."""
+        self.total_wait: float = 0
+        """Total number of seconds admitted requests have waited in the queue."""
+        self.max_wait: float = 0
+        """Longest number of seconds an admitted request has waited in the queue."""
+
+    @contextlib.contextmanager
+    def admit(self) -> Iterator[None]:
+        """Wait for a slot to run the request and release it when the request completes."""
+        if self._semaphore.acquire(blocking=False):
+            self._on_admitted(wait=0)
+        else:
+            self._enter_queue()
+            start = time.monotonic()
+            try:
+                acquired = self._semaphore.acquire(timeout=self.queue_timeout)
+            finally:
+                self._leave_queue()
+            self._on_acquired(acquired=acquired, wait=time.monotonic() - start)
+        try:
+            yield
+        finally:
+            self._release()
+
+    @contextlib.asynccontextmanager
+    async def admit_async(self) -> AsyncIterator[None]:
+        """Same as `admit()`, but waits for the slot in the event loop, so that waiting requests hold no threads."""
+        if self._semaphore.acquire(blocking=False):
+            self._on_admitted(wait=0)
+        else:
+            self._enter_queue()
+            start = time.monotonic()
+            try:
+                acquired = await self._acquire_async(deadline=start + self.queue_timeout)
+            finally:
+                self._leave_queue()
+            self._on_acquired(acquired=acquired, wait=time.monotonic() - start)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def get_stats(self) -> dict[str, Any]:
+        """Return current queue depth, concurrency and wait time statistics."""
+        with self._lock:
+            return {
+                'max_concurrency': self.max_concurrency,
+                'max_queue': self.max_queue,
+                'waiting': self.waiting,
+                'running': self.running,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'avg_wait_seconds': round(self.total_wait / self.admitted, 3) if self.admitted else 0,
+                'max_wait_seconds': round(self.max_wait, 3),
+            }
+
+    def _enter_queue(self) -> None:
+        """Take a place in the queue or reject the request if the queue is full."""
+        with self._lock:
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                raise OverloadedError(f'Backend [{self.name}] is overloaded, {self.waiting} requests are waiting. '
+                                      'Please try again later.')
+            self.waiting += 1
+
+    def _leave_queue(self) -> None:
+        with self._lock:
+            self.waiting -= 1
+
+    def _on_acquired(self, acquired: bool, wait: float) -> None:
+        """Record the admitted request or reject it if it did not get a slot in time."""
+        if not acquired:
+            with self._lock:
+                self.rejected += 1
+            raise OverloadedError(f'Backend [{self.name}] is overloaded, the request could not start within '
+                                  f'{self.queue_timeout} seconds. Please try again later.')
+        self._on_admitted(wait=wait)
+
+    def _on_admitted(self, wait: float) -> None:
+        QUEUE_WAIT_SECONDS.observe(wait, self.name)
+        with self._lock:
+            self.running += 1
+            self.admitted += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    async def _acquire_async(self, deadline: float) -> bool:
+        """Wait for a slot until the deadline, trying again each time a slot is released."""
+        loop = asyncio.get_running_loop()
+        while True:
+            waiter = (loop, loop.create_future())
+            with self._lock:
+                self._async_waiters.append(waiter)
+            try:
+                # Try after registering the waiter, so that a slot released in between is not missed
+                if self._semaphore.acquire(blocking=False):
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                try:
+                    await asyncio.wait_for(waiter[1], timeout=remaining)
+                except asyncio.TimeoutError:
+                    return self._semaphore.acquire(blocking=False)
+            finally:
+                with self._lock:
+                    self._async_waiters.remove(waiter)
+
+    def _release(self) -> None:
+        with self._lock:
+            self.running -= 1
+            waiters = list(self._async_waiters)
+        self._semaphore.release()
+        # Wake up all async waiters to race for the slot, threads waiting in `admit()` are woken up by the semaphore
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(_set_done, future)
+            except RuntimeError:
+                # Event loop of the waiter has been closed
+                pass
+
+
+def _set_done(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
@@ -0,0 +1,164 @@
+# Copyright 2023 Qarik Group, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Pack retrieved chunks into a token budget before they are "stuffed" into the LLM prompt.
+
+Typical usage:
+    Wrap the vector store retriever of a `RetrievalQA` chain:
+
+        retriever = ContextPackingRetriever(retriever=db.as_retriever(), max_tokens=3000)
+"""
+
+import collections
+import hashlib
+import threading
+from typing import Callable, List, Tuple
+
+from common import metrics, solution
+from common.log import Logger, log
+from langchain.callbacks.manager import CallbackManagerForRetrieverRun
+from langchain.docstore.document import Document
+from langchain.schema import BaseRetriever
+
+logger = Logger(__name__).get_logger()
+logger.info('Initializing...')
+
+CONTEXT_TOKEN_BUDGET: int = int(solution.getenv('CONTEXT_TOKEN_BUDGET', '3000'))
+"""Default maximum number of tokens of retrieved context to put into a single prompt."""
+
+CHARS_PER_TOKEN: int = 4
+"""Rough number of characters per token for English text, used when no exact tokenizer is provided."""
+
+MAX_OVERLAP_CHARS: int = 300
+"""Longest overlap between neighboring chunks that will be trimmed (text splitters use 0-50 characters overlap)."""
+
+MIN_OVERLAP_CHARS: int = 20
+"""Shortest overlap between neighboring chunks that will be trimmed, so that common words are not cut off."""
+
+TOKEN_CACHE_SIZE: int = 2**14
+"""Maximum number of chunks to remember token counts for."""
+
+_token_cache: collections.OrderedDict[Tuple[str, Callable[[str], int]], Tuple[int, int]] = collections.OrderedDict()
+"""Token counts of recently packed chunks by chunk ID and tokenizer, with the length of the text that was counted."""
+_token_cache_lock = threading.Lock()
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate number of tokens in the text without loading a tokenizer."""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def _count_chunk_tokens(chunk_id: str, text: str, count_tokens: Callable[[str], int]) -> int:
+    """Count tokens of the chunk once and remember the result for subsequent requests.
+
+    The cache is keyed by the chunk ID rather than the text, so it does not keep chunk texts in memory. The text length
+    is stored along with the count, so a chunk that was re-ingested with a different text under the same ID is
+    counted again.
+    """
+    key = (chunk_id, count_tokens)
+    with _token_cache_lock:
+        cached = _token_cache.get(key)
+        if cached is not None and cached[0] == len(text):
+            _token_cache.move_to_end(key)
+            return cached[1]
+    tokens = count_tokens(text)
+    with _token_cache_lock:
+        _token_cache[key] = (len(text), tokens)
+        _token_cache.move_to_end(key)
+        while len(_token_cache) > TOKEN_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+    return tokens
+
+
+def _get_chunk_id(doc: Document) -> str:
+    """Return stable ID of the chunk: index metadata if available, otherwise hash of the text."""
+    if 'chunk' in doc.metadata:
+        return f'{doc.metadata.get("source", "")}/{doc.metadata.get("document_name", "")}#{doc.metadata["chunk"]}'
+    return hashlib.md5(doc.page_content.encode()).hexdigest()
+
+
+def _normalize(text: str) -> str:
+    """Collapse whitespace so that the same text extracted with different line breaks is detected as duplicate."""
+    return ' '.join(text.split())
+
+
+def _trim_overlap(packed: List[str], text: str) -> str:
+    """Remove the beginning of the text if it repeats the end of a chunk that is already packed."""
+    overlap = MIN_OVERLAP_CHARS - 1
+    for previous in packed:
+        for size in range(min(len(previous), len(text), MAX_OVERLAP_CHARS), overlap, -1):
+            if previous.endswith(text[:size]):
+                overlap = size
+                break
+    if overlap < MIN_OVERLAP_CHARS:
+        return text
+    return text[overlap:].lstrip()
+
+
+@log
+def pack_documents(docs: List[Document],
+                   max_tokens: int = CONTEXT_TOKEN_BUDGET,
+                   count_tokens: Callable[[str], int] = estimate_tokens) -> List[Document]:
+    """Greedily select the most relevant chunks that fit into the token budget, dropping duplicated text.
+
+    Chunks are considered in the order of their relevance `score` (higher is better) if all of them have one,
+    otherwise in the order returned by the retriever, which is already sorted by relevance.
+
+    Args:
+        docs: Retrieved chunks.
+        max_tokens: Maximum total number of tokens in the selected chunks.
+        count_tokens: Function that counts tokens in the text.
+
+    Returns:
+        Selected chunks in the order of their relevance.
+    """
+    if all('score' in doc.metadata for doc in docs):
+        docs = sorted(docs, key=lambda doc: doc.metadata['score'], reverse=True)
+
+    packed_docs: List[Document] = []
+    packed_texts: List[str] = []
+    total_tokens: int = 0
+    packed_tokens: int = 0
+    for doc in docs:
+        chunk_tokens = _count_chunk_tokens(_get_chunk_id(doc), doc.page_content, count_tokens)
+        total_tokens += chunk_tokens
+        text = _normalize(doc.page_content)
+        if not text or any(text in packed for packed in packed_texts):
+            continue
+        trimmed = _trim_overlap(packed_texts, text)
+        tokens = chunk_tokens if trimmed == text else count_tokens(trimmed)
+        if packed_tokens + tokens > max_tokens:
+            continue
+        packed_texts.append(text)
+        packed_docs.append(doc if trimmed == text else Document(page_content=trimmed, metadata=doc.metadata))
+        packed_tokens += tokens
+
+    logger.info('Packed %s of %s chunks into %s tokens (budget %s), saved %s tokens.', len(packed_docs), len(docs),
+                packed_tokens, max_tokens, total_tokens - packed_tokens)
+    return packed_docs
+
+
+class ContextPackingRetriever(BaseRetriever):
+    """Retriever that packs results of another retriever into a token budget (see `pack_documents`)."""
+    retriever: BaseRetriever
+    """Retriever that does the actual search."""
+    max_tokens: int = CONTEXT_TOKEN_BUDGET
+    """Maximum number of tokens of retrieved context."""
+    count_tokens: Callable[[str], int] = estimate_tokens
+    """Function that counts tokens in the text."""
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        """Retrieve documents with the wrapped retriever and pack them into the token budget."""
+        with metrics.STAGE_SECONDS.time('retrieval'):
+            docs = self.retriever.get_relevant_documents(query, callbacks=run_manager.get_child())
+        return pack_documents(docs=docs, max_tokens=self.max_tokens, count_tokens=self.count_tokens)
@@ -26,6 +26,8 @@ deploy() {
     --region "${REGION}"
     --project "${PROJECT_ID}"
     --memory "4Gi"
+    # Logs are written by a background thread, so keep CPU allocated between requests to let it drain the queue
+    --no-cpu-throttling
     --set-env-vars "OPENAI_API_KEY=${OPENAI_API_KEY}"
     --set-env-vars "GOOGLE_PALM_API_KEY=${GOOGLE_PALM_API_KEY}"
     --set-env-vars "EMBEDDINGS_BUCKET_NAME=${EMBEDDINGS_BUCKET_NAME}"
@@ -33,6 +35,7 @@ deploy() {
     --set-env-vars "PROJECT_ID=${PROJECT_ID}"
     --set-env-vars "REGION=${REGION}"
     --set-env-vars "LOG_LEVEL=DEBUG"
+    --set-env-vars "LOG_FORMAT=json"
     --allow-unauthenticated
   )
 
@@ -12,8 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import threading
+
 from common import solution
-from common.log import Logger, log_params
+from common.log import Logger, log, log_params
+from google.api_core import retry, retry_async
 from google.cloud import discoveryengine
 from unidecode import unidecode  # type: ignore
 
@@ -24,29 +27,89 @@ LOCATION = 'global'
 DATA_STORE_ID = 'skills-search_1688081193007'
 SERVING_CONFIG_ID = 'default_config'
 
+SEARCH_TIMEOUT: float = float(solution.getenv('ENT_SEARCH_TIMEOUT', '30'))
+"""Overall deadline in seconds for a single search, including retries."""
+
+SEARCH_RETRY_INITIAL_DELAY: float = 0.25
+"""Delay in seconds before the first retry of a failed search."""
+
+SEARCH_RETRY_MAX_DELAY: float = 4.0
+"""Maximum delay in seconds between retries of a failed search."""
+
+SERVING_CONFIG: str = discoveryengine.SearchServiceClient.serving_config_path(
+    project=solution.PROJECT_ID,
+    location=LOCATION,
+    data_store=DATA_STORE_ID,
+    serving_config=SERVING_CONFIG_ID,
+)
+"""The full resource name of the search engine serving config: e.g. projects/{project_id}/locations/{location}..."""
+
+_SEARCH_RETRY = retry.Retry(initial=SEARCH_RETRY_INITIAL_DELAY,
+                            maximum=SEARCH_RETRY_MAX_DELAY,
+                            multiplier=2.0,
+                            predicate=retry.if_transient_error,
+                            deadline=SEARCH_TIMEOUT)
+"""Retry policy for transient errors of the synchronous client."""
+
+_ASYNC_SEARCH_RETRY = retry_async.AsyncRetry(initial=SEARCH_RETRY_INITIAL_DELAY,
+                                             maximum=SEARCH_RETRY_MAX_DELAY,
+                                             multiplier=2.0,
+                                             predicate=retry.if_transient_error,
+                                             deadline=SEARCH_TIMEOUT)
+"""Retry policy for transient errors of the asynchronous client."""
+
+_CLIENT: discoveryengine.SearchServiceClient | None = None
+"""Process wide search client that reuses the gRPC channel and credentials across requests."""
+
+_ASYNC_CLIENT: discoveryengine.SearchServiceAsyncClient | None = None
+"""Process wide asynchronous search client. Bound to the event loop of the service."""
+
+_CLIENT_LOCK = threading.Lock()
+"""Lock to prevent concurrent creation of the clients."""
 
-@log_params
-def query(question: str) -> str | None:
-    """Query the Google Discovery Engine with summarization enabled."""
-    client = discoveryengine.SearchServiceClient()
-
-    # The full resource name of the search engine serving config: e.g. projects/{project_id}/locations/{location}
-    serving_config = client.serving_config_path(
-        project=solution.PROJECT_ID,
-        location=LOCATION,
-        data_store=DATA_STORE_ID,
-        serving_config=SERVING_CONFIG_ID,
-    )
-
-    request = discoveryengine.SearchRequest(
-        serving_config=serving_config,
-        query=question,
-    )
-    response = client.search(request)
-    # https://cloud.google.com/generative-ai-app-builder/docs/reference/rest/v1/SearchResponse
 
+@log
+def _get_client() -> discoveryengine.SearchServiceClient:
+    """Return the search client singleton, creating it on first use."""
+    global _CLIENT
+    if _CLIENT is None:
+        with _CLIENT_LOCK:
+            if _CLIENT is None:
+                _CLIENT = discoveryengine.SearchServiceClient()
+    return _CLIENT
+
+
+@log
+def _get_async_client() -> discoveryengine.SearchServiceAsyncClient:
+    """Return the asynchronous search client singleton, creating it on first use from within the event loop."""
+    global _ASYNC_CLIENT
+    if _ASYNC_CLIENT is None:
+        with _CLIENT_LOCK:
+            if _ASYNC_CLIENT is None:
+                _ASYNC_CLIENT = discoveryengine.SearchServiceAsyncClient()
+    return _ASYNC_CLIENT
+
+
+def _get_answer(response) -> str | None:
+    """Return the first extractive answer from the search response."""
+    # https://cloud.google.com/generative-ai-app-builder/docs/reference/rest/v1/SearchResponse
     for a in response.results[0].document.derived_struct_data['extractive_answers']:
         for b in a.items():
             return unidecode(str(b[1]))
 
     return None
+
+
+@log_params
+def query(question: str) -> str | None:
+    """Query the Google Discovery Engine with summarization enabled."""
+    request = discoveryengine.SearchRequest(serving_config=SERVING_CONFIG, query=question)
+    response = _get_client().search(request, retry=_SEARCH_RETRY, timeout=SEARCH_TIMEOUT)
+    return _get_answer(response)
+
+
+async def aquery(question: str) -> str | None:
+    """Query the Google Discovery Engine with summarization enabled without blocking the event loop."""
+    request = discoveryengine.SearchRequest(serving_config=SERVING_CONFIG, query=question)
+    pager = await _get_async_client().search(request, retry=_ASYNC_SEARCH_RETRY, timeout=SEARCH_TIMEOUT)
+    return _get_answer(pager)
@@ -14,15 +14,19 @@
 
 """Main API service that handles REST API calls to LLM and is run on server."""
 
-import threading
-from datetime import datetime
-from typing import Any
-
-from common import admin_dao, constants, gcs_tools, solution
-from common.cache import cache
+import glob
+import os
+import shutil
+import time
+import weakref
+
+from common import admin_dao, constants, gcs_tools, metrics, solution
+from common.engine_registry import EngineRegistry
 from common.log import Logger, log
+from context_tools import ContextPackingRetriever
 from langchain.chains import RetrievalQA
-from langchain.document_loaders import PyPDFDirectoryLoader
+from langchain.docstore.document import Document
+from langchain.document_loaders import PyPDFLoader
 from langchain.embeddings import VertexAIEmbeddings  # type: ignore
 from langchain.llms import VertexAI  # type: ignore
 from langchain.text_splitter import RecursiveCharacterTextSplitter
@@ -52,54 +56,197 @@ TOP_K: int = 10
 SIMILARITY_SEARCH_K: int = 11
 """Number of similar documents to return from the index."""
 
-LANGCHAIN_ENGINE: Any = None
-"""Langchain engine singleton that is used to answer questions."""
-
 RESUME_BUCKET_NAME: str = solution.getenv('RESUME_BUCKET_NAME')
 """Location to download source PDF resumes from."""
 
 LOCAL_PROD_DATA_DIR: str = 'tmp/chroma-source-resumes'
 """Location of the local data directory for storing resumes PDF files copied from GCS."""
 
-CHROMA_LOCK = threading.Lock()
-"""Lock to prevent concurrent creation of langchain."""
-
-LAST_LOCAL_INDEX_UPDATE: datetime | None = None
-"""Keep track of the most recent local index update to avoid unnecessary refreshes."""
-
 LOCAL_DEV_DATA_DIR: str = 'dev/tmp'
 """Location of the local data directory for development on local machine."""
 
+if solution.LOCAL_DEVELOPMENT_MODE:
+    CHROMA_INDEX_DIR: str = 'dev/tmp/chroma-index'
+else:
+    CHROMA_INDEX_DIR = 'tmp/chroma-index'
+"""Location of the persistent Chroma collection on the local disk."""
+
+CHROMA_COLLECTION_NAME: str = f'{solution.RESOURCE_PREFIX}_resumes'
+"""Name of the Chroma collection with resume chunks."""
+
+CHROMA_BUCKET_NAME: str = solution.getenv('CHROMA_BUCKET_NAME', '')
+"""Optional GCS bucket with the Chroma collection published by the resume manager (see `resume_manager/ingestion.py`).
+Empty value makes the query engine build and update the collection itself."""
+
+CHROMA_STAGING_DIR: str = f'{CHROMA_INDEX_DIR}-staging'
+"""Local copy of the published Chroma collection that is synced with GCS and copied for each engine snapshot."""
+
+_latest_index_dir: str | None = None
+"""Local copy of the collection used by the most recent engine snapshot, which the next copy is made from."""
+
+_leftovers_checked: bool = False
+"""Whether copies of the collection left by a previous process have been taken over or deleted."""
+
+RESUME_METADATA_KEY: str = 'resume'
+"""Chunk metadata key with the name of the source resume file."""
+
+RESUME_HASH_METADATA_KEY: str = 'resume_hash'
+"""Chunk metadata key with the MD5 hash of the source resume file the chunk was created from."""
+
 
 @log
-def _create_langchain_client():
-    """Create a new Langchain client and initialize the index. Returns Langchain engine singleton."""
-    global LANGCHAIN_ENGINE
+def _get_resume_hashes() -> dict[str, str]:
+    """Return MD5 hashes of the current source resumes keyed by resume file name."""
+    if solution.LOCAL_DEVELOPMENT_MODE:
+        return {os.path.basename(path): gcs_tools.file_md5(path) for path in glob.glob(f'{LOCAL_DEV_DATA_DIR}/*.pdf')}
+    return {name: md5 for name, md5 in gcs_tools.list_blob_hashes(bucket_name=RESUME_BUCKET_NAME).items()
+            if name.lower().endswith('.pdf')}
 
+
+@log
+def _load_resume_chunks(resume_name: str, resume_hash: str) -> list[Document]:
+    """Load a single resume PDF (downloading it from GCS if needed) and split it into chunks."""
     if solution.LOCAL_DEVELOPMENT_MODE:
-        source_pdf_path = LOCAL_DEV_DATA_DIR
+        resume_path = os.path.join(LOCAL_DEV_DATA_DIR, resume_name)
     else:
-        source_pdf_path = LOCAL_PROD_DATA_DIR
-        # Download source PDF files from GCS into local folder for processing
-        gcs_tools.download(bucket_name=RESUME_BUCKET_NAME, local_dir=LOCAL_PROD_DATA_DIR)
+        resume_path = os.path.join(LOCAL_PROD_DATA_DIR, resume_name)
+        gcs_tools.download_blob(bucket_name=RESUME_BUCKET_NAME, blob_name=resume_name, local_file_path=resume_path)
 
-    # Load docs...
-    loader = PyPDFDirectoryLoader(path=source_pdf_path)
-    documents = loader.load()
-
-    # split the documents into chunks
     text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
-    docs = text_splitter.split_documents(documents)
-    logger.info(f'# of documents created from source PDFs = {len(docs)}')
+    chunks = text_splitter.split_documents(PyPDFLoader(resume_path).load())
+    for chunk in chunks:
+        chunk.metadata[RESUME_METADATA_KEY] = resume_name
+        chunk.metadata[RESUME_HASH_METADATA_KEY] = resume_hash
+
+    if not solution.LOCAL_DEVELOPMENT_MODE:
+        os.remove(resume_path)
+    return chunks
 
-    embeddings = VertexAIEmbeddings()
 
-    # Store docs in local vector store as index
-    # it may take a while since API is rate limited
-    db = Chroma.from_documents(documents=docs, embedding=embeddings)
+@log
+def _update_chroma_index(db: Chroma) -> bool:
+    """Bring the persistent Chroma collection in sync with the source resumes, re-embedding only changed resumes.
+
+    Returns:
+        True if the collection was changed.
+    """
+    resume_hashes = _get_resume_hashes()
+    indexed_hashes: dict[str, str] = {}
+    for metadata in db.get(include=['metadatas'])['metadatas']:
+        indexed_hashes[metadata[RESUME_METADATA_KEY]] = metadata[RESUME_HASH_METADATA_KEY]
+
+    removed = [name for name in indexed_hashes.keys() if name not in resume_hashes]
+    changed = [name for name, md5 in resume_hashes.items() if indexed_hashes.get(name) != md5]
+    logger.info('Resumes in Chroma index: %s, removed: %s, new or changed: %s', len(indexed_hashes), len(removed),
+                len(changed))
+
+    for resume_name in removed + [name for name in changed if name in indexed_hashes]:
+        ids = db.get(where={RESUME_METADATA_KEY: resume_name})['ids']
+        if ids:
+            db.delete(ids=ids)
+
+    for resume_name in changed:
+        chunks = _load_resume_chunks(resume_name=resume_name, resume_hash=resume_hashes[resume_name])
+        if chunks:
+            # it may take a while since API is rate limited
+            db.add_documents(documents=chunks,
+                             ids=[f'{resume_hashes[resume_name]}-{i}' for i in range(len(chunks))])
+
+    if removed or changed:
+        db.persist()
+        return True
+    return False
+
+
+def _new_index_dir() -> str:
+    """Return a new directory for a copy of the Chroma collection."""
+    return f'{CHROMA_INDEX_DIR}-{time.time_ns()}'
+
+
+def _remove_index_dir(local_dir: str) -> None:
+    shutil.rmtree(local_dir, ignore_errors=True)
+    if os.path.exists(f'{local_dir}{gcs_tools.LOCAL_MANIFEST_SUFFIX}'):
+        os.remove(f'{local_dir}{gcs_tools.LOCAL_MANIFEST_SUFFIX}')
+
+
+def _take_leftover_index_dirs() -> list[str]:
+    """Return copies of the collection left by a previous process, oldest first, once per process."""
+    global _leftovers_checked
+    if _leftovers_checked:
+        return []
+    _leftovers_checked = True
+    leftovers = sorted((path for path in glob.glob(f'{CHROMA_INDEX_DIR}-*')
+                        if os.path.isdir(path) and path.rsplit('-', 1)[-1].isdigit()),
+                       key=lambda path: int(path.rsplit('-', 1)[-1]))
+    # Collection updated in place by earlier versions of the service
+    if os.path.isdir(CHROMA_INDEX_DIR):
+        leftovers.insert(0, CHROMA_INDEX_DIR)
+    return leftovers
+
+
+def _open_index_dir(local_dir: str) -> Chroma:
+    """Open the copy of the collection and delete it once the last engine snapshot that uses it is garbage collected,
+    that is after the in-flight requests of a replaced snapshot have completed."""
+    db = Chroma(collection_name=CHROMA_COLLECTION_NAME,
+                embedding_function=VertexAIEmbeddings(),
+                persist_directory=local_dir)
+    finalizer = weakref.finalize(db, _remove_index_dir, local_dir)
+    # Keep the copy of the last snapshot on exit, so that the next process does not embed unchanged resumes again
+    finalizer.atexit = False
+    return db
+
+
+@log
+def _build_chroma_index() -> Chroma:
+    """Copy the collection of the current snapshot into a new local directory and update it with changed resumes.
+
+    Each engine snapshot reads its own copy, so a rebuild never changes the collection under in-flight requests.
+    """
+    global _latest_index_dir
+    leftovers = _take_leftover_index_dirs()
+    if _latest_index_dir is not None:
+        local_dir = _new_index_dir()
+        shutil.copytree(_latest_index_dir, local_dir)
+    elif leftovers:
+        # No snapshot of this process uses the copies left by the previous one, so update the newest in place
+        local_dir = leftovers.pop()
+    else:
+        local_dir = _new_index_dir()
+    for old_dir in leftovers:
+        _remove_index_dir(old_dir)
+    db = _open_index_dir(local_dir)
+    _update_chroma_index(db)
+    _latest_index_dir = local_dir
+    return db
+
+
+@log
+def _open_published_chroma_index() -> Chroma:
+    """Sync the collection published by the resume manager into the staging directory and open a copy of it.
+
+    Only new and changed files are downloaded into the staging directory. Each engine snapshot reads its own copy, so
+    the copy of the previous snapshot is never changed under in-flight requests.
+    """
+    for old_dir in _take_leftover_index_dirs():
+        _remove_index_dir(old_dir)
+    gcs_tools.download(bucket_name=CHROMA_BUCKET_NAME, local_dir=CHROMA_STAGING_DIR)
+    local_dir = _new_index_dir()
+    shutil.copytree(CHROMA_STAGING_DIR, local_dir)
+    return _open_index_dir(local_dir)
 
-    # Expose index to the retriever
-    retriever = db.as_retriever(search_type='similarity', search_kwargs={'k': SIMILARITY_SEARCH_K})
+
+@log
+def _create_langchain_client() -> RetrievalQA:
+    """Open the latest published Chroma collection, or build a new local one with changed resumes, and create a new
+    engine."""
+    if CHROMA_BUCKET_NAME:
+        db = _open_published_chroma_index()
+    else:
+        db = _build_chroma_index()
+
+    # Expose index to the retriever, keeping only as many of the most relevant chunks as fit into the token budget
+    retriever = ContextPackingRetriever(
+        retriever=db.as_retriever(search_type='similarity', search_kwargs={'k': SIMILARITY_SEARCH_K}))
 
     # LLM model
     llm = VertexAI(model_name=constants.GOOGLE_PALM_MODEL,
@@ -112,48 +259,23 @@ def _create_langchain_client():
     # Create chain to answer questions
     # Uses LLM to synthesize results from the search index.
     # We use Vertex PaLM Text API for LLM
-    LANGCHAIN_ENGINE = RetrievalQA.from_chain_type(
+    return RetrievalQA.from_chain_type(
         llm=llm,
         chain_type='stuff',
         retriever=retriever,
         return_source_documents=False)
 
 
-@cache
-@log
-def _refresh_chroma_index() -> None:
-    """Refresh the index of resumes from the database using Chroma Vector DB. Returns retrieval engine client."""
-    global CHROMA_LOCK
-    global LAST_LOCAL_INDEX_UPDATE
-
-    if solution.LOCAL_DEVELOPMENT_MODE:
-        # In local development mode we don't need to refresh the index and only load it on the first time
-        if LAST_LOCAL_INDEX_UPDATE is None:
-            last_resume_refresh: datetime = solution.now()
-        else:
-            last_resume_refresh = LAST_LOCAL_INDEX_UPDATE
-    else:
-        last_resume_refresh = admin_dao.AdminDAO().get_resumes_timestamp()
-        if last_resume_refresh is None:
-            last_resume_refresh = solution.now()
-
-    if LAST_LOCAL_INDEX_UPDATE is None or \
-            LANGCHAIN_ENGINE is None or \
-            LAST_LOCAL_INDEX_UPDATE < last_resume_refresh:
-        # Prevent concurrent updates of the same index - needed in case we have more than one request processing
-        with CHROMA_LOCK:
-            # Check for condition again because the index may have been updated while we were waiting for the lock
-            if LAST_LOCAL_INDEX_UPDATE is None or \
-                    LANGCHAIN_ENGINE is None or \
-                    LAST_LOCAL_INDEX_UPDATE < last_resume_refresh:
-                _create_langchain_client()
+ENGINE_REGISTRY = EngineRegistry(name='chroma', builder=_create_langchain_client)
+"""Versioned Langchain engine snapshots. Replaced in the background when resumes are updated."""
 
 
 @log
 def query(question: str) -> str:
     """Ask a question to the Google PaLM model using local index store in ChromaDB and Langchain. For large datasets this will not scale well."""
-    global LANGCHAIN_ENGINE
-    _refresh_chroma_index()
-    # answer = LANGCHAIN_ENGINE({'query': query})['result']
-    answer = LANGCHAIN_ENGINE(question)['result']
+    langchain_engine = ENGINE_REGISTRY.get(version=admin_dao.get_resumes_version()).engine
+    # Same steps as RetrievalQA, done one by one so that retrieval and the LLM call are timed separately
+    docs = langchain_engine.retriever.get_relevant_documents(question)
+    with metrics.STAGE_SECONDS.time('llm'):
+        answer = langchain_engine.combine_documents_chain.run(input_documents=docs, question=question)
     return str(answer)
@@ -13,14 +13,23 @@
 # limitations under the License.
 """Main service that handles REST API calls with user questions and invokes backend LLMs to get responses."""
 
-from typing import Annotated, Any
+import asyncio
+import functools
+import hashlib
+import json
+import time
+from datetime import datetime
+from typing import Annotated, Any, AsyncIterator, Awaitable, Callable, NamedTuple
 
 import chat_dao
 import langchain_tools
-from common import api_tools, constants, llamaindex_tools, solution
-from common.log import Logger, log_params
+from concurrency_tools import AdmissionController, RequestCoalescer
+from common import admin_dao, api_tools, constants, llamaindex_tools, metrics, solution, tracing
+from common.engine_registry import EngineSnapshot
+from common.log import Logger, log, log_params
 from fastapi import Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
 from query_engine import goog_search_tools, vertexai_tools
 from query_engine.chat_dao import VoteStatistic
@@ -35,6 +44,26 @@ class AskInput(BaseModel):
     """Question to ask the LLM model."""
     prompt_prefix: str = ''
     """Prefix to add to the question before passing it to the LLM model."""
+    retrieval_mode: str | None = None
+    """Retrieval parameters preset, such as 'fast' or 'thorough' (only used by the Vertex AI backend)."""
+
+
+class AskAllInput(AskInput):
+    """Input parameters for the ask all endpoint."""
+    backends: list[str] | None = None
+    """Names of the backends to ask (see `BACKENDS`), all of them if not specified."""
+
+
+class AskBatchInput(BaseModel):
+    """Input parameters for the ask batch endpoint."""
+    backend: str
+    """Name of the backend to ask (see `BACKENDS`)."""
+    questions: list[str]
+    """Questions to ask the LLM model."""
+    prompt_prefix: str = ''
+    """Prefix to add to each question before passing it to the LLM model."""
+    retrieval_mode: str | None = None
+    """Retrieval parameters preset, such as 'fast' or 'thorough' (only used by the Vertex AI backend)."""
 
 
 class VoteInput(BaseModel):
@@ -45,6 +74,12 @@ class VoteInput(BaseModel):
     upvoted: bool
 
 
+BATCH_MAX_QUESTIONS: int = int(solution.getenv('BATCH_MAX_QUESTIONS', '100'))
+"""Maximum number of questions in one batch request."""
+
+BATCH_PARALLELISM: int = int(solution.getenv('BATCH_PARALLELISM', '4'))
+"""Maximum number of questions of one batch request that are answered at the same time."""
+
 app = api_tools.ServiceAPI(title='Resume Chatbot API (experimental)',
                            description='Request / response API for the Resume Chatbot that uses LLM for queries.')
 
@@ -66,6 +101,9 @@ _users_db = chat_dao.UserDao()
 _vote_db = chat_dao.VoteDao()
 """Data Access Object to the database of votes."""
 
+_interaction_writer = chat_dao.InteractionWriter(user_dao=_users_db)
+"""Write-behind queue that saves questions and answers to the database of users off the request path."""
+
 
 def _get_user_id(user_email: str | None) -> str:
     """Extract user ID from the request headers.˝"""
@@ -81,20 +119,246 @@ def _get_user_id(user_email: str | None) -> str:
     return user_id
 
 
-def _store_answer(data: AskInput, answer: str, x_goog: Any, provider: constants.LlmProvider):
-    _users_db.save_question_answer(user_id=_get_user_id(x_goog),
-                                   question=f'{data.prompt_prefix}===>{data.question}',
-                                   answer=str(answer),
-                                   llm_backend=str(provider))
+def _get_interaction(data: AskInput, answer: Any, provider: constants.LlmProvider) -> dict[str, Any]:
+    return chat_dao.create_interaction(question=f'{data.prompt_prefix}===>{data.question}',
+                                       answer=str(answer),
+                                       llm_backend=str(provider))
+
+
+async def _store_answer(data: AskInput, answer: Any, x_goog: Any, provider: constants.LlmProvider):
+    # Falls back to a synchronous Firestore write when the queue is full, so keep it off the event loop
+    await asyncio.to_thread(_interaction_writer.save_interactions,
+                            user_id=_get_user_id(x_goog),
+                            interactions=[_get_interaction(data=data, answer=answer, provider=provider)])
+
+
+class Backend(NamedTuple):
+    """LLM backend that can answer user questions."""
+    provider: constants.LlmProvider
+    """LLM provider recorded with the answer."""
+    ask: Callable[[AskInput], Any]
+    """Blocking function that returns the answer."""
+    timeout: float
+    """Maximum number of seconds to wait for the answer when asking several backends at once."""
+    ask_async: Callable[[AskInput], Awaitable[Any]] | None = None
+    """Optional non-blocking version of `ask` to run in the event loop instead of a worker thread."""
+
+
+BACKENDS: dict[str, Backend] = {
+    'gpt': Backend(
+        provider=constants.LlmProvider.OPEN_AI,
+        ask=lambda data: llamaindex_tools.query(question=f'{data.prompt_prefix}\n{data.question}'),
+        timeout=float(solution.getenv('GPT_TIMEOUT', '120'))),
+    'ent_search': Backend(
+        provider=constants.LlmProvider.GOOG_ENT_SEARCH,
+        ask=lambda data: goog_search_tools.query(question=f'{data.prompt_prefix}\n{data.question}'),
+        timeout=goog_search_tools.SEARCH_TIMEOUT,
+        ask_async=lambda data: goog_search_tools.aquery(question=f'{data.prompt_prefix}\n{data.question}')),
+    'palm_chroma_langchain': Backend(
+        provider=constants.LlmProvider.GOOG_PALM,
+        ask=lambda data: langchain_tools.query(question=f'{data.prompt_prefix}\n{data.question}'),
+        timeout=float(solution.getenv('PALM_CHROMA_TIMEOUT', '60'))),
+    'vertexai': Backend(
+        provider=constants.LlmProvider.GOOG_VERTEX,
+        ask=lambda data: vertexai_tools.query(question=data.question,
+                                              config=vertexai_tools.get_retrieval_config(mode=data.retrieval_mode)),
+        timeout=float(solution.getenv('VERTEXAI_TIMEOUT', '60'))),
+}
+"""Backends that can answer questions keyed by the suffix of their `/ask_*` endpoint."""
+
+
+_coalescer = RequestCoalescer()
+"""Share answers between concurrent identical questions to the same backend."""
+
+_admission: dict[str, AdmissionController] = {
+    name: AdmissionController(name=name,
+                              max_concurrency=int(solution.getenv(f'{name.upper()}_MAX_CONCURRENCY', '8')),
+                              max_queue=int(solution.getenv(f'{name.upper()}_MAX_QUEUE', '32')),
+                              queue_timeout=float(solution.getenv(f'{name.upper()}_QUEUE_TIMEOUT', '10')))
+    for name in BACKENDS.keys()
+}
+"""Limit the number of concurrent requests to each backend to stay within LLM quotas."""
+
+_ENGINE_REGISTRIES = (vertexai_tools.ENGINE_REGISTRY,
+                      llamaindex_tools.ENGINE_REGISTRY,
+                      langchain_tools.ENGINE_REGISTRY)
+"""Engine snapshots of the backends that build them from the resume index."""
+
+
+def _get_admission_stat(stat: str) -> dict[tuple[str, ...], float | None]:
+    return {(name,): controller.get_stats()[stat] for name, controller in _admission.items()}
+
+
+def _get_index_versions() -> dict[tuple[str, ...], float | None]:
+    """Return timestamp of the resume update that the current engine of each backend was built from."""
+    versions: dict[tuple[str, ...], float | None] = {}
+    for registry in _ENGINE_REGISTRIES:
+        snapshot = registry.current()
+        if snapshot is not None and isinstance(snapshot.version, datetime):
+            versions[(registry.name,)] = snapshot.version.timestamp()
+    return versions
+
+
+metrics.CallbackGauge('backend_requests_running', 'Requests currently running against each backend.',
+                      callback=lambda: _get_admission_stat('running'), labelnames=('backend',))
+metrics.CallbackGauge('backend_requests_waiting', 'Requests currently waiting for a backend concurrency slot.',
+                      callback=lambda: _get_admission_stat('waiting'), labelnames=('backend',))
+metrics.CallbackCounter('backend_requests_admitted_total', 'Requests admitted by the backend admission control.',
+                        callback=lambda: _get_admission_stat('admitted'), labelnames=('backend',))
+metrics.CallbackCounter('backend_requests_rejected_total', 'Requests rejected because the backend was overloaded.',
+                        callback=lambda: _get_admission_stat('rejected'), labelnames=('backend',))
+metrics.CallbackCounter('coalesced_requests_total',
+                        'Requests that called the backend (leader) or reused the answer of an identical in-flight '
+                        'request (follower).',
+                        callback=lambda: {('leader',): _coalescer.leaders, ('follower',): _coalescer.followers},
+                        labelnames=('role',))
+metrics.CallbackGauge('interaction_queue_depth', 'Questions and answers waiting to be saved to the database.',
+                      callback=lambda: {(): _interaction_writer.queue_depth()})
+metrics.CallbackGauge('index_version_timestamp_seconds',
+                      'Time of the resume update that the current engine of each backend was built from.',
+                      callback=_get_index_versions, labelnames=('backend',))
+
+
+def _ask_admitted(name: str, data: AskInput) -> Any:
+    """Ask the backend once a concurrency slot is available."""
+    with _admission[name].admit():
+        return BACKENDS[name].ask(data)
+
+
+def _get_coalescing_key(name: str, data: AskInput) -> tuple:
+    return (name, data.prompt_prefix, data.question, data.retrieval_mode, admin_dao.get_resumes_version())
+
+
+def _ask(name: str, data: AskInput) -> Any:
+    """Ask the backend, attaching to the in-flight request for the same question against the same index version.
+
+    Blocks the calling thread while waiting for a slot, so only use it from a bounded number of worker threads.
+    """
+    return _coalescer.run(_get_coalescing_key(name, data), _ask_admitted, name, data)
+
+
+async def _ask_admitted_async(name: str, data: AskInput) -> Any:
+    """Ask the backend once a concurrency slot is available, taking a worker thread only after the slot."""
+    backend = BACKENDS[name]
+    async with _admission[name].admit_async():
+        if backend.ask_async is not None:
+            return await backend.ask_async(data)
+        return await asyncio.to_thread(backend.ask, data)
+
+
+async def _ask_async(name: str, data: AskInput) -> Any:
+    """Same as `_ask()`, but requests waiting for a slot or for an identical in-flight request hold no threads.
+
+    The worker thread of a running request can not be interrupted and finishes in the background if the caller gives
+    up on it.
+    """
+    key = await asyncio.to_thread(_get_coalescing_key, name, data)
+    return await _coalescer.run_async(key, _ask_admitted_async, name, data)
+
+
+async def _add_answer(event: dict[str, Any], name: str, get_answer: Callable[[], Awaitable[Any]],
+                      timeout: float) -> dict[str, Any]:
+    """Wait for the answer within the deadline and add it, or the error, to the event for the client."""
+    start = time.monotonic()
+    try:
+        event['answer'] = str(await asyncio.wait_for(get_answer(), timeout=timeout))
+    except asyncio.TimeoutError:
+        event['error'] = f'No answer within {timeout} seconds.'
+    except Exception as err:    # noqa: B902
+        logger.error('Backend [%s] failed to answer: %s', name, err)
+        event['error'] = str(err)
+    event['seconds'] = round(time.monotonic() - start, 3)
+    return event
+
+
+async def _ask_backend(name: str, data: AskInput) -> dict[str, Any]:
+    """Ask one backend within its deadline and return the answer or the error as an event for the client."""
+    backend = BACKENDS[name]
+    return await _add_answer(event={'backend': name, 'llm': str(backend.provider)},
+                             name=name,
+                             get_answer=lambda: _ask_async(name, data),
+                             timeout=backend.timeout)
+
+
+def _get_batch_ask(data: AskBatchInput) -> Callable[[int, str], Any]:
+    """Return blocking function that answers the question at the given position of the batch.
+
+    Vertex AI retrieval for the whole batch is done here upfront, with one embeddings pass and one Matching Engine
+    call, so that only the LLM calls are left per question. Other backends answer each question independently.
+    """
+    if data.backend == 'vertexai':
+        config = vertexai_tools.get_retrieval_config(mode=data.retrieval_mode)
+        try:
+            contexts = vertexai_tools.retrieve_batch(questions=data.questions, config=config)
+
+            def ask_vertexai(index: int, question: str) -> Any:
+                with _admission['vertexai'].admit():
+                    return vertexai_tools.answer(question=question, docs=contexts[index])
+
+            return ask_vertexai
+        except Exception as err:    # noqa: B902
+            logger.warning('Batch retrieval failed, will retrieve context for each question separately: %s', err)
+
+    def ask(index: int, question: str) -> Any:
+        return _ask(data.backend,
+                    AskInput(question=question, prompt_prefix=data.prompt_prefix, retrieval_mode=data.retrieval_mode))
+
+    return ask
+
+
+def _refresh_engines(version: Any) -> None:
+    """Start rebuilding the engines of all backends as soon as the resumes are updated, before the next question."""
+    for registry in _ENGINE_REGISTRIES:
+        if registry.current() is not None:
+            registry.refresh(version=version)
+
+
+@app.on_event('startup')
+def warm_up() -> None:
+    """Initialize slow backends in the background so that the service can start serving health checks right away."""
+    if not solution.LOCAL_DEVELOPMENT_MODE:
+        admin_dao.VERSION_WATCHER.add_listener(_refresh_engines)
+        admin_dao.VERSION_WATCHER.start()
+    vertexai_tools.warm_up()
+    llamaindex_tools.ENGINE_REGISTRY.warm_up(get_version=admin_dao.get_resumes_version)
+    langchain_tools.ENGINE_REGISTRY.warm_up(get_version=admin_dao.get_resumes_version)
+
+
+@app.on_event('shutdown')
+def flush_interactions() -> None:
+    """Write all queued interactions to the database and stop watching the config before the process exits."""
+    _interaction_writer.close(timeout=chat_dao.INTERACTIONS_FLUSH_INTERVAL * 10)
+    admin_dao.VERSION_WATCHER.stop()
+
+
+@functools.lru_cache(maxsize=1)
+def _get_people_etag(snapshot: EngineSnapshot) -> str:
+    """Compute the ETag of the people list once per index snapshot."""
+    digest = hashlib.sha1(f'{snapshot.version}|{"|".join(snapshot.engine.people)}'.encode()).hexdigest()
+    return f'"{digest[:16]}"'
 
 
 @app.get('/people')
 @log_params
-def list_people() -> list[str]:
-    """List all people names found in the database of uploaded resumes."""
-    llamaindex_tools._refresh_llama_index()
-    people = llamaindex_tools.load_resumes(resume_dir='')
-    return [person for person in people.keys()]
+def list_people(if_none_match: Annotated[str | None, Header()] = None) -> Response:
+    """List all people names found in the database of uploaded resumes.
+
+    The list is computed when the index snapshot is built and served from memory. Clients that send back the ETag in
+    the `If-None-Match` header get 304 Not Modified until the resumes are updated. Returns 503 until the first snapshot
+    has been built in the background: the request never builds or refreshes the index, which is left to `warm_up` and
+    the resume version watcher.
+    """
+    snapshot = llamaindex_tools.ENGINE_REGISTRY.current()
+    if snapshot is None:
+        raise RuntimeError('The list of people is still loading, please try again later.')
+    etag = _get_people_etag(snapshot)
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    metrics.CACHE_LOOKUPS.inc('people_etag')
+    if if_none_match is not None and (if_none_match.strip() == '*' or etag in
+                                      [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]):
+        return Response(status_code=304, headers=headers)
+    metrics.CACHE_MISSES.inc('people_etag')
+    return JSONResponse(content=snapshot.engine.people, headers=headers)
 
 
 @app.get('/health', name='Health check and information about the software version and configuration.')
@@ -104,60 +368,163 @@ def healthcheck() -> dict:
     return solution.health_status()
 
 
+@app.get('/traces', name='Span trees of the most recent slow requests.')
+@log
+def list_traces() -> list[dict]:
+    """Return wall and CPU time of each decorated function called by recent slow requests, newest first.
+
+    Only a sample of requests is traced (see `tracing.TRACE_SAMPLE_RATE`), and only those slower than
+    `tracing.TRACE_LOG_THRESHOLD` are kept.
+    """
+    return tracing.recent_traces()
+
+
+@app.get('/metrics', name='Metrics in the Prometheus text format.')
+@log
+def get_metrics() -> Response:
+    """Return request counts, latency histograms, in-flight gauges and component statistics for scraping."""
+    return Response(content=metrics.REGISTRY.expose(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get('/ready', name='Readiness check that reports whether slow to initialize backends are ready to answer.')
+@log_params
+def readiness() -> dict:
+    """Return 503 until the backends initialized in the background are ready to answer questions."""
+    if not vertexai_tools.is_ready():
+        raise RuntimeError('Vertex AI backend is still initializing.')
+    return solution.health_status()
+
+
+@app.get('/stats', name='Statistics of admission control and request coalescing for each LLM backend.')
+@log_params
+def stats() -> dict[str, Any]:
+    """Return queue depth, wait times and rejections per backend, and how many requests shared in-flight answers."""
+    return {
+        'admission': {name: controller.get_stats() for name, controller in _admission.items()},
+        'coalescing': {'leaders': _coalescer.leaders, 'followers': _coalescer.followers},
+    }
+
+
 @app.post('/ask_gpt', name='Ask a question to the GPT-3 model using LlamaIndex and local embeddings store.'
           ' This can be slow because of LlamaIndex chain implementation.')
-@log_params
-def ask_gpt(data: AskInput, x_goog_authenticated_user_email: Annotated[str | None, Header()] = None) -> dict[str, str]:
+async def ask_gpt(data: AskInput,
+                  x_goog_authenticated_user_email: Annotated[str | None, Header()] = None) -> dict[str, str]:
     """Ask a question to the GPT-3 model."""
-    answer = llamaindex_tools.query(question=f'{data.prompt_prefix}\n{data.question}')
-    _store_answer(data=data,
-                  answer=answer,
-                  x_goog=x_goog_authenticated_user_email,
-                  provider=constants.LlmProvider.OPEN_AI)
+    answer = await _ask_async('gpt', data)
+    await _store_answer(data=data,
+                        answer=answer,
+                        x_goog=x_goog_authenticated_user_email,
+                        provider=constants.LlmProvider.OPEN_AI)
     return {'answer': str(answer)}
 
 
 @app.post('/ask_ent_search', name='Ask a question to the Google GenAI using Enterprise Search with summarization.')
-@log_params
-def ask_goog_ent_search(data: AskInput, x_goog_authenticated_user_email: Annotated[str | None, Header()] = None) -> dict[str, str]:
+async def ask_goog_ent_search(
+        data: AskInput,
+        x_goog_authenticated_user_email: Annotated[str | None, Header()] = None) -> dict[str, str]:
     """Ask a question to the Google GenAI using Enterprise Search with summarization."""
-    answer = goog_search_tools.query(question=f'{data.prompt_prefix}\n{data.question}')
-    _store_answer(data=data,
-                  answer=answer,
-                  x_goog=x_goog_authenticated_user_email,
-                  provider=constants.LlmProvider.GOOG_ENT_SEARCH)
+    answer = await _ask_async('ent_search', data)
+    await _store_answer(data=data,
+                        answer=answer,
+                        x_goog=x_goog_authenticated_user_email,
+                        provider=constants.LlmProvider.GOOG_ENT_SEARCH)
     return {'answer': str(answer)}
 
 
 @app.post('/ask_palm_chroma_langchain',
           name='Ask a question to the Google PaLM model using local index store in ChromaDB and Langchain.')
-@log_params
-def ask_palm_chroma_langchain(data: AskInput,
-                              x_goog_authenticated_user_email: Annotated[str | None, Header()] = None) -> dict[str, str]:
+async def ask_palm_chroma_langchain(
+        data: AskInput,
+        x_goog_authenticated_user_email: Annotated[str | None, Header()] = None) -> dict[str, str]:
     """Ask a question to the Google PaLM model using local index store in ChromaDB and Langchain."""
-    answer = langchain_tools.query(question=f'{data.prompt_prefix}\n{data.question}')
-    _store_answer(data=data,
-                  answer=answer,
-                  x_goog=x_goog_authenticated_user_email,
-                  provider=constants.LlmProvider.GOOG_PALM)
+    answer = await _ask_async('palm_chroma_langchain', data)
+    await _store_answer(data=data,
+                        answer=answer,
+                        x_goog=x_goog_authenticated_user_email,
+                        provider=constants.LlmProvider.GOOG_PALM)
     return {'answer': answer}
 
 
 @app.post('/ask_vertexai',
           name='Ask a question to the Google PaLM 2 model via Langchain using VertexAI Embeddings and Index Search.')
-@log_params
-def ask_vertexai(data: AskInput, x_goog_authenticated_user_email: Annotated[str | None, Header()] = None) -> dict[str, str]:
+async def ask_vertexai(data: AskInput,
+                       x_goog_authenticated_user_email: Annotated[str | None, Header()] = None) -> dict[str, str]:
     """Ask a question to the Google PaLM 2 model via Langchain using VertexAI Embeddings and Index Search.
 
     This should scale well for large datasets."""
-    answer = vertexai_tools.query(data.question)
-    _store_answer(data=data,
-                  answer=answer,
-                  x_goog=x_goog_authenticated_user_email,
-                  provider=constants.LlmProvider.GOOG_VERTEX)
+    answer = await _ask_async('vertexai', data)
+    await _store_answer(data=data,
+                        answer=answer,
+                        x_goog=x_goog_authenticated_user_email,
+                        provider=constants.LlmProvider.GOOG_VERTEX)
     return {'answer': answer}
 
 
+@app.post('/ask_all', name='Ask a question to several LLM backends at once and stream answers as they arrive.')
+async def ask_all(data: AskAllInput,
+                  x_goog_authenticated_user_email: Annotated[str | None, Header()] = None) -> StreamingResponse:
+    """Ask a question to several LLM backends concurrently, each one within its own deadline.
+
+    Returns: newline delimited JSON stream with one event per backend in the order the answers arrive. For example:
+    {"backend": "ent_search", "llm": "LlmProvider.GOOG_ENT_SEARCH", "answer": "...", "seconds": 1.2}
+    {"backend": "gpt", "llm": "LlmProvider.OPEN_AI", "error": "No answer within 120.0 seconds.", "seconds": 120.0}
+    All answers are queued to be saved to the user history together after the last event.
+    """
+    names = data.backends if data.backends else list(BACKENDS.keys())
+    unknown = [name for name in names if name not in BACKENDS]
+    if unknown:
+        raise ValueError(f'Unknown backends: {", ".join(unknown)}, expected some of: {", ".join(BACKENDS.keys())}')
+    user_id = _get_user_id(x_goog_authenticated_user_email)
+
+    async def stream_answers() -> AsyncIterator[str]:
+        interactions: list[dict[str, Any]] = []
+        for next_event in asyncio.as_completed([_ask_backend(name=name, data=data) for name in names]):
+            event = await next_event
+            if 'answer' in event:
+                interactions.append(
+                    _get_interaction(data=data, answer=event['answer'], provider=BACKENDS[event['backend']].provider))
+            yield json.dumps(event) + '\n'
+        if interactions:
+            # Falls back to a synchronous Firestore write when the queue is full, so keep it off the event loop
+            await asyncio.to_thread(_interaction_writer.save_interactions, user_id=user_id, interactions=interactions)
+
+    return StreamingResponse(stream_answers(), media_type='application/x-ndjson')
+
+
+@app.post('/ask_batch', name='Ask many questions to one LLM backend and stream answers as they arrive.')
+async def ask_batch(data: AskBatchInput) -> StreamingResponse:
+    """Ask a list of questions to one backend with bounded parallelism, for offline evaluation and bulk analytics.
+
+    Returns: newline delimited JSON stream with one event per question in the order the answers arrive. For example:
+    {"index": 1, "question": "Who is Steven Kim?", "answer": "...", "seconds": 3.4}
+    {"index": 0, "question": "Who is Roman Kharkovski?", "error": "No answer within 60.0 seconds.", "seconds": 60.0}
+    Answers are not saved to the user history.
+    """
+    if data.backend not in BACKENDS:
+        raise ValueError(f'Unknown backend: {data.backend}, expected one of: {", ".join(BACKENDS.keys())}')
+    if len(data.questions) > BATCH_MAX_QUESTIONS:
+        raise ValueError(f'Too many questions: {len(data.questions)}, the maximum is {BATCH_MAX_QUESTIONS}')
+    if data.backend == 'vertexai':
+        vertexai_tools.get_retrieval_config(mode=data.retrieval_mode)
+    backend = BACKENDS[data.backend]
+    semaphore = asyncio.Semaphore(BATCH_PARALLELISM)
+
+    async def ask_question(ask: Callable[[int, str], Any], index: int, question: str) -> dict[str, Any]:
+        async with semaphore:
+            return await _add_answer(event={'index': index, 'question': question},
+                                     name=data.backend,
+                                     get_answer=lambda: asyncio.to_thread(ask, index, question),
+                                     timeout=backend.timeout)
+
+    async def stream_answers() -> AsyncIterator[str]:
+        ask = await asyncio.to_thread(_get_batch_ask, data)
+        tasks = [ask_question(ask, index, question) for index, question in enumerate(data.questions)]
+        for next_event in asyncio.as_completed(tasks):
+            yield json.dumps(await next_event) + '\n'
+
+    return StreamingResponse(stream_answers(), media_type='application/x-ndjson')
+
+
 @app.post('/vote', name='Submit user vote for the LLM answer. Returns total number of votes for all LLMs.')
 @log_params
 def vote(data: VoteInput) -> list[VoteStatistic]:
@@ -12,9 +12,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from common import constants, llamaindex_tools
+import asyncio
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from common import constants, llamaindex_tools, metrics
 from common.log import Logger, log
+from langchain.docstore.document import Document
 from query_engine import goog_search_tools
+from query_engine.concurrency_tools import AdmissionController, OverloadedError, RequestCoalescer
+from query_engine.context_tools import pack_documents
 
 logger = Logger(__name__).get_logger()
 logger.info('Initializing...')
@@ -108,6 +117,248 @@ def test_queries(query_engine) -> None:
     print('\x1b[0m')
 
 
+def _count_words(text: str) -> int:
+    return len(text.split())
+
+
+class TestPackDocuments(unittest.TestCase):
+
+    @log
+    def test_drop_duplicates(self) -> None:
+        """Test that a chunk repeating packed text, even with different line breaks, is dropped."""
+        docs = [Document(page_content='Roman knows Java and Python.'),
+                Document(page_content='Roman knows\nJava   and Python.'),
+                Document(page_content='Java and Python.'),
+                Document(page_content='Steven knows Go.')]
+        packed = pack_documents(docs, max_tokens=100, count_tokens=_count_words)
+        assert [doc.page_content for doc in packed] == ['Roman knows Java and Python.', 'Steven knows Go.']
+
+    @log
+    def test_trim_overlap(self) -> None:
+        """Test that the beginning of a chunk repeating the end of a packed chunk is cut off."""
+        overlap = 'shared text between neighboring chunks'
+        docs = [Document(page_content=f'First chunk ends with {overlap}'),
+                Document(page_content=f'{overlap} and the second chunk continues')]
+        packed = pack_documents(docs, max_tokens=100, count_tokens=_count_words)
+        assert [doc.page_content for doc in packed] == [docs[0].page_content, 'and the second chunk continues']
+
+    @log
+    def test_budget(self) -> None:
+        """Test that chunks over the budget are skipped, while later chunks that still fit are packed."""
+        docs = [Document(page_content='one two three'),
+                Document(page_content='four five six seven'),
+                Document(page_content='eight nine')]
+        packed = pack_documents(docs, max_tokens=5, count_tokens=_count_words)
+        assert [doc.page_content for doc in packed] == ['one two three', 'eight nine']
+        assert pack_documents(docs, max_tokens=2, count_tokens=_count_words) == [docs[2]]
+
+    @log
+    def test_order_by_score(self) -> None:
+        """Test that chunks are packed in the order of their score when all of them have one."""
+        docs = [Document(page_content='less relevant', metadata={'score': 0.1}),
+                Document(page_content='more relevant', metadata={'score': 0.9})]
+        packed = pack_documents(docs, max_tokens=2, count_tokens=_count_words)
+        assert [doc.page_content for doc in packed] == ['more relevant']
+
+    @log
+    def test_token_cache(self) -> None:
+        """Test that tokens of a chunk are counted once per chunk ID, unless its text changes."""
+        counted: list[str] = []
+
+        def count_tokens(text: str) -> int:
+            counted.append(text)
+            return _count_words(text)
+
+        metadata = {'source': 'resumes', 'document_name': 'roman.pdf', 'chunk': 0}
+        docs = [Document(page_content='Roman knows Java.', metadata=metadata)]
+        pack_documents(docs, max_tokens=100, count_tokens=count_tokens)
+        pack_documents(docs, max_tokens=100, count_tokens=count_tokens)
+        assert counted == ['Roman knows Java.']
+        docs = [Document(page_content='Roman knows Java and Go.', metadata=metadata)]
+        packed = pack_documents(docs, max_tokens=4, count_tokens=count_tokens)
+        assert counted == ['Roman knows Java.', 'Roman knows Java and Go.']
+        assert packed == []
+
+
+class TestRequestCoalescer(unittest.TestCase):
+
+    @log
+    def test_share_result(self) -> None:
+        """Test that concurrent requests with the same key wait for the leader and get its result."""
+        coalescer = RequestCoalescer()
+        started = threading.Event()
+        release = threading.Event()
+        calls: list[str] = []
+
+        def answer(question: str) -> str:
+            calls.append(question)
+            started.set()
+            assert release.wait(timeout=10)
+            return f'answer to {question}'
+
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            leader = executor.submit(coalescer.run, 'key', answer, 'question')
+            assert started.wait(timeout=10)
+            followers = [executor.submit(coalescer.run, 'key', answer, 'question') for _ in range(2)]
+            while coalescer.followers < 2:
+                time.sleep(0.01)
+            release.set()
+            results = [future.result(timeout=10) for future in [leader] + followers]
+        assert results == ['answer to question'] * 3
+        assert calls == ['question']
+        assert (coalescer.leaders, coalescer.followers) == (1, 2)
+
+    @log
+    def test_propagate_error(self) -> None:
+        """Test that the error of the leader is raised to the followers and the next request runs again."""
+        coalescer = RequestCoalescer()
+        started = threading.Event()
+        release = threading.Event()
+
+        def fail() -> str:
+            started.set()
+            assert release.wait(timeout=10)
+            raise ValueError('backend failed')
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            leader = executor.submit(coalescer.run, 'key', fail)
+            assert started.wait(timeout=10)
+            follower = executor.submit(coalescer.run, 'key', fail)
+            while coalescer.followers < 1:
+                time.sleep(0.01)
+            release.set()
+            for future in (leader, follower):
+                with self.assertRaises(ValueError):
+                    future.result(timeout=10)
+        assert coalescer.run('key', lambda: 'recovered') == 'recovered'
+        assert coalescer.leaders == 2
+
+    @log
+    def test_share_result_async(self) -> None:
+        """Test that concurrent coroutines with the same key await the leader and get its result."""
+        coalescer = RequestCoalescer()
+        calls: list[str] = []
+
+        async def answer(question: str) -> str:
+            calls.append(question)
+            await asyncio.sleep(0.05)
+            return f'answer to {question}'
+
+        async def ask_all() -> list[str]:
+            return await asyncio.gather(*[coalescer.run_async('key', answer, 'question') for _ in range(3)])
+
+        assert asyncio.run(ask_all()) == ['answer to question'] * 3
+        assert calls == ['question']
+        assert (coalescer.leaders, coalescer.followers) == (1, 2)
+
+    @log
+    def test_different_keys(self) -> None:
+        """Test that requests with different keys do not wait for each other."""
+        coalescer = RequestCoalescer()
+        assert coalescer.run('a', lambda: 1) == 1
+        assert coalescer.run('b', lambda: 2) == 2
+        assert (coalescer.leaders, coalescer.followers) == (2, 0)
+
+
+class TestAdmissionController(unittest.TestCase):
+
+    @log
+    def test_reject_when_queue_full(self) -> None:
+        """Test that a request is rejected right away when all slots are taken and the queue is full."""
+        controller = AdmissionController(name='test', max_concurrency=1, max_queue=0, queue_timeout=10)
+        with controller.admit():
+            start = time.monotonic()
+            with self.assertRaises(OverloadedError):
+                with controller.admit():
+                    pass
+            assert time.monotonic() - start < 1
+        stats = controller.get_stats()
+        assert (stats['admitted'], stats['rejected'], stats['running'], stats['waiting']) == (1, 1, 0, 0)
+
+    @log
+    def test_reject_after_timeout(self) -> None:
+        """Test that a queued request is rejected when it does not get a slot within the queue timeout."""
+        controller = AdmissionController(name='test', max_concurrency=1, max_queue=1, queue_timeout=0.1)
+        with controller.admit():
+            with self.assertRaises(OverloadedError):
+                with controller.admit():
+                    pass
+        stats = controller.get_stats()
+        assert (stats['admitted'], stats['rejected'], stats['waiting']) == (1, 1, 0)
+        with controller.admit():
+            assert controller.get_stats()['running'] == 1
+
+    @log
+    def test_admit_queued_request(self) -> None:
+        """Test that a queued request starts as soon as the running one releases its slot."""
+        controller = AdmissionController(name='queued', max_concurrency=1, max_queue=1, queue_timeout=10)
+        release = threading.Event()
+
+        def hold_slot() -> None:
+            with controller.admit():
+                assert release.wait(timeout=10)
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            holder = executor.submit(hold_slot)
+            while controller.get_stats()['running'] < 1:
+                time.sleep(0.01)
+            threading.Timer(0.1, release.set).start()
+            with controller.admit():
+                assert controller.get_stats()['admitted'] == 2
+            holder.result(timeout=10)
+        assert controller.get_stats()['max_wait_seconds'] > 0
+        assert 'backend_queue_wait_seconds_count{backend="queued"} 2' in metrics.REGISTRY.expose()
+
+    @log
+    def test_admit_async_without_threads(self) -> None:
+        """Test that requests queued by `admit_async` wait in the event loop and start as slots are released."""
+        controller = AdmissionController(name='test', max_concurrency=1, max_queue=5, queue_timeout=10)
+        order: list[int] = []
+
+        async def ask(index: int) -> None:
+            async with controller.admit_async():
+                order.append(index)
+                await asyncio.sleep(0.01)
+
+        async def ask_all() -> int:
+            tasks = [asyncio.create_task(ask(index)) for index in range(5)]
+            while controller.get_stats()['waiting'] < 4:
+                await asyncio.sleep(0.001)
+            threads = threading.active_count()
+            await asyncio.gather(*tasks)
+            return threads
+
+        threads_before = threading.active_count()
+        assert asyncio.run(asyncio.wait_for(ask_all(), timeout=10)) == threads_before
+        assert sorted(order) == list(range(5))
+        stats = controller.get_stats()
+        assert (stats['admitted'], stats['rejected'], stats['running'], stats['waiting']) == (5, 0, 0, 0)
+
+    @log
+    def test_cancel_waiting_request(self) -> None:
+        """Test that cancelling a request waiting for a slot in `admit_async` does not leak the slot."""
+        controller = AdmissionController(name='test', max_concurrency=1, max_queue=1, queue_timeout=10)
+
+        async def wait_for_slot() -> None:
+            async with controller.admit_async():
+                pass
+
+        async def cancel_while_waiting() -> None:
+            with controller.admit():
+                waiter = asyncio.create_task(wait_for_slot())
+                while controller.get_stats()['waiting'] < 1:
+                    await asyncio.sleep(0.01)
+                waiter.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await waiter
+            # The slot is given back once the cancelled waiter's thread acquires it
+            async with controller.admit_async():
+                assert controller.get_stats()['running'] == 1
+
+        asyncio.run(asyncio.wait_for(cancel_while_waiting(), timeout=10))
+        assert controller.get_stats()['running'] == 0
+
+
 @log
 def main():
     """Main function of the app."""
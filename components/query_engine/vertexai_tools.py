@@ -19,17 +19,23 @@ This code is based on the following Google Cloud Platform example:
 https://github.com/GoogleCloudPlatform/generative-ai/blob/main/language/use-cases/document-qa/question_answering_documents_langchain_matching_engine.ipynb
 """
 
-import textwrap
+import re
+from typing import Any
 
-from common import solution
+from common import admin_dao, gcs_tools, llamaindex_tools, metrics, solution
+from common.cache import cache
+from common.engine_registry import EngineRegistry
 from common.log import Logger, log
+from common.matching_engine import CustomVertexAIEmbeddings, MatchingEngine
+from common.matching_engine_tools import MatchingEngineUtils
+from context_tools import CONTEXT_TOKEN_BUDGET, ContextPackingRetriever, pack_documents
 # import vertexai
 from google.cloud import aiplatform
 from langchain.chains import RetrievalQA
+from langchain.docstore.document import Document
 from langchain.llms import VertexAI  # type: ignore
 from langchain.prompts import PromptTemplate
-from matching_engine import CustomVertexAIEmbeddings, MatchingEngine
-from matching_engine_tools import MatchingEngineUtils
+from pydantic import BaseModel
 
 logger = Logger(__name__).get_logger()
 logger.info('Initializing...')
@@ -59,79 +65,50 @@ NUMBER_OF_RESULTS = 20
 """Number of results to return from the Matching Engine."""
 SEARCH_DISTANCE_THRESHOLD = 0.6
 """Search distance threshold for the Matching Engine."""
+DOCUMENT_NAME_NAMESPACE: str = 'document_name'
+"""Matching Engine restrict namespace that holds the resume file name of each datapoint (see `vertexai_setup.py`)."""
 
 
-logger.debug('Vertex AI SDK version: %s', aiplatform.__version__)
+class RetrievalConfig(BaseModel):
+    """Matching Engine retrieval parameters for a single request."""
+    k: int = NUMBER_OF_RESULTS
+    """Number of results to return from the Matching Engine."""
+    search_distance: float = SEARCH_DISTANCE_THRESHOLD
+    """Search distance threshold for the Matching Engine."""
+    filters: list[dict] | None = None
+    """Namespace restricts for the search, if None they are derived from the question (see `_get_person_filters`)."""
+    max_context_tokens: int = CONTEXT_TOKEN_BUDGET
+    """Maximum number of tokens of retrieved context to put into the prompt."""
 
+    def get_search_kwargs(self) -> dict[str, Any]:
+        """Return keyword arguments for `MatchingEngine.similarity_search`."""
+        return {'k': self.k, 'search_distance': self.search_distance, 'filters': self.filters}
 
-def _formatter(result):
-    """Utility function to format the result."""
-    print(f'Query: {result["query"]}')
-    print('.' * 80)
-    if 'source_documents' in result.keys():
-        for idx, ref in enumerate(result['source_documents']):
-            print('-' * 80)
-            print(f'REFERENCE #{idx}')
-            print('-' * 80)
-            if 'score' in ref.metadata:
-                print(f'Matching Score: {ref.metadata["score"]}')
-            if 'source' in ref.metadata:
-                print(f'Document Source: {ref.metadata["source"]}')
-            if 'document_name' in ref.metadata:
-                print(f'Document Name: {ref.metadata["document_name"]}')
-            print('.' * 80)
-            print(f'Content: \n{_wrap(ref.page_content)}')
-    print('.' * 80)
-    print(f'Response: {_wrap(result["result"])}')
-    print('.' * 80)
-
-
-def _wrap(s):
-    return '\n'.join(textwrap.wrap(s, width=120, break_long_words=False))
 
+RETRIEVAL_MODES: dict[str, RetrievalConfig] = {
+    'fast': RetrievalConfig(k=5, max_context_tokens=1500),
+    'default': RetrievalConfig(),
+    'thorough': RetrievalConfig(k=40, search_distance=0.5, max_context_tokens=6000),
+}
+"""Named sets of retrieval parameters that can be selected by API clients."""
 
-# vertexai.init(project=PROJECT_ID, location=REGION)
+DEFAULT_RETRIEVAL_MODE: str = 'default'
+"""Retrieval mode used when the client does not ask for a specific one."""
 
-logger.debug('Initialize VertexAI LangChain Models...')
-_llm = VertexAI(
-    model_name='text-bison@001',
-    max_output_tokens=1024,
-    temperature=TEMPERATURE,
-    top_p=TOP_P,
-    top_k=TOP_K,
-    verbose=True,
-)
-
-logger.debug('Creating custom embeddings class...')
-_embeddings = CustomVertexAIEmbeddings(requests_per_minute=EMBEDDING_QPM)
-
-logger.debug('Creating matching engine utils...')
-_mengine = MatchingEngineUtils(project_id=PROJECT_ID, region=ME_REGION, index_name=ME_INDEX_NAME)
-ME_INDEX_ID, ME_INDEX_ENDPOINT_ID = _mengine.get_index_and_endpoint()
-
-# Initialize Matching Engine vector store with text embeddings model
-_me = MatchingEngine.from_components(
-    project_id=PROJECT_ID,
-    region=ME_REGION,
-    gcs_bucket_name=f'gs://{ME_EMBEDDING_BUCKET}'.split('/')[2],
-    embedding=_embeddings,
-    index_id=ME_INDEX_ID,
-    endpoint_id=ME_INDEX_ENDPOINT_ID,
-)
 
+logger.debug('Vertex AI SDK version: %s', aiplatform.__version__)
 
-"""
-LangChain provides easy ways to chain multiple tasks that can do QA over a set of documents, called QA chains. The notebook works with [**RetrievalQA**](https://python.langchain.com/en/latest/modules/chains/index_examples/vector_db_qa.html) chain which is based on **load_qa_chain** under the hood.
-"""
 
-# Expose index to the retriever
-_retriever = _me.as_retriever(
-    search_type='similarity',
-    search_kwargs={
-        'k': NUMBER_OF_RESULTS,
-        'search_distance': SEARCH_DISTANCE_THRESHOLD,
-    },
-)
+def _formatter(result):
+    """Log the question, the retrieved references and the answer for debugging."""
+    logger.debug('Query: %s', result['query'])
+    for idx, ref in enumerate(result.get('source_documents', [])):
+        logger.debug('Reference #%s: score=%s, source=%s, document=%s\n%s', idx, ref.metadata.get('score'),
+                     ref.metadata.get('source'), ref.metadata.get('document_name'), ref.page_content)
+    logger.debug('Response: %s', result['result'])
+
+
+# vertexai.init(project=PROJECT_ID, location=REGION)
 
 # Customize the default retrieval prompt template
 template = """SYSTEM: You are an intelligent assistant answering questions about people and their skills from their resumes.
@@ -142,31 +119,175 @@ Use the following pieces of context to answer the question at the end. Do not tr
 Question: {question}
 Helpful Answer:"""
 
-# Configure RetrievalQA chain. Uses LLM to synthesize results from the search index.
-_qa = RetrievalQA.from_chain_type(
-    llm=_llm,
-    chain_type='stuff',
-    retriever=_retriever,
-    return_source_documents=True,
-    verbose=True,
-    chain_type_kwargs={
-        'prompt': PromptTemplate(
-            template=template,
-            input_variables=['context', 'question'],
-        ),
-    },
-)
-
-# Enable verbose logging for debugging and troubleshooting the chains which includes the complete prompt to the LLM
-_qa.combine_documents_chain.verbose = True
-_qa.combine_documents_chain.llm_chain.verbose = True  # type: ignore
-_qa.combine_documents_chain.llm_chain.llm.verbose = True  # type: ignore
 
 @log
-def query(question: str, qa=_qa, k=NUMBER_OF_RESULTS, search_distance=SEARCH_DISTANCE_THRESHOLD) -> str:
-    """Ask a question to the Vertex PaLM model. This is main exposed method of this module."""
-    qa.retriever.search_kwargs['search_distance'] = search_distance
-    qa.retriever.search_kwargs['k'] = k
-    result = qa({'query': question})
+def _create_qa() -> RetrievalQA:
+    """Create Vertex AI clients, look up the Matching Engine index and endpoint, and build the retrieval chain."""
+    logger.debug('Initialize VertexAI LangChain Models...')
+    llm = VertexAI(
+        model_name='text-bison@001',
+        max_output_tokens=1024,
+        temperature=TEMPERATURE,
+        top_p=TOP_P,
+        top_k=TOP_K,
+        verbose=True,
+    )
+
+    logger.debug('Creating custom embeddings class...')
+    embeddings = CustomVertexAIEmbeddings(requests_per_minute=EMBEDDING_QPM)
+
+    logger.debug('Creating matching engine utils...')
+    mengine = MatchingEngineUtils(project_id=PROJECT_ID, region=ME_REGION, index_name=ME_INDEX_NAME)
+    me_index_id, me_index_endpoint_id = mengine.get_index_and_endpoint()
+
+    # Initialize Matching Engine vector store with text embeddings model
+    me = MatchingEngine.from_components(
+        project_id=PROJECT_ID,
+        region=ME_REGION,
+        gcs_bucket_name=f'gs://{ME_EMBEDDING_BUCKET}'.split('/')[2],
+        embedding=embeddings,
+        index_id=me_index_id,
+        endpoint_id=me_index_endpoint_id,
+    )
+
+    # LangChain provides easy ways to chain multiple tasks that can do QA over a set of documents, called QA chains.
+    # We use RetrievalQA chain which is based on load_qa_chain under the hood:
+    # https://python.langchain.com/en/latest/modules/chains/index_examples/vector_db_qa.html
+
+    # Expose index to the retriever
+    retriever = me.as_retriever(
+        search_type='similarity',
+        search_kwargs={
+            'k': NUMBER_OF_RESULTS,
+            'search_distance': SEARCH_DISTANCE_THRESHOLD,
+        },
+    )
+
+    # Configure RetrievalQA chain. Uses LLM to synthesize results from the search index.
+    qa = RetrievalQA.from_chain_type(
+        llm=llm,
+        chain_type='stuff',
+        retriever=retriever,
+        return_source_documents=True,
+        verbose=True,
+        chain_type_kwargs={
+            'prompt': PromptTemplate(
+                template=template,
+                input_variables=['context', 'question'],
+            ),
+        },
+    )
+
+    # Enable verbose logging for debugging and troubleshooting the chains which includes the complete prompt to the LLM
+    qa.combine_documents_chain.verbose = True
+    qa.combine_documents_chain.llm_chain.verbose = True  # type: ignore
+    qa.combine_documents_chain.llm_chain.llm.verbose = True  # type: ignore
+    return qa
+
+
+ENGINE_REGISTRY = EngineRegistry(name='vertexai', builder=_create_qa)
+"""Versioned retrieval chain snapshots. Created on first use or by `warm_up()` to keep network calls out of the module
+import, and recreated in the background (with fresh index and endpoint lookup) when resumes are updated."""
+
+
+def _get_qa() -> RetrievalQA:
+    """Return the current retrieval chain, creating it on first use."""
+    return ENGINE_REGISTRY.get(version=admin_dao.get_resumes_version()).engine
+
+
+def warm_up() -> None:
+    """Start creating the Vertex AI clients in a background thread so that the service can start serving right away."""
+    ENGINE_REGISTRY.warm_up(get_version=admin_dao.get_resumes_version)
+
+
+def is_ready() -> bool:
+    """Return True if the Vertex AI backend has been initialized and can answer questions without a delay."""
+    return ENGINE_REGISTRY.current() is not None
+
+
+@cache
+@log
+def _get_document_names() -> dict[str, list[str]]:
+    """Map lower case person names to the resume file names used as `document_name` restricts in the index."""
+    document_names: dict[str, list[str]] = {}
+    for blob_name in gcs_tools.list_blob_names(bucket_name=SOURCE_PDF_BUCKET):
+        person_name = llamaindex_tools.get_person_name(blob_name).lower()
+        if person_name:
+            document_names.setdefault(person_name, []).append(blob_name.split('/')[-1])
+    return document_names
+
+
+@log
+def _get_person_filters(question: str) -> list[dict] | None:
+    """Restrict the search to a single resume if the question names exactly one known person, otherwise return None."""
+    question = question.lower()
+    people = [person_name for person_name in _get_document_names().keys()
+              if re.search(rf'\b{re.escape(person_name)}\b', question)]
+    if len(people) != 1:
+        return None
+    logger.debug('Restricting the search to the resume of: %s', people[0])
+    return [{'namespace': DOCUMENT_NAME_NAMESPACE, 'allow_list': _get_document_names()[people[0]]}]
+
+
+@log
+def get_retrieval_config(mode: str | None = None) -> RetrievalConfig:
+    """Return retrieval parameters for the named mode (see `RETRIEVAL_MODES`)."""
+    if mode is None:
+        mode = DEFAULT_RETRIEVAL_MODE
+    if mode not in RETRIEVAL_MODES:
+        raise ValueError(f'Unknown retrieval mode "{mode}", expected one of: {", ".join(RETRIEVAL_MODES.keys())}')
+    return RETRIEVAL_MODES[mode]
+
+
+@log
+def query(question: str, config: RetrievalConfig | None = None, qa: RetrievalQA | None = None) -> str:
+    """Ask a question to the Vertex PaLM model. This is main exposed method of this module.
+
+    Retrieval parameters are applied to a retriever created for this request only, so concurrent requests with
+    different parameters never see each other's settings. The LLM chain itself is shared and stateless.
+    """
+    if qa is None:
+        qa = _get_qa()
+    if config is None:
+        config = get_retrieval_config()
+    if config.filters is None:
+        config = config.copy(update={'filters': _get_person_filters(question)})
+    retriever = ContextPackingRetriever(
+        retriever=qa.retriever.vectorstore.as_retriever(search_type='similarity',  # type: ignore
+                                                        search_kwargs=config.get_search_kwargs()),
+        max_tokens=config.max_context_tokens)
+    # Same steps as RetrievalQA, done one by one so that retrieval and the LLM call are timed separately
+    docs = retriever.get_relevant_documents(question)
+    result = {'query': question, 'result': answer(question=question, docs=docs, qa=qa), 'source_documents': docs}
     _formatter(result)
     return str(result['result'])
+
+
+@log
+@metrics.STAGE_SECONDS.time('retrieval')
+def retrieve_batch(questions: list[str],
+                   config: RetrievalConfig | None = None,
+                   qa: RetrievalQA | None = None) -> list[list[Document]]:
+    """Retrieve and pack context for many questions, sharing one embeddings pass and one Matching Engine call.
+
+    Returns:
+        Packed context for each of the questions, in the same order as the questions.
+    """
+    if qa is None:
+        qa = _get_qa()
+    if config is None:
+        config = get_retrieval_config()
+    filters = [config.filters if config.filters is not None else _get_person_filters(question)
+               for question in questions]
+    results = qa.retriever.vectorstore.similarity_search_batch(  # type: ignore
+        questions, k=config.k, search_distance=config.search_distance, filters=filters)
+    return [pack_documents(docs=docs, max_tokens=config.max_context_tokens) for docs in results]
+
+
+@log
+@metrics.STAGE_SECONDS.time('llm')
+def answer(question: str, docs: list[Document], qa: RetrievalQA | None = None) -> str:
+    """Ask a question to the Vertex PaLM model using context retrieved in advance by `retrieve_batch`."""
+    if qa is None:
+        qa = _get_qa()
+    return str(qa.combine_documents_chain.run(input_documents=docs, question=question))
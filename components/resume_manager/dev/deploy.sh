@@ -64,10 +64,13 @@ deploy() {
     --project "${PROJECT_ID}"
     --set-env-vars "PROJECT_ID=${PROJECT_ID}"
     --set-env-vars "LOG_LEVEL=${LOG_LEVEL}"
+    --set-env-vars "LOG_FORMAT=json"
     --set-env-vars "OPENAI_API_KEY=${OPENAI_API_KEY}"
     --set-env-vars "EMBEDDINGS_BUCKET_NAME=${EMBEDDINGS_BUCKET_NAME}"
     --allow-unauthenticated
     --ingress internal
+    --no-cpu-throttling
+    --max-instances 1
   )
 
   log "Deploying Cloud Run service [${RESUME_SVC_NAME}]..."
@@ -0,0 +1,526 @@
+# Copyright 2023 Qarik Group, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Ingestion pipeline that parses each changed resume once and fans out its chunks to every enabled index backend.
+
+Typical usage:
+    pipeline = IngestionPipeline(backends=create_backends(INGESTION_BACKENDS))
+    result = pipeline.run(bucket_name='resumes', resume_names=['John Doe.pdf'], progress=job.backends)
+
+Each backend reports the MD5 hash of every resume it has indexed, so only new and changed resumes are parsed and
+embedded, and a backend that failed in a previous run catches up without redoing the work of the others.
+
+The Chroma and Matching Engine backends import their dependencies only when they are created. Install
+`requirements-backends.txt` (see `Dockerfile`) to enable them.
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, NamedTuple
+
+from common import constants, gcs_tools, llamaindex_tools, solution, tracing
+from common.log import Logger, log
+from google.api_core import exceptions
+from google.cloud import storage
+from langchain.docstore.document import Document
+from langchain.document_loaders import PyPDFLoader
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from llama_index import Document as LlamaDocument
+from rebuild_queue import BackendProgress, JobState
+
+logger = Logger(__name__).get_logger()
+logger.info('Initializing...')
+
+INGESTION_BACKENDS: list[str] = [name.strip() for name in solution.getenv('INGESTION_BACKENDS', 'llamaindex').split(',')
+                                 if name.strip()]
+"""Comma separated names of the index backends to keep in sync with the resumes (see `BACKENDS`)."""
+
+INGESTION_ATTEMPTS: int = int(solution.getenv('INGESTION_ATTEMPTS', '3'))
+"""How many times to call a backend for the same resume before giving up on the backend for this run."""
+
+INGESTION_RETRY_DELAY: float = float(solution.getenv('INGESTION_RETRY_DELAY', '2'))
+"""Seconds to wait before the first retry of a failed backend call, doubled after each failed attempt."""
+
+RESUME_DIR: str = 'tmp/ingestion'
+"""Location to download resume PDF files to while they are parsed."""
+
+CHROMA_BUCKET_NAME: str = solution.getenv('CHROMA_BUCKET_NAME', '')
+"""GCS bucket to publish the Chroma collection to. The query engine reads it from there (see `langchain_tools.py`)."""
+
+CHROMA_INDEX_DIR: str = 'tmp/chroma-index'
+"""Location of the persistent Chroma collection on the local disk."""
+
+CHROMA_COLLECTION_NAME: str = f'{solution.RESOURCE_PREFIX}_resumes'
+"""Name of the Chroma collection with resume chunks. Must be the same as in the query engine."""
+
+ME_INDEX_NAME: str = f'{solution.PROJECT_ID}-me-index'
+"""Matching Engine index name."""
+
+ME_EMBEDDING_BUCKET: str = solution.getenv('ME_EMBEDDING_BUCKET', f'matching-engine-embeddings-{solution.PROJECT_ID}')
+"""GCS bucket where Matching Engine stores the text of the indexed chunks."""
+
+EMBEDDING_QPM: int = 100
+"""Rate limit for calling Google VertexAI embeddings API."""
+
+RESUME_METADATA_KEY: str = 'resume'
+"""Chunk metadata key with the name of the source resume file."""
+
+RESUME_HASH_METADATA_KEY: str = 'resume_hash'
+"""Chunk metadata key with the MD5 hash of the source resume file the chunk was created from."""
+
+
+class ChunkingConfig(NamedTuple):
+    """How to split resume pages into chunks. Backends with the same config share the chunks."""
+    chunk_size: int
+    chunk_overlap: int
+    separators: tuple[str, ...] | None = None
+
+
+CHROMA_CHUNKING = ChunkingConfig(chunk_size=2500, chunk_overlap=0)
+"""Chunks of the Chroma collection, the same as the query engine uses when it builds the collection itself."""
+
+MATCHING_ENGINE_CHUNKING = ChunkingConfig(chunk_size=1000, chunk_overlap=50,
+                                          separators=('\n\n', '\n', '.', '!', '?', ',', ' ', ''))
+"""Chunks of the Matching Engine index, the same as `setup/vertexai_setup.py` uses."""
+
+
+class ParsedResume(NamedTuple):
+    """Text of a resume extracted from the PDF file, one document per page."""
+    name: str
+    md5: str
+    pages: list[Document]
+
+
+class IngestionResult(NamedTuple):
+    """Outcome of a pipeline run."""
+    changed: bool
+    """True if any backend published changes."""
+    errors: list[str]
+    """Description of each backend or resume that failed."""
+
+
+class IndexBackend:
+    """Index that the pipeline keeps in sync with the resumes. Calls of one backend never overlap."""
+    name: str = ''
+    chunking: ChunkingConfig | None = None
+    """How to split the resumes for this backend, or None if the backend splits the pages itself."""
+
+    def open(self) -> None:
+        """Prepare the local copy of the index, if any. Called at the start of every run."""
+
+    def needs_full_sync(self) -> bool:
+        """Return True if the backend must be compared with all resumes, even if the run names only some of them.
+
+        Backends that publish a local copy as a whole return True until the first copy is published, so that the first
+        published version is not limited to the resumes named in one event.
+        """
+        return False
+
+    def get_indexed_hashes(self) -> dict[str, str]:
+        """Return MD5 hashes of the indexed resumes keyed by resume name."""
+        raise NotImplementedError
+
+    def upsert(self, resume: ParsedResume, chunks: list[Document]) -> None:
+        """Replace the resume in the index with the new chunks."""
+        raise NotImplementedError
+
+    def delete(self, resume_name: str) -> None:
+        """Remove the resume from the index."""
+        raise NotImplementedError
+
+    def publish(self, resume_names: list[str], full: bool) -> None:
+        """Make the changes of the resumes visible to the query engine.
+
+        Args:
+            resume_names: Resumes that were added, changed or removed in this run.
+            full: All resumes were compared with the index, rather than only the ones named in the events.
+        """
+
+
+class LlamaIndexBackend(IndexBackend):
+    """Per-person llama-index vector indices published to the embeddings bucket."""
+    name = 'llamaindex'
+
+    def __init__(self) -> None:
+        self._synced = False
+
+    def open(self) -> None:
+        # The local copy is authoritative once synced, since only one rebuild runs at a time
+        if not self._synced and gcs_tools.is_published(llamaindex_tools.INDEX_BUCKET):
+            gcs_tools.download(bucket_name=llamaindex_tools.INDEX_BUCKET, local_dir=llamaindex_tools.LLAMA_INDEX_DIR)
+        self._synced = True
+
+    def needs_full_sync(self) -> bool:
+        return not gcs_tools.is_published(llamaindex_tools.INDEX_BUCKET)
+
+    def get_indexed_hashes(self) -> dict[str, str]:
+        return llamaindex_tools.get_indexed_resumes()
+
+    def upsert(self, resume: ParsedResume, chunks: list[Document]) -> None:
+        pages = [LlamaDocument(text=page.page_content,
+                               metadata={'file_name': resume.name, 'page_label': str(page.metadata.get('page', 0) + 1)})
+                 for page in resume.pages]
+        # TODO - need to generate proper embeddings for each provider, not hard coded
+        llamaindex_tools.update_person_embeddings(resume_name=resume.name, resume_hash=resume.md5, pages=pages,
+                                                  provider=constants.LlmProvider.OPEN_AI)
+
+    def delete(self, resume_name: str) -> None:
+        llamaindex_tools.delete_person_embeddings(person_name=llamaindex_tools.get_person_name(resume_name))
+
+    def publish(self, resume_names: list[str], full: bool) -> None:
+        if full:
+            gcs_tools.upload(bucket_name=llamaindex_tools.INDEX_BUCKET, local_dir=llamaindex_tools.LLAMA_INDEX_DIR,
+                             bundle=True)
+        else:
+            people = sorted({llamaindex_tools.get_person_name(name) for name in resume_names})
+            gcs_tools.publish_fragment(bucket_name=llamaindex_tools.INDEX_BUCKET,
+                                       local_dir=llamaindex_tools.LLAMA_INDEX_DIR, sub_dirs=people, bundle=True)
+
+
+class ChromaBackend(IndexBackend):
+    """Persistent Chroma collection published to `CHROMA_BUCKET_NAME` as a whole."""
+    name = 'chroma'
+    chunking = CHROMA_CHUNKING
+
+    def __init__(self) -> None:
+        if not CHROMA_BUCKET_NAME:
+            raise ValueError('CHROMA_BUCKET_NAME must be set to ingest resumes into Chroma.')
+        self._db: Any = None
+        """Chroma vector store of langchain."""
+
+    def open(self) -> None:
+        # Imported here rather than at the top, so that chromadb is only required when the backend is enabled
+        from langchain.embeddings import VertexAIEmbeddings  # type: ignore
+        from langchain.vectorstores import Chroma
+
+        if self._db is None:
+            if gcs_tools.is_published(CHROMA_BUCKET_NAME):
+                gcs_tools.download(bucket_name=CHROMA_BUCKET_NAME, local_dir=CHROMA_INDEX_DIR)
+            self._db = Chroma(collection_name=CHROMA_COLLECTION_NAME,
+                              embedding_function=VertexAIEmbeddings(),
+                              persist_directory=CHROMA_INDEX_DIR)
+
+    def needs_full_sync(self) -> bool:
+        return not gcs_tools.is_published(CHROMA_BUCKET_NAME)
+
+    def get_indexed_hashes(self) -> dict[str, str]:
+        return {metadata[RESUME_METADATA_KEY]: metadata[RESUME_HASH_METADATA_KEY]
+                for metadata in self._get_db().get(include=['metadatas'])['metadatas']}
+
+    def upsert(self, resume: ParsedResume, chunks: list[Document]) -> None:
+        # Ids are derived from the resume name, since resumes of different people may have identical files
+        from common.matching_engine import make_datapoint_id
+
+        self.delete(resume.name)
+        if chunks:
+            # it may take a while since API is rate limited
+            self._get_db().add_documents(documents=chunks,
+                                         ids=[make_datapoint_id(resume.name, i) for i in range(len(chunks))])
+
+    def delete(self, resume_name: str) -> None:
+        ids = self._get_db().get(where={RESUME_METADATA_KEY: resume_name})['ids']
+        if ids:
+            self._get_db().delete(ids=ids)
+
+    def publish(self, resume_names: list[str], full: bool) -> None:
+        self._get_db().persist()
+        gcs_tools.upload(bucket_name=CHROMA_BUCKET_NAME, local_dir=CHROMA_INDEX_DIR, bundle=True)
+
+    def _get_db(self) -> Any:
+        if self._db is None:
+            raise RuntimeError('Chroma collection is not open.')
+        return self._db
+
+
+class MatchingEngineBackend(IndexBackend):
+    """Vertex AI Matching Engine index with streaming updates, visible to queries as soon as they are upserted.
+
+    Datapoints have deterministic ids (see `make_datapoint_id`), and the hash and number of chunks of each resume are
+    saved in the Matching Engine bucket, so that a changed resume replaces its datapoints and drops the extra ones.
+    """
+    name = 'matching_engine'
+    chunking = MATCHING_ENGINE_CHUNKING
+
+    def __init__(self) -> None:
+        self._me: Any = None
+        """`MatchingEngine` vector store."""
+        self._ingested: dict[str, dict[str, Any]] = {}
+
+    def open(self) -> None:
+        # Imported here rather than at the top, so that the Vertex AI SDK is only required when the backend is enabled
+        from common.matching_engine import CustomVertexAIEmbeddings, MatchingEngine
+        from common.matching_engine_tools import MatchingEngineUtils
+
+        if self._me is None:
+            me_index_id, me_index_endpoint_id = MatchingEngineUtils(
+                project_id=solution.PROJECT_ID, region=solution.REGION,
+                index_name=ME_INDEX_NAME).get_index_and_endpoint()
+            self._me = MatchingEngine.from_components(
+                project_id=solution.PROJECT_ID,
+                region=solution.REGION,
+                gcs_bucket_name=ME_EMBEDDING_BUCKET,
+                embedding=CustomVertexAIEmbeddings(requests_per_minute=EMBEDDING_QPM),
+                index_id=me_index_id,
+                endpoint_id=me_index_endpoint_id,
+            )
+        self._ingested = self._load_ingested()
+
+    def get_indexed_hashes(self) -> dict[str, str]:
+        return {name: ingested['resume_hash'] for name, ingested in self._ingested.items()}
+
+    def upsert(self, resume: ParsedResume, chunks: list[Document]) -> None:
+        from common.matching_engine import make_datapoint_id
+
+        metadatas = [[{'namespace': 'source', 'allow_list': [chunk.metadata['source']]},
+                      {'namespace': 'document_name', 'allow_list': [chunk.metadata['document_name']]},
+                      {'namespace': 'chunk', 'allow_list': [str(chunk.metadata['chunk'])]}]
+                     for chunk in chunks]
+        ids = [make_datapoint_id(resume.name, i) for i in range(len(chunks))]
+        me = self._get_me()
+        if chunks:
+            me.add_texts(texts=[chunk.page_content for chunk in chunks], metadatas=metadatas, ids=ids)
+        me.delete(ids=[make_datapoint_id(resume.name, i)
+                       for i in range(len(chunks), self._ingested.get(resume.name, {}).get('chunks', 0))])
+        self._ingested[resume.name] = {'resume_hash': resume.md5, 'chunks': len(chunks)}
+        self._save_ingested()
+
+    def delete(self, resume_name: str) -> None:
+        from common.matching_engine import make_datapoint_id
+
+        chunks = self._ingested.get(resume_name, {}).get('chunks', 0)
+        self._get_me().delete(ids=[make_datapoint_id(resume_name, i) for i in range(chunks)])
+        self._ingested.pop(resume_name, None)
+        self._save_ingested()
+
+    def _get_me(self) -> Any:
+        if self._me is None:
+            raise RuntimeError('Matching Engine is not open.')
+        return self._me
+
+    def _get_ingested_blob(self) -> storage.Blob:
+        from common.matching_engine import ME_INGESTED_RESUMES
+
+        return storage.Client().bucket(ME_EMBEDDING_BUCKET).blob(ME_INGESTED_RESUMES)
+
+    def _load_ingested(self) -> dict[str, dict[str, Any]]:
+        try:
+            return json.loads(self._get_ingested_blob().download_as_bytes())
+        except exceptions.NotFound:
+            return {}
+
+    def _save_ingested(self) -> None:
+        self._get_ingested_blob().upload_from_string(json.dumps(self._ingested), content_type='application/json')
+
+
+BACKENDS: dict[str, Callable[[], IndexBackend]] = {
+    LlamaIndexBackend.name: LlamaIndexBackend,
+    ChromaBackend.name: ChromaBackend,
+    MatchingEngineBackend.name: MatchingEngineBackend,
+}
+"""Index backends that can be enabled with `INGESTION_BACKENDS`."""
+
+
+def create_backends(names: list[str]) -> list[IndexBackend]:
+    """Create the named index backends."""
+    unknown = [name for name in names if name not in BACKENDS]
+    if unknown:
+        raise ValueError(f'Unknown ingestion backends: {", ".join(unknown)}, expected: {", ".join(BACKENDS.keys())}')
+    return [BACKENDS[name]() for name in names]
+
+
+class _BackendPlan(NamedTuple):
+    """Changes to apply to one backend in a run."""
+    deletes: list[str]
+    upserts: list[str]
+    full: bool
+    """All resumes were compared with the backend."""
+
+
+class IngestionPipeline:
+    """Keep all index backends in sync with the resume PDF files in a GCS bucket."""
+
+    def __init__(self, backends: list[IndexBackend]) -> None:
+        """Initialize the pipeline.
+
+        Args:
+            backends: Index backends to update, in parallel with each other.
+        """
+        self._backends = backends
+        self._lock = threading.Lock()
+        """Serialize runs, since backends keep local state."""
+
+    @log
+    def run(self, bucket_name: str, resume_names: list[str] | None,
+            progress: dict[str, BackendProgress]) -> IngestionResult:
+        """Bring every backend in sync with the resumes in the bucket.
+
+        Args:
+            bucket_name: GCS bucket with the resumes.
+            resume_names: Resumes to compare with the backends, or None to compare all of them. Named resumes that no
+                longer exist are removed from the backends.
+            progress: Dictionary to record progress of each backend in, keyed by backend name.
+
+        Returns:
+            Whether anything was published, and what failed. Backends that failed do not stop the others.
+        """
+        with self._lock:
+            for backend in self._backends:
+                progress[backend.name] = BackendProgress()
+            resume_hashes = {name: md5 for name, md5 in gcs_tools.list_blob_hashes(bucket_name=bucket_name).items()
+                             if name.lower().endswith('.pdf')}
+            errors: list[str] = []
+
+            plans: dict[str, _BackendPlan] = {}
+            with tracing.ContextThreadPoolExecutor(max_workers=len(self._backends),
+                                                   thread_name_prefix='ingestion') as executor:
+                futures = {backend.name: executor.submit(self._plan, backend, resume_hashes, resume_names)
+                           for backend in self._backends}
+                for backend in self._backends:
+                    try:
+                        plans[backend.name] = futures[backend.name].result()
+                        progress[backend.name].deletes = len(plans[backend.name].deletes)
+                        progress[backend.name].upserts = len(plans[backend.name].upserts)
+                    except Exception as err:    # noqa: B902
+                        self._fail(backend, progress[backend.name], err, errors)
+
+            to_parse = sorted({name for plan in plans.values() for name in plan.upserts})
+            resumes: dict[str, ParsedResume] = {}
+            for resume_name in to_parse:
+                try:
+                    resumes[resume_name] = _parse_resume(bucket_name=bucket_name, resume_name=resume_name,
+                                                         md5=resume_hashes[resume_name])
+                except Exception as err:    # noqa: B902
+                    logger.error('Failed to parse resume %s: %s', resume_name, err)
+                    errors.append(f'Failed to parse resume {resume_name}: {err}')
+
+            chunks: dict[tuple[ChunkingConfig, str], list[Document]] = {}
+            for config in {backend.chunking for backend in self._backends if backend.chunking is not None}:
+                for resume in resumes.values():
+                    chunks[(config, resume.name)] = _split_resume(resume=resume, config=config)
+
+            active = [backend for backend in self._backends if backend.name in plans]
+            changed = False
+            if active:
+                with tracing.ContextThreadPoolExecutor(max_workers=len(active),
+                                                       thread_name_prefix='ingestion') as executor:
+                    futures = {backend.name: executor.submit(self._sync, backend, plans[backend.name], resumes, chunks,
+                                                             progress[backend.name])
+                               for backend in active}
+                    for backend in active:
+                        try:
+                            changed = futures[backend.name].result() or changed
+                        except Exception as err:    # noqa: B902
+                            self._fail(backend, progress[backend.name], err, errors)
+            return IngestionResult(changed=changed, errors=errors)
+
+    def _plan(self, backend: IndexBackend, resume_hashes: dict[str, str],
+              resume_names: list[str] | None) -> _BackendPlan:
+        """Compare the resumes with the backend and return what needs to be removed and (re)indexed."""
+        _call_with_retry(backend.open, backend=backend, progress=None)
+        indexed = _call_with_retry(backend.get_indexed_hashes, backend=backend, progress=None)
+        if resume_names is not None and _call_with_retry(backend.needs_full_sync, backend=backend, progress=None):
+            logger.info('Backend [%s] has not been published yet, comparing all resumes.', backend.name)
+            resume_names = None
+        scope = set(resume_hashes.keys()) | set(indexed.keys()) if resume_names is None else set(resume_names)
+        deletes = sorted(name for name in scope if name in indexed and name not in resume_hashes)
+        upserts = sorted(name for name in scope if name in resume_hashes and indexed.get(name) != resume_hashes[name])
+        logger.info('Backend [%s] has %s resumes, removed: %s, new or changed: %s', backend.name, len(indexed),
+                    len(deletes), len(upserts))
+        return _BackendPlan(deletes=deletes, upserts=upserts, full=resume_names is None)
+
+    @log
+    def _sync(self, backend: IndexBackend, plan: _BackendPlan, resumes: dict[str, ParsedResume],
+              chunks: dict[tuple[ChunkingConfig, str], list[Document]], progress: BackendProgress) -> bool:
+        """Apply the plan to the backend and publish what was applied, even if some of it failed.
+
+        Returns:
+            True if anything was published.
+        """
+        progress.state = JobState.RUNNING
+        completed: list[str] = []
+        try:
+            for resume_name in plan.deletes:
+                _call_with_retry(backend.delete, resume_name, backend=backend, progress=progress)
+                completed.append(resume_name)
+                progress.done += 1
+            for resume_name in plan.upserts:
+                resume = resumes.get(resume_name)
+                if resume is None:
+                    continue    # failed to parse, reported by the caller
+                resume_chunks = chunks[(backend.chunking, resume_name)] if backend.chunking is not None else []
+                _call_with_retry(backend.upsert, resume, resume_chunks, backend=backend, progress=progress)
+                completed.append(resume_name)
+                progress.done += 1
+        finally:
+            if completed:
+                _call_with_retry(backend.publish, completed, plan.full, backend=backend, progress=progress)
+        skipped = len(plan.deletes) + len(plan.upserts) - progress.done
+        if skipped:
+            progress.state = JobState.FAILED
+            progress.error = f'Skipped {skipped} resumes that failed to parse.'
+        else:
+            progress.state = JobState.SUCCEEDED
+        return bool(completed)
+
+    def _fail(self, backend: IndexBackend, progress: BackendProgress, err: Exception, errors: list[str]) -> None:
+        logger.error('Failed to update backend [%s]: %s', backend.name, err)
+        progress.state = JobState.FAILED
+        progress.error = str(err)
+        errors.append(f'Failed to update backend [{backend.name}]: {err}')
+
+
+def _call_with_retry(func: Callable[..., Any], *args: Any, backend: IndexBackend,
+                     progress: BackendProgress | None) -> Any:
+    """Call the backend, retrying with exponential backoff up to `INGESTION_ATTEMPTS` times."""
+    delay = INGESTION_RETRY_DELAY
+    for attempt in range(1, INGESTION_ATTEMPTS + 1):
+        try:
+            return func(*args)
+        except Exception as err:    # noqa: B902
+            if attempt == INGESTION_ATTEMPTS:
+                raise
+            logger.warning('Backend [%s] call %s failed (attempt %s of %s), retrying in %s seconds: %s', backend.name,
+                           func.__name__, attempt, INGESTION_ATTEMPTS, delay, err)
+            if progress is not None:
+                progress.retries += 1
+            time.sleep(delay)
+            delay *= 2
+
+
+@log
+def _parse_resume(bucket_name: str, resume_name: str, md5: str) -> ParsedResume:
+    """Download the resume and extract the text of its pages."""
+    resume_path = os.path.join(RESUME_DIR, os.path.basename(resume_name))
+    gcs_tools.download_blob(bucket_name=bucket_name, blob_name=resume_name, local_file_path=resume_path)
+    try:
+        pages = PyPDFLoader(resume_path).load()
+    finally:
+        os.remove(resume_path)
+    for page in pages:
+        page.metadata['source'] = f'gs://{bucket_name}/{resume_name}'
+    return ParsedResume(name=resume_name, md5=md5, pages=pages)
+
+
+def _split_resume(resume: ParsedResume, config: ChunkingConfig) -> list[Document]:
+    """Split the resume pages into chunks with the metadata that all backends use."""
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=config.chunk_size, chunk_overlap=config.chunk_overlap,
+                                                   separators=list(config.separators) if config.separators else None)
+    chunks = text_splitter.split_documents(resume.pages)
+    for i, chunk in enumerate(chunks):
+        chunk.metadata[RESUME_METADATA_KEY] = resume.name
+        chunk.metadata[RESUME_HASH_METADATA_KEY] = resume.md5
+        chunk.metadata['document_name'] = resume.name.split('/')[-1]
+        chunk.metadata['chunk'] = i
+    return chunks
@@ -0,0 +1,224 @@
+# Copyright 2023 Qarik Group, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Queue of index rebuild jobs that coalesces bursts of resume update events into a single rebuild.
+
+Typical usage:
+    queue = RebuildQueue(process=rebuild_index)
+    job = queue.submit(bucket_name='resumes', resume_name='John Doe.pdf', event_type='...finalized')
+    ...
+    print(queue.get(job.job_id).state)
+"""
+
+import collections
+import threading
+import time
+import uuid
+from datetime import datetime
+from enum import Enum
+from typing import Callable
+
+from common import metrics, solution, tracing
+from common.log import Logger, log
+from pydantic import BaseModel
+
+logger = Logger(__name__).get_logger()
+logger.info('Initializing...')
+
+DEBOUNCE_DELAY: float = float(solution.getenv('REBUILD_DEBOUNCE_DELAY', '10'))
+"""Start the rebuild only after no new events have arrived for this many seconds."""
+
+MAX_DEBOUNCE_DELAY: float = float(solution.getenv('REBUILD_MAX_DEBOUNCE_DELAY', '120'))
+"""Start the rebuild at most this many seconds after the first event, even if events keep arriving."""
+
+MAX_ATTEMPTS: int = 3
+"""How many times to try the changes of a failed job before giving up. Events are acknowledged before the rebuild, so
+Eventarc does not retry them."""
+
+MAX_JOBS_KEPT: int = 100
+"""Number of most recent jobs to keep for status requests."""
+
+REBUILD_JOBS = metrics.Counter('rebuild_jobs_total', 'Finished rebuild jobs by final state.', labelnames=('state',))
+
+
+class JobState(str, Enum):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+
+
+class BackendProgress(BaseModel):
+    """Progress of updating one index backend within a rebuild job."""
+    state: JobState = JobState.QUEUED
+    deletes: int = 0
+    """Number of resumes to remove from the index."""
+    upserts: int = 0
+    """Number of new or changed resumes to add to the index."""
+    done: int = 0
+    """Number of resumes removed or added so far."""
+    retries: int = 0
+    """Number of failed calls to the backend that were retried."""
+    error: str | None = None
+
+
+class RebuildJob(BaseModel):
+    """Rebuild of the index for all resume updates received during the debounce window."""
+    job_id: str
+    bucket_name: str
+    """GCS bucket with the resumes."""
+    state: JobState = JobState.QUEUED
+    changes: dict[str, str] = {}
+    """Event type of the most recent event for each changed resume, keyed by resume name."""
+    full: bool = False
+    """Rebuild the index from all resumes, because one of the events did not name a resume."""
+    events: int = 0
+    """Number of events coalesced into this job."""
+    attempt: int = 1
+    """Number of times the oldest of the changes has been tried, including this job."""
+    created: datetime
+    started: datetime | None = None
+    finished: datetime | None = None
+    error: str | None = None
+    backends: dict[str, BackendProgress] = {}
+    """Progress of each index backend, keyed by backend name."""
+
+
+class RebuildQueue:
+    """Run at most one rebuild at a time in a background thread, coalescing events that arrive in the meantime.
+
+    Events for the same bucket that arrive while a job is queued are merged into it. The job starts once no new events
+    have arrived for `debounce_delay` seconds, but no later than `max_debounce_delay` seconds after its first event.
+    Events that arrive while a job is running go into the next job.
+    """
+
+    def __init__(self,
+                 process: Callable[[RebuildJob], None],
+                 debounce_delay: float = DEBOUNCE_DELAY,
+                 max_debounce_delay: float = MAX_DEBOUNCE_DELAY) -> None:
+        """Initialize the queue.
+
+        Args:
+            process: Function that rebuilds the index for the job. Raises an exception if the rebuild failed.
+            debounce_delay: Quiet period after the last event before the job starts.
+            max_debounce_delay: Maximum delay after the first event before the job starts.
+        """
+        self._process = process
+        self._debounce_delay = debounce_delay
+        self._max_debounce_delay = max_debounce_delay
+        self._condition = threading.Condition()
+        self._pending: dict[str, RebuildJob] = {}
+        """Queued jobs keyed by bucket name."""
+        self._first_event: dict[str, float] = {}
+        self._last_event: dict[str, float] = {}
+        self._jobs: collections.OrderedDict[str, RebuildJob] = collections.OrderedDict()
+        self._thread: threading.Thread | None = None
+
+    def submit(self, bucket_name: str, resume_name: str | None, event_type: str | None) -> RebuildJob:
+        """Add the event to the queued job for the bucket, creating the job if there is none, and return the job.
+
+        Events without a resume name make the job rebuild all resumes.
+        """
+        with self._condition:
+            job = self._get_pending(bucket_name)
+            self._last_event[bucket_name] = time.monotonic()
+            job.events += 1
+            if resume_name and event_type:
+                job.changes[resume_name] = event_type
+            else:
+                job.full = True
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='rebuild-queue', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+            return job
+
+    def get(self, job_id: str) -> RebuildJob | None:
+        """Return the job if it is still remembered."""
+        with self._condition:
+            return self._jobs.get(job_id)
+
+    def recent(self) -> list[RebuildJob]:
+        """Return the most recent jobs, newest first."""
+        with self._condition:
+            return list(reversed(self._jobs.values()))
+
+    def _get_pending(self, bucket_name: str) -> RebuildJob:
+        """Return the queued job for the bucket, creating it if there is none. Must be called with the lock held."""
+        job = self._pending.get(bucket_name)
+        if job is None:
+            job = RebuildJob(job_id=uuid.uuid4().hex, bucket_name=bucket_name, created=solution.now())
+            self._pending[bucket_name] = job
+            self._first_event[bucket_name] = self._last_event[bucket_name] = time.monotonic()
+            self._remember(job)
+        return job
+
+    def _retry(self, failed: RebuildJob) -> None:
+        """Merge changes of the failed job into the queued job, keeping more recent events for the same resumes."""
+        with self._condition:
+            job = self._get_pending(failed.bucket_name)
+            job.changes = {**failed.changes, **job.changes}
+            job.full = job.full or failed.full
+            job.events += failed.events
+            job.attempt = max(job.attempt, failed.attempt + 1)
+            self._last_event[failed.bucket_name] = time.monotonic()
+            self._condition.notify()
+        logger.info('Retrying changes of job %s in job %s.', failed.job_id, job.job_id)
+
+    def _remember(self, job: RebuildJob) -> None:
+        self._jobs[job.job_id] = job
+        while len(self._jobs) > MAX_JOBS_KEPT:
+            self._jobs.popitem(last=False)
+
+    def _get_start_time(self, bucket_name: str) -> float:
+        return min(self._last_event[bucket_name] + self._debounce_delay,
+                   self._first_event[bucket_name] + self._max_debounce_delay)
+
+    def _next_job(self) -> RebuildJob:
+        """Wait until one of the queued jobs is due to start and take it off the queue."""
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                due = {name: self._get_start_time(name) for name in self._pending}
+                ready = [name for name, start in due.items() if start <= now]
+                if ready:
+                    job = self._pending.pop(ready[0])
+                    job.state = JobState.RUNNING
+                    job.started = solution.now()
+                    return job
+                self._condition.wait(timeout=min(due.values()) - now if due else None)
+
+    def _run(self) -> None:
+        while True:
+            job = self._next_job()
+            # Use the job id as trace id, so that all logs of the rebuild can be found by the id returned to clients
+            with tracing.request_context(trace_id=job.job_id):
+                self._execute(job)
+
+    @log
+    def _execute(self, job: RebuildJob) -> None:
+        """Run the rebuild and record its outcome in the job."""
+        logger.info('Starting rebuild job %s with %s events for %s resumes (full=%s).', job.job_id, job.events,
+                    len(job.changes), job.full)
+        try:
+            with metrics.STAGE_SECONDS.time('rebuild'):
+                self._process(job)
+            job.state = JobState.SUCCEEDED
+        except Exception as err:    # noqa: B902
+            logger.error('Rebuild job %s failed (attempt %s of %s): %s', job.job_id, job.attempt, MAX_ATTEMPTS, err)
+            job.error = str(err)
+            job.state = JobState.FAILED
+        job.finished = solution.now()
+        REBUILD_JOBS.inc(job.state.value)
+        if job.state == JobState.FAILED and job.attempt < MAX_ATTEMPTS:
+            self._retry(job)
@@ -13,35 +13,85 @@
 # limitations under the License.
 """Main API service that handles REST API calls to LLM and is run on server."""
 
+from typing import Annotated
+
 import fastapi
-from common import admin_dao, api_tools, constants, gcs_tools, llamaindex_tools, solution
-from common.log import Logger, log_params
+from common import admin_dao, api_tools, metrics, solution, tracing
+from common.log import Logger, log, log_params
+from ingestion import INGESTION_BACKENDS, IngestionPipeline, create_backends
+from rebuild_queue import RebuildJob, RebuildQueue
 
 logger = Logger(__name__).get_logger()
 logger.info('Initializing...')
 
 
-INDEX_BUCKET: str = solution.getenv('EMBEDDINGS_BUCKET_NAME')
-RESUME_DIR: str = 'tmp'
+FINALIZED_EVENT: str = 'google.cloud.storage.object.v1.finalized'
+"""Eventarc event type sent when a resume is uploaded or overwritten."""
+DELETED_EVENT: str = 'google.cloud.storage.object.v1.deleted'
+"""Eventarc event type sent when a resume is deleted, or when an older version of it is replaced by an upload."""
+MAX_INCREMENTAL_RESUMES: int = int(solution.getenv('MAX_INCREMENTAL_RESUMES', '20'))
+"""Compare all resumes with the index backends instead of only the changed ones if more resumes than this changed at
+once. The llama-index is then published as a whole rather than one person at a time."""
+
+_pipeline = IngestionPipeline(backends=create_backends(INGESTION_BACKENDS))
+"""Parse changed resumes once and update all enabled index backends."""
 
 app = api_tools.ServiceAPI(title='Resume PDF Manager', description='Eventarc handler.')
 
 # In case you need to print the log of all inbound HTTP headers
 app.router.route_class = api_tools.DebugHeaders
 
-# TODO - need to be able to handle many concurrent deletes or updates to avoid concurrent generation of embeddings
+
+@log
+def _rebuild(job: RebuildJob) -> None:
+    """Bring all index backends in sync with the resume changes of the job and notify the query engines.
+
+    Only the changed resumes are compared with the backends, unless one of the events did not name a resume or too
+    many resumes changed. Raises an exception if any backend or resume failed, so that the job is retried.
+    """
+    full = job.full or len(job.changes) > MAX_INCREMENTAL_RESUMES
+    result = _pipeline.run(bucket_name=job.bucket_name, resume_names=None if full else list(job.changes.keys()),
+                           progress=job.backends)
+    if result.changed:
+        admin_dao.AdminDAO().touch_resumes(timestamp=solution.now())
+    if result.errors:
+        raise RuntimeError('; '.join(result.errors))
+
+
+_rebuild_queue = RebuildQueue(process=_rebuild)
+"""Run one rebuild at a time for bursts of resume events."""
+
+
+@app.post('/resumes', name='Handle Eventarc events.', status_code=fastapi.status.HTTP_202_ACCEPTED)
+@log_params
+def update_embeddings(event_data: dict = fastapi.Body(),
+                      ce_type: Annotated[str | None, fastapi.Header()] = None) -> dict:
+    """Queue the update of embeddings for the changed resume and acknowledge the event right away.
+
+    Events that arrive within the debounce window are processed together by one rebuild job (see `RebuildQueue`).
+    Events with an unknown type (e.g. a manual call without the `ce-type` header) make the job process all resumes.
+    """
+    resume_name = event_data.get('name')
+    event_type = ce_type if ce_type in (FINALIZED_EVENT, DELETED_EVENT) else None
+    job = _rebuild_queue.submit(bucket_name=event_data['bucket'], resume_name=resume_name, event_type=event_type)
+    return {'status': 'accepted', 'job_id': job.job_id}
 
 
-@app.post('/resumes', name='Handle Eventarc events.')
+@app.get('/jobs', name='List most recent rebuild jobs.')
 @log_params
-def update_embeddings(event_data: dict = fastapi.Body()) -> dict:
-    """Handle resume updates in GCS bucket and generate embeddings."""
-    gcs_tools.download(bucket_name=event_data['bucket'], local_dir=RESUME_DIR)
-    # TODO - need to generate proper embeddings for each provider, not hard coded
-    llamaindex_tools.generate_embeddings(resume_dir=RESUME_DIR, provider=constants.LlmProvider.OPEN_AI)
-    gcs_tools.upload(bucket_name=INDEX_BUCKET, local_dir=llamaindex_tools.LLAMA_INDEX_DIR)
-    admin_dao.AdminDAO().touch_resumes(timestamp=solution.now())
-    return {'status': 'ok'}
+def list_jobs() -> list[RebuildJob]:
+    """Return status of the most recent rebuild jobs, newest first."""
+    return _rebuild_queue.recent()
+
+
+@app.get('/jobs/{job_id}', name='Get status of a rebuild job.')
+@log_params
+def get_job(job_id: str) -> RebuildJob:
+    """Return status of the rebuild job."""
+    job = _rebuild_queue.get(job_id)
+    if job is None:
+        raise fastapi.HTTPException(status_code=fastapi.status.HTTP_404_NOT_FOUND, detail=f'Unknown job: {job_id}')
+    return job
 
 
 @app.get('/health', name='Health check and information about the software version and configuration.')
@@ -49,3 +99,21 @@ def update_embeddings(event_data: dict = fastapi.Body()) -> dict:
 def healthcheck() -> dict:
     """Verify that the process is up without testing backend connections."""
     return solution.health_status()
+
+
+@app.get('/traces', name='Span trees of the most recent slow requests.')
+@log
+def list_traces() -> list[dict]:
+    """Return wall and CPU time of each decorated function called by recent slow requests, newest first.
+
+    Only a sample of requests is traced (see `tracing.TRACE_SAMPLE_RATE`), and only those slower than
+    `tracing.TRACE_LOG_THRESHOLD` are kept.
+    """
+    return tracing.recent_traces()
+
+
+@app.get('/metrics', name='Metrics in the Prometheus text format.')
+@log
+def get_metrics() -> fastapi.Response:
+    """Return request counts, latency histograms, in-flight gauges and component statistics for scraping."""
+    return fastapi.Response(content=metrics.REGISTRY.expose(), media_type=metrics.CONTENT_TYPE)
@@ -0,0 +1,116 @@
+# Copyright 2023 Qarik Group, LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+import unittest
+from typing import Callable
+
+from common.log import Logger, log
+from resume_manager.rebuild_queue import JobState, RebuildJob, RebuildQueue
+
+logger = Logger(__name__).get_logger()
+logger.info('Initializing...')
+
+FINALIZED = 'google.cloud.storage.object.v1.finalized'
+DELETED = 'google.cloud.storage.object.v1.deleted'
+
+
+def _wait_for(condition: Callable[[], bool], timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'Timed out waiting for the rebuild queue'
+        time.sleep(0.01)
+
+
+class TestRebuildQueue(unittest.TestCase):
+
+    @log
+    def test_debounce(self) -> None:
+        """Test that events arriving within the debounce delay are coalesced into one job."""
+        processed: list[RebuildJob] = []
+        rebuild_queue = RebuildQueue(process=processed.append, debounce_delay=0.2, max_debounce_delay=10)
+        first = rebuild_queue.submit(bucket_name='resumes', resume_name='a.pdf', event_type=FINALIZED)
+        second = rebuild_queue.submit(bucket_name='resumes', resume_name='b.pdf', event_type=FINALIZED)
+        third = rebuild_queue.submit(bucket_name='resumes', resume_name='a.pdf', event_type=DELETED)
+        assert first.job_id == second.job_id == third.job_id
+        _wait_for(lambda: first.state == JobState.SUCCEEDED)
+        assert len(processed) == 1
+        assert processed[0].changes == {'a.pdf': DELETED, 'b.pdf': FINALIZED}
+        assert processed[0].events == 3
+        assert not processed[0].full
+
+    @log
+    def test_full_rebuild(self) -> None:
+        """Test that an event without a resume name makes the job rebuild all resumes."""
+        rebuild_queue = RebuildQueue(process=lambda job: None, debounce_delay=0.05, max_debounce_delay=10)
+        rebuild_queue.submit(bucket_name='resumes', resume_name='a.pdf', event_type=FINALIZED)
+        job = rebuild_queue.submit(bucket_name='resumes', resume_name=None, event_type=None)
+        _wait_for(lambda: job.state == JobState.SUCCEEDED)
+        assert job.full
+
+    @log
+    def test_max_debounce(self) -> None:
+        """Test that a job starts after the maximum debounce delay even if events keep arriving."""
+        rebuild_queue = RebuildQueue(process=lambda job: None, debounce_delay=0.2, max_debounce_delay=0.5)
+        job = rebuild_queue.submit(bucket_name='resumes', resume_name='0.pdf', event_type=FINALIZED)
+        start = time.monotonic()
+        for i in range(1, 100):
+            if job.state != JobState.QUEUED:
+                break
+            rebuild_queue.submit(bucket_name='resumes', resume_name=f'{i}.pdf', event_type=FINALIZED)
+            time.sleep(0.05)
+        _wait_for(lambda: job.state == JobState.SUCCEEDED)
+        assert time.monotonic() - start < 2
+        assert 1 < job.events < 100
+
+    @log
+    def test_merge_on_retry(self) -> None:
+        """Test that changes of a failed job are merged into the next job, where newer events win."""
+        failing = threading.Event()
+        failing.set()
+        running = threading.Event()
+        release = threading.Event()
+        processed: list[RebuildJob] = []
+
+        def process(job: RebuildJob) -> None:
+            processed.append(job.copy(deep=True))
+            if failing.is_set():
+                failing.clear()
+                running.set()
+                assert release.wait(timeout=10)
+                raise RuntimeError('index is not available')
+
+        rebuild_queue = RebuildQueue(process=process, debounce_delay=0.05, max_debounce_delay=10)
+        failed = rebuild_queue.submit(bucket_name='resumes', resume_name='a.pdf', event_type=FINALIZED)
+        rebuild_queue.submit(bucket_name='resumes', resume_name='b.pdf', event_type=FINALIZED)
+        assert running.wait(timeout=10)
+        # Events that arrive while the job is running go into the next job
+        next_job = rebuild_queue.submit(bucket_name='resumes', resume_name='a.pdf', event_type=DELETED)
+        assert next_job.job_id != failed.job_id
+        release.set()
+        _wait_for(lambda: next_job.state == JobState.SUCCEEDED)
+
+        assert failed.state == JobState.FAILED
+        assert failed.error == 'index is not available'
+        assert len(processed) == 2
+        assert processed[1].job_id == next_job.job_id
+        assert processed[1].changes == {'a.pdf': DELETED, 'b.pdf': FINALIZED}
+        assert processed[1].events == 3
+        assert processed[1].attempt == 2
+        assert [job.job_id for job in rebuild_queue.recent()] == [next_job.job_id, failed.job_id]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -19,7 +19,7 @@ import json
 import uuid
 
 import numpy as np
-from query_engine.matching_engine import ME_DIMENSIONS
+from common.matching_engine import ME_DIMENSIONS
 
 # Create a dummy embeddings file to initialize when creating the index dummy embedding
 init_embedding = {'id': str(uuid.uuid4()), 'embedding': list(np.zeros(ME_DIMENSIONS))}
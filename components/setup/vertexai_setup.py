@@ -20,20 +20,27 @@ https://github.com/GoogleCloudPlatform/generative-ai/blob/main/language/use-case
 """
 
 
+import collections
+import itertools
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, NamedTuple
+
 import langchain
 import vertexai
-from common import solution
+from common import gcs_tools, solution
 from common.log import Logger
-from google.cloud import aiplatform
-from langchain.document_loaders import GCSDirectoryLoader
+from common.matching_engine import (ME_DIMENSIONS, ME_INGESTED_RESUMES, CustomVertexAIEmbeddings, MatchingEngine,
+                                    make_datapoint_id)
+from common.matching_engine_tools import MatchingEngineUtils
+from google.api_core import exceptions
+from google.cloud import aiplatform, storage
+from langchain.document_loaders import GCSFileLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from query_engine.matching_engine import ME_DIMENSIONS, CustomVertexAIEmbeddings, MatchingEngine
-from query_engine.matching_engine_tools import MatchingEngineUtils
 
 logger = Logger(__name__).get_logger()
-logger.info('Initializing...')
-logger.info(f'Vertex AI SDK version: {aiplatform.__version__}')
-logger.info(f'LangChain version: {langchain.__version__}')
 
 PROJECT_ID: str = solution.PROJECT_ID
 REGION: str = solution.REGION
@@ -42,166 +49,320 @@ ME_INDEX_NAME: str = f'{PROJECT_ID}-me-index'
 ME_EMBEDDING_DIR: str = solution.getenv('ME_EMBEDDING_BUCKET')
 GCS_BUCKET_DOCS = solution.getenv('RESUME_BUCKET_NAME')
 
-# Initialize Vertex AI SDK
-vertexai.init(project=PROJECT_ID, location=REGION)
-
-
 # Embeddings API integrated with langChain
 EMBEDDING_QPM = 100
-embeddings = CustomVertexAIEmbeddings(
-    requests_per_minute=EMBEDDING_QPM,
-)
 
-"""
-As part of the environment setup, create an index on Vertex AI Matching Engine and deploy the index to an Endpoint. Index Endpoint can be [public](https://cloud.google.com/vertex-ai/docs/matching-engine/deploy-index-public) or [private](https://cloud.google.com/vertex-ai/docs/matching-engine/deploy-index-vpc). This notebook uses a **Public endpoint**.
-Refer to the [Matching Engine documentation](https://cloud.google.com/vertex-ai/docs/matching-engine/overview) for details.
+INGESTION_BATCH_SIZE: int = int(solution.getenv('INGESTION_BATCH_SIZE', '100'))
+"""Number of chunks to embed and add to the index between checkpoints."""
+INGESTION_WORKERS: int = int(solution.getenv('INGESTION_WORKERS', str(os.cpu_count() or 1)))
+"""Number of worker processes that parse and split documents."""
+INGESTION_JOURNAL: str = solution.getenv('INGESTION_JOURNAL', 'tmp/ingestion_journal.jsonl')
+"""Local file with the ids of chunks already added to the index, one JSON line per document and batch."""
+PUBLISH_ATTEMPTS: int = 5
+"""How many times to try merging the ingested documents into a list of ingested resumes that keeps being changed."""
 
-NOTE: Please note creating an Index on Matching Engine and deploying the Index to an Index Endpoint can take up to 1 hour.</b>
 
-- Configure parameters to create Matching Engine index
-    - `ME_REGION`: Region where Matching Engine Index and Index Endpoint are deployed
-    - `ME_INDEX_NAME`: Matching Engine index display name
-    - `ME_EMBEDDING_DIR`: Cloud Storage path to allow inserting, updating or deleting the contents of the Index
-    - `ME_DIMENSIONS`: The number of dimensions of the input vectors. Vertex AI Embedding API generates 768 dimensional vector embeddings.
+def create_index(mengine: MatchingEngineUtils) -> None:
+    """As part of the environment setup, create an index on Vertex AI Matching Engine and deploy the index to an Endpoint. Index Endpoint can be [public](https://cloud.google.com/vertex-ai/docs/matching-engine/deploy-index-public) or [private](https://cloud.google.com/vertex-ai/docs/matching-engine/deploy-index-vpc). This notebook uses a **Public endpoint**.
+    Refer to the [Matching Engine documentation](https://cloud.google.com/vertex-ai/docs/matching-engine/overview) for details.
 
-    You can [create index](https://cloud.google.com/vertex-ai/docs/matching-engine/create-manage-index#create-index) on Vertex AI Matching Engine for batch updates or streaming updates.
+    NOTE: Please note creating an Index on Matching Engine and deploying the Index to an Index Endpoint can take up to 1 hour.</b>
 
-This creates Matching Engine Index:
-- With [streaming updates](https://cloud.google.com/vertex-ai/docs/matching-engine/create-manage-index#create-stream)
-- With default configuration - e.g. small shard size
+    - Configure parameters to create Matching Engine index
+        - `ME_REGION`: Region where Matching Engine Index and Index Endpoint are deployed
+        - `ME_INDEX_NAME`: Matching Engine index display name
+        - `ME_EMBEDDING_DIR`: Cloud Storage path to allow inserting, updating or deleting the contents of the Index
+        - `ME_DIMENSIONS`: The number of dimensions of the input vectors. Vertex AI Embedding API generates 768 dimensional vector embeddings.
 
-You can [update the index configuration](https://cloud.google.com/vertex-ai/docs/matching-engine/configuring-indexes) in the Matching Engine utilities script.
+        You can [create index](https://cloud.google.com/vertex-ai/docs/matching-engine/create-manage-index#create-index) on Vertex AI Matching Engine for batch updates or streaming updates.
 
-While the index is being created and deployed, you can read more about Matching Engine's ANN service which uses a new type of vector quantization developed by Google Research: [Accelerating Large-Scale Inference with Anisotropic Vector Quantization](https://arxiv.org/abs/1908.10396).
+    This creates Matching Engine Index:
+    - With [streaming updates](https://cloud.google.com/vertex-ai/docs/matching-engine/create-manage-index#create-stream)
+    - With default configuration - e.g. small shard size
 
-For more information about how this works, see [Announcing ScaNN: Efficient
-Vector Similarity Search](https://ai.googleblog.com/2020/07/announcing-scann-efficient-vector.html).
-"""
+    You can [update the index configuration](https://cloud.google.com/vertex-ai/docs/matching-engine/configuring-indexes) in the Matching Engine utilities script.
 
-mengine = MatchingEngineUtils(PROJECT_ID, ME_REGION, ME_INDEX_NAME)
+    While the index is being created and deployed, you can read more about Matching Engine's ANN service which uses a new type of vector quantization developed by Google Research: [Accelerating Large-Scale Inference with Anisotropic Vector Quantization](https://arxiv.org/abs/1908.10396).
 
-logger.info('Started Index creation...')
-index = mengine.create_index(
-    embedding_gcs_uri=f'gs://{ME_EMBEDDING_DIR}/init_index',
-    dimensions=ME_DIMENSIONS,
-    index_update_method='streaming',
-    index_algorithm='tree-ah',
-)
+    For more information about how this works, see [Announcing ScaNN: Efficient
+    Vector Similarity Search](https://ai.googleblog.com/2020/07/announcing-scann-efficient-vector.html).
+    """
+    logger.info('Started Index creation...')
+    index = mengine.create_index(
+        embedding_gcs_uri=f'gs://{ME_EMBEDDING_DIR}/init_index',
+        dimensions=ME_DIMENSIONS,
+        index_update_method='streaming',
+        index_algorithm='tree-ah',
+    )
 
-if index:
-    logger.info(index.name)
-else:
-    logger.info('Index creation still in progress...')
+    if index:
+        logger.info(index.name)
+    else:
+        logger.info('Index creation still in progress...')
 
-"""
-Deploy index to Index Endpoint on Matching Engine. This [deploys the index to a public endpoint](https://cloud.google.com/vertex-ai/docs/matching-engine/deploy-index-public). The deployment operation creates a  public endpoint that will be used for querying the index for approximate nearest neighbors.
 
-For deploying index to a Private Endpoint, refer to the [documentation](https://cloud.google.com/vertex-ai/docs/matching-engine/deploy-index-vpc) to set up pre-requisites.
-"""
+def deploy_index(mengine: MatchingEngineUtils) -> None:
+    """Deploy index to Index Endpoint on Matching Engine. This [deploys the index to a public endpoint](https://cloud.google.com/vertex-ai/docs/matching-engine/deploy-index-public). The deployment operation creates a  public endpoint that will be used for querying the index for approximate nearest neighbors.
 
-index_endpoint = mengine.deploy_index()
-if index_endpoint:
-    logger.info(f'Index endpoint resource name: {index_endpoint.name}')
-    logger.info(f'Index endpoint public domain name: {index_endpoint.public_endpoint_domain_name}')
-    logger.info('Deployed indexes on the index endpoint:')
-    for d in index_endpoint.deployed_indexes:
-        logger.info(f'    {d.id}')
+    For deploying index to a Private Endpoint, refer to the [documentation](https://cloud.google.com/vertex-ai/docs/matching-engine/deploy-index-vpc) to set up pre-requisites.
+    """
+    index_endpoint = mengine.deploy_index()
+    if index_endpoint:
+        logger.info(f'Index endpoint resource name: {index_endpoint.name}')
+        logger.info(f'Index endpoint public domain name: {index_endpoint.public_endpoint_domain_name}')
+        logger.info('Deployed indexes on the index endpoint:')
+        for d in index_endpoint.deployed_indexes:
+            logger.info(f'    {d.id}')
 
-"""
-Add Document Embeddings to Matching Engine - Vector Store
-
-This step ingests and parse PDF documents, split them, generate embeddings and add the embeddings to the vector store. The document corpus used as dataset is a sample of Google published research papers across different domains - large models, traffic simulation, productivity etc.
-
-### Ingest PDF files
-
-The document corpus is hosted on Cloud Storage bucket (at `gs://github-repo/documents/google-research-pdfs/`) and LangChain provides a convenient document loader [`GCSDirectoryLoader`](https://python.langchain.com/en/latest/modules/indexes/document_loaders/examples/google_cloud_storage_directory.html) to load documents from a Cloud Storage bucket. The loader uses `Unstructured` package to load files of many types including pdfs, images, html and more.
 
-Ingest PDF files
 """
+Add Document Embeddings to Matching Engine - Vector Store
 
-logger.info(f'Processing documents from {GCS_BUCKET_DOCS}')
-loader = GCSDirectoryLoader(
-    project_name=PROJECT_ID, bucket=GCS_BUCKET_DOCS, prefix=''
-)
-documents = loader.load()
-
-# Add document name and source to the metadata
-for document in documents:
-    doc_md = document.metadata
-    document_name = doc_md['source'].split('/')[-1]
-    # derive doc source from Document loader
-    doc_source_prefix = '/'.join(GCS_BUCKET_DOCS.split('/')[:3])
-    doc_source_suffix = '/'.join(doc_md['source'].split('/')[4:-1])
-    source = f'{doc_source_prefix}/{doc_source_suffix}'
-    document.metadata = {'source': source, 'document_name': document_name}
-
-logger.info(f'# of documents loaded (pre-chunking) = {len(documents)}')
-
-# Verify document metadata
-documents[0].metadata
-
-"""
-Chunk documents
-Split the documents to smaller chunks. When splitting the document, ensure a few chunks can fit within the context length of LLM.
-"""
-text_splitter = RecursiveCharacterTextSplitter(
-    chunk_size=1000,
-    chunk_overlap=50,
-    separators=['\n\n', '\n', '.', '!', '?', ',', ' ', ''],
-)
-doc_splits = text_splitter.split_documents(documents)
-
-# Add chunk number to metadata
-for idx, split in enumerate(doc_splits):
-    split.metadata['chunk'] = idx
-
-logger.info(f'# of documents = {len(doc_splits)}')
-
-doc_splits[0].metadata
-
-# Configure Matching Engine as Vector Store. Get Matching Engine Index id and Endpoint id
-
-ME_INDEX_ID, ME_INDEX_ENDPOINT_ID = mengine.get_index_and_endpoint()
-logger.info(f'ME_INDEX_ID={ME_INDEX_ID}')
-logger.info(f'ME_INDEX_ENDPOINT_ID={ME_INDEX_ENDPOINT_ID}')
-
-# Initialize Matching Engine vector store with text embeddings model
-me = MatchingEngine.from_components(
-    project_id=PROJECT_ID,
-    region=ME_REGION,
-    gcs_bucket_name=f'gs://{ME_EMBEDDING_DIR}'.split('/')[2],
-    embedding=embeddings,
-    index_id=ME_INDEX_ID,
-    endpoint_id=ME_INDEX_ENDPOINT_ID,
-)
-
-"""
-Add documents as embeddings in Matching Engine as index
+This step ingests and parse PDF documents, split them, generate embeddings and add the embeddings to the vector store.
 
 The document chunks are transformed as embeddings (vectors) using Vertex AI Embeddings API and added to the index with **[streaming index update](https://cloud.google.com/vertex-ai/docs/matching-engine/create-manage-index#create-index)**. With Streaming Updates, you can update and query your index within a few seconds.
 
 The original document text is stored on Cloud Storage bucket had referenced by id.
 
-Prepare text and metadata to be added to the vectors
+Documents are parsed and split by a pool of worker processes, and the chunks are added to the index in batches. The ids
+of the chunks in every added batch are recorded in a local journal, so if the script fails, e.g. on an API quota error,
+rerunning it continues after the last completed batch instead of embedding everything again. Chunk ids are
+deterministic (see `make_datapoint_id`), so a batch that was added but not recorded is replaced rather than duplicated.
+Delete the journal to ingest all documents again.
 """
 
-# Store docs as embeddings in Matching Engine index
-# It may take a while since API is rate limited
-texts = [doc.page_content for doc in doc_splits]
-metadatas = [
-    [
-        {'namespace': 'source', 'allow_list': [doc.metadata['source']]},
-        {'namespace': 'document_name', 'allow_list': [doc.metadata['document_name']]},
-        {'namespace': 'chunk', 'allow_list': [str(doc.metadata['chunk'])]},
-    ]
-    for doc in doc_splits
-]
 
-# Add embeddings to the vector store
-# Depending on the volume and size of documents, this step may take time.
+class IngestionJournal:
+    """Append-only record of the chunks added to the index, which survives failures of the script.
+
+    Entries are keyed by document name and MD5 hash, so a document that changed since it was recorded is ingested
+    again. A document is complete once the line with its number of chunks is written after the last of its chunks.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._done: dict[tuple[str, str], set[str]] = collections.defaultdict(set)
+        """Ids of the added chunks keyed by document name and hash."""
+        self.complete: dict[str, dict[str, Any]] = {}
+        """Hash and number of chunks of every completely ingested document, keyed by document name."""
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Last line may be cut short if the script was killed while writing it
+                        logger.warning('Skipping incomplete line of journal %s.', path)
+                        continue
+                    if 'chunks' in entry:
+                        self.complete[entry['document']] = {'resume_hash': entry['md5'], 'chunks': entry['chunks']}
+                    else:
+                        self._done[(entry['document'], entry['md5'])].update(entry['ids'])
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def is_complete(self, document_name: str, md5: str) -> bool:
+        return self.complete.get(document_name, {}).get('resume_hash') == md5
+
+    def is_done(self, document_name: str, md5: str, chunk_id: str) -> bool:
+        return chunk_id in self._done.get((document_name, md5), ())
+
+    def record_chunks(self, chunks: list['Chunk']) -> None:
+        """Record chunks added to the index and flush the journal to disk."""
+        ids_by_document: dict[tuple[str, str], list[str]] = collections.defaultdict(list)
+        for chunk in chunks:
+            ids_by_document[(chunk.document_name, chunk.md5)].append(chunk.id)
+        for (document_name, md5), ids in ids_by_document.items():
+            self._done[(document_name, md5)].update(ids)
+            self._write({'document': document_name, 'md5': md5, 'ids': ids})
+        self._flush()
+
+    def record_complete(self, document_name: str, md5: str, chunks: int) -> None:
+        """Record that all chunks of the document have been added to the index."""
+        self.complete[document_name] = {'resume_hash': md5, 'chunks': chunks}
+        self._write({'document': document_name, 'md5': md5, 'chunks': chunks})
+        self._flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+    def _write(self, entry: dict[str, Any]) -> None:
+        self._file.write(json.dumps(entry) + '\n')
+
+    def _flush(self) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+
+class Chunk(NamedTuple):
+    """Chunk of a document, in a form that worker processes can send back cheaply."""
+    id: str
+    document_name: str
+    md5: str
+    text: str
+    metadata: list[dict[str, Any]]
+    """Restricts of the Matching Engine datapoint."""
+
+
+def load_and_split(bucket_name: str, blob_name: str, md5: str) -> list[Chunk]:
+    """Load the document from GCS and split it into chunks. Runs in a worker process.
+
+    Split the documents to smaller chunks. When splitting the document, ensure a few chunks can fit within the context
+    length of LLM. Chunks are numbered within the document, so that their ids do not depend on other documents.
+    """
+    documents = GCSFileLoader(project_name=PROJECT_ID, bucket=bucket_name, blob=blob_name).load()
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=1000,
+        chunk_overlap=50,
+        separators=['\n\n', '\n', '.', '!', '?', ',', ' ', ''],
+    )
+    document_name = blob_name.split('/')[-1]
+    source = f'gs://{bucket_name}/{blob_name}'
+    return [
+        Chunk(id=make_datapoint_id(blob_name, idx),
+              document_name=blob_name,
+              md5=md5,
+              text=split.page_content,
+              metadata=[
+                  {'namespace': 'source', 'allow_list': [source]},
+                  {'namespace': 'document_name', 'allow_list': [document_name]},
+                  {'namespace': 'chunk', 'allow_list': [str(idx)]},
+              ])
+        for idx, split in enumerate(text_splitter.split_documents(documents))
+    ]
 
-doc_ids = me.add_texts(texts=texts, metadatas=metadatas)
 
-# Validate semantic search with Matching Engine is working
-me.similarity_search('List all people with Java skills?', k=2)
-me.similarity_search('Who is the CTO of Qarik Group?', k=2)
+def ingest_documents(me: MatchingEngine, bucket_name: str, journal: IngestionJournal,
+                     ingested: dict[str, dict[str, Any]] | None = None,
+                     batch_size: int = INGESTION_BATCH_SIZE, workers: int = INGESTION_WORKERS) -> None:
+    """Add chunks of all documents in the bucket that are not in the journal yet to the index, batch by batch.
+
+    Documents are parsed by the worker processes while earlier batches are embedded, which is limited by the API
+    quota. At most two documents per worker are parsed ahead, to bound the memory used by waiting chunks.
+    If a changed document has fewer chunks than when it was ingested before, according to the journal or to the list
+    of ingested resumes `ingested`, its trailing datapoints are deleted once all of its chunks are added.
+    """
+    ingested = ingested or {}
+    documents = [(name, md5) for name, md5 in gcs_tools.list_blob_hashes(bucket_name=bucket_name).items()
+                 if not journal.is_complete(name, md5)]
+    logger.info('Processing %s documents from %s, skipping the ones completed in earlier runs...', len(documents),
+                bucket_name)
+    batch: list[Chunk] = []
+    # Documents whose last chunks are in the current batch, recorded as complete once the batch is added
+    waiting: list[tuple[str, str, int]] = []
+
+    def add_batch() -> None:
+        if batch:
+            me.add_texts(texts=[chunk.text for chunk in batch], metadatas=[chunk.metadata for chunk in batch],
+                         ids=[chunk.id for chunk in batch])
+            journal.record_chunks(batch)
+            batch.clear()
+        for name, md5, chunks in waiting:
+            old_chunks = max(journal.complete.get(name, {}).get('chunks', 0), ingested.get(name, {}).get('chunks', 0))
+            if old_chunks > chunks:
+                me.delete(ids=[make_datapoint_id(name, i) for i in range(chunks, old_chunks)])
+            journal.record_complete(name, md5, chunks)
+        waiting.clear()
+
+    # Spawn rather than fork the workers, since forking a process with running gRPC threads is not safe
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        remaining = iter(documents)
+        parsing: collections.deque = collections.deque(
+            (name, md5, executor.submit(load_and_split, bucket_name, name, md5))
+            for name, md5 in itertools.islice(remaining, workers * 2))
+        parsed = 0
+        while parsing:
+            name, md5, future = parsing.popleft()
+            chunks = future.result()
+            for next_name, next_md5 in itertools.islice(remaining, 1):
+                parsing.append(
+                    (next_name, next_md5, executor.submit(load_and_split, bucket_name, next_name, next_md5)))
+            for chunk in chunks:
+                if not journal.is_done(chunk.document_name, chunk.md5, chunk.id):
+                    batch.append(chunk)
+                    if len(batch) >= batch_size:
+                        add_batch()
+            waiting.append((name, md5, len(chunks)))
+            if not batch:
+                add_batch()
+            parsed += 1
+            logger.info('Parsed %s of %s documents.', parsed, len(documents))
+        add_batch()
+
+
+def read_ingested_resumes(bucket_name: str) -> tuple[dict[str, dict[str, Any]], int]:
+    """Return the list of ingested resumes and the generation of its object, or 0 if there is no list yet."""
+    blob = storage.Client(project=PROJECT_ID).bucket(bucket_name).get_blob(ME_INGESTED_RESUMES)
+    if blob is None:
+        return {}, 0
+    return json.loads(blob.download_as_bytes(if_generation_match=blob.generation)), blob.generation
+
+
+def publish_ingested_resumes(bucket_name: str, journal: IngestionJournal) -> None:
+    """Merge the completed documents into the list of ingested resumes of the resume manager (see `ingestion.py`).
+
+    The resume manager then skips the resumes loaded here instead of embedding them again on its next rebuild.
+    The list is written with a generation precondition, so resumes ingested by the resume manager in the meantime are
+    merged rather than overwritten.
+    """
+    blob = storage.Client(project=PROJECT_ID).bucket(bucket_name).blob(ME_INGESTED_RESUMES)
+    for attempt in range(1, PUBLISH_ATTEMPTS + 1):
+        try:
+            ingested, generation = read_ingested_resumes(bucket_name=bucket_name)
+            ingested.update(journal.complete)
+            blob.upload_from_string(json.dumps(ingested), content_type='application/json',
+                                    if_generation_match=generation)
+            return
+        except (exceptions.PreconditionFailed, exceptions.NotFound):
+            if attempt == PUBLISH_ATTEMPTS:
+                raise
+            logger.warning('List of ingested resumes in %s changed while publishing, retrying...', bucket_name)
+
+
+def main() -> None:
+    logger.info('Initializing...')
+    logger.info(f'Vertex AI SDK version: {aiplatform.__version__}')
+    logger.info(f'LangChain version: {langchain.__version__}')
+
+    # Initialize Vertex AI SDK
+    vertexai.init(project=PROJECT_ID, location=REGION)
+
+    mengine = MatchingEngineUtils(PROJECT_ID, ME_REGION, ME_INDEX_NAME)
+    create_index(mengine)
+    deploy_index(mengine)
+
+    # Configure Matching Engine as Vector Store. Get Matching Engine Index id and Endpoint id
+    ME_INDEX_ID, ME_INDEX_ENDPOINT_ID = mengine.get_index_and_endpoint()
+    logger.info(f'ME_INDEX_ID={ME_INDEX_ID}')
+    logger.info(f'ME_INDEX_ENDPOINT_ID={ME_INDEX_ENDPOINT_ID}')
+
+    # Initialize Matching Engine vector store with text embeddings model
+    me_bucket_name = f'gs://{ME_EMBEDDING_DIR}'.split('/')[2]
+    me = MatchingEngine.from_components(
+        project_id=PROJECT_ID,
+        region=ME_REGION,
+        gcs_bucket_name=me_bucket_name,
+        embedding=CustomVertexAIEmbeddings(requests_per_minute=EMBEDDING_QPM),
+        index_id=ME_INDEX_ID,
+        endpoint_id=ME_INDEX_ENDPOINT_ID,
+    )
+
+    # Add embeddings to the vector store
+    # Depending on the volume and size of documents, this step may take time.
+    journal = IngestionJournal(INGESTION_JOURNAL)
+    ingested, _ = read_ingested_resumes(bucket_name=me_bucket_name)
+    try:
+        ingest_documents(me=me, bucket_name=GCS_BUCKET_DOCS, journal=journal, ingested=ingested)
+    except Exception as err:    # noqa: B902
+        logger.error('Ingestion failed, rerun the script to continue from the last completed batch: %s', err)
+        raise
+    finally:
+        journal.close()
+    publish_ingested_resumes(bucket_name=me_bucket_name, journal=journal)
+
+    # Validate semantic search with Matching Engine is working
+    me.similarity_search('List all people with Java skills?', k=2)
+    me.similarity_search('Who is the CTO of Qarik Group?', k=2)
+
+
+if __name__ == '__main__':
+    main()